@@ -21,7 +21,16 @@ LOGS = PLOT_ME_ROOT.joinpath(f"logs/{datetime.now():%Y-%m-%d_%H-%M}.log")
 LOGS.parent.mkdir(parents=True, exist_ok=True)
 RECORDS = PLOT_ME_ROOT.joinpath(f"logs/classify_timings.tsv")
 
-from plot_me import parse_DB, classify, tools, bio
+SUBMODULES = ("parse_DB", "classify", "tools", "bio", "taxonomy", "kmer_store", "counts_cache", "parse_multi", "reports",
+              "benchmarks")
+
+
+def __getattr__(name):
+    """ Import the submodules on first access (plot_me.classify...), to keep the start of each entry point fast """
+    if name in SUBMODULES:
+        import importlib
+        return importlib.import_module(f"plot_me.{name}")
+    raise AttributeError(f"module 'plot_me' has no attribute '{name}'")
 
 if __name__ == '__main__':
     print(f"PLoT-ME version {__version__}. "
@@ -0,0 +1,420 @@
+#!/usr/bin/env python3
+"""
+#############################################################################
+Benchmarks of PLoT-ME's hot spots, comparing the current implementations
+ with the previous ones on synthetic data.
+Usage: python -m plot_me.benchmarks <benchmark> [options]
+
+#############################################################################
+Sylvain @ GIS / Biopolis / Singapore
+Sylvain RIONDET <sylvainriondet@gmail.com>
+PLoT-ME: Pre-classification of Long-reads for Memory Efficient Taxonomic assignment
+https://github.com/sylvain-ri/PLoT-ME
+#############################################################################
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+from time import perf_counter
+
+import numpy as np
+
+from plot_me.tools import init_logger
+
+
+logger = init_logger('benchmarks')
+# Dependencies taking seconds to import, that the entry point of plot-me.classify shouldn't load
+HEAVY_MODULES = ("sklearn", "scipy", "matplotlib", "pandas", "ete3")
+
+
+def random_sequence(length, n_ratio=0.001, seed=3):
+    """ Random nucleotide string, with a few N sprinkled in """
+    rng = np.random.default_rng(seed)
+    seq = rng.choice(np.frombuffer(b"ACGT", dtype=np.uint8), size=length)
+    seq[rng.random(length) < n_ratio] = ord("N")
+    return seq.tobytes().decode()
+
+
+def timeit(func, *args, repeat=5):
+    """ Best wall time of a few runs, in seconds """
+    best = float("inf")
+    for _ in range(repeat):
+        start = perf_counter()
+        func(*args)
+        best = min(best, perf_counter() - start)
+    return best
+
+
+def bench_kmer_counting(length=10000, k=4, repeat=5):
+    """ Dict based seq_count_kmer() vs numpy seq_count_kmer_array(), on one segment of a given length """
+    from plot_me.bio import kmers_dic, seq_count_kmer, seq_count_kmer_array
+
+    seq = random_sequence(length)
+    legacy = np.fromiter(seq_count_kmer(seq, kmers_dic(k), k).values(), dtype=int)
+    assert np.array_equal(legacy, seq_count_kmer_array(seq, k)), "numpy and dict k-mer counts differ"
+
+    t_dict = timeit(lambda: seq_count_kmer(seq, kmers_dic(k), k), repeat=repeat)
+    t_numpy = timeit(lambda: seq_count_kmer_array(seq, k), repeat=repeat)
+    logger.info(f"k-mer counting, k={k}, sequence of {length} bp: dict {t_dict*1000:.2f} ms, "
+                f"numpy {t_numpy*1000:.2f} ms, speed up x{t_dict/t_numpy:.1f}")
+    return t_dict, t_numpy
+
+
+def random_reads(n_reads, mean_length=5000, seed=3):
+    """ Synthetic long reads as Biopython SeqRecords, with random lengths around the mean """
+    from Bio.Seq import Seq
+    from Bio.SeqRecord import SeqRecord
+
+    rng = np.random.default_rng(seed)
+    genome = random_sequence(4 * mean_length * 10, seed=seed)
+    records = []
+    for i in range(n_reads):
+        length = max(100, int(rng.normal(mean_length, mean_length / 4)))
+        start = int(rng.integers(0, len(genome) - length))
+        records.append(SeqRecord(Seq(genome[start:start + length]), id=f"read_{i}", description=f"read_{i} synthetic",
+                                 letter_annotations={"phred_quality": [30] * length}))
+    return records
+
+
+def toy_model(k=4, n_clusters=10, canonical=False):
+    """ MiniBatchKMeans trained on random k-mer profiles, to time the predictions """
+    from sklearn.cluster import MiniBatchKMeans
+    from plot_me.bio import kmer_columns
+
+    rng = np.random.default_rng(3)
+    profiles = rng.random((n_clusters * 100, len(kmer_columns(k, canonical))), dtype=np.float32)
+    model = MiniBatchKMeans(n_clusters=n_clusters, random_state=3, batch_size=1000, n_init=3)
+    model.fit(profiles)
+    model.canonical = canonical
+    return model
+
+
+def bench_binning(n_reads=5000, mean_length=5000, k=4, batch_size=10000):
+    """ Reads/sec of the read-to-bin assignment, one MODEL.predict per read vs batched predictions """
+    from plot_me import classify
+    from plot_me.classify import ReadToBin
+
+    records = random_reads(n_reads, mean_length)
+    classify.K = k
+    ReadToBin.MODEL = toy_model(k)
+
+    start = perf_counter()
+    per_read = []
+    for record in records:
+        read = ReadToBin(record)
+        read.scale()
+        per_read.append(read.find_bin())
+    t_per_read = perf_counter() - start
+
+    start = perf_counter()
+    batched = []
+    for i in range(0, n_reads, batch_size):
+        batched.extend(ReadToBin.predict_batch([record.seq for record in records[i:i + batch_size]]))
+    t_batched = perf_counter() - start
+
+    agreement = np.mean(np.array(per_read) == np.array(batched))
+    logger.info(f"read binning, {n_reads} reads of ~{mean_length} bp, k={k}: per read {n_reads/t_per_read:.0f} reads/s, "
+                f"batches of {batch_size} {n_reads/t_batched:.0f} reads/s, speed up x{t_per_read/t_batched:.1f} "
+                f"(same bin for {agreement:.2%} of the reads)")
+    return t_per_read, t_batched
+
+
+def bench_reader(n_reads=20000, mean_length=5000, fmt="fastq"):
+    """ Reads/sec to parse a file and prepare the tagged records for the bin files:
+        Biopython SeqIO + ReadToBin wrapper + SeqRecord.format vs read_fastx_raw() + tag_raw_record()
+    """
+    from Bio import SeqIO
+    from plot_me.bio import read_fastx_raw, tag_raw_record
+    from plot_me.classify import ReadToBin
+
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, f"reads.{fmt}")
+        SeqIO.write(random_reads(n_reads, mean_length), path, fmt)
+
+        start = perf_counter()
+        via_seqio = []
+        for record in SeqIO.parse(path, fmt):
+            read = ReadToBin(record)
+            read.set_bin(0)
+            via_seqio.append(read.format(fmt).encode())
+        t_seqio = perf_counter() - start
+
+        start = perf_counter()
+        via_raw = [tag_raw_record(raw, header, b"bin_id=0") for header, seq, raw in read_fastx_raw(path, fmt)]
+        t_raw = perf_counter() - start
+
+    assert via_seqio == via_raw, "raw records differ from the ones written by Biopython"
+    logger.info(f"reading {n_reads} {fmt} reads of ~{mean_length} bp: SeqIO {n_reads/t_seqio:.0f} reads/s, "
+                f"raw bytes {n_reads/t_raw:.0f} reads/s, speed up x{t_seqio/t_raw:.1f}")
+    return t_seqio, t_raw
+
+
+def bench_model(n_rows=100000, k=4, n_clusters=20, repeat=5):
+    """ Loading time of the pickled sklearn model vs the .npz CentroidModel, and rows/sec of their predictions """
+    import pickle
+    from plot_me.tools import CentroidModel
+
+    model = toy_model(k, n_clusters)
+    centroids = CentroidModel.from_sklearn(model, k, 10000)
+    rows = np.random.default_rng(5).random((n_rows, model.cluster_centers_.shape[1]), dtype=np.float32)
+    with tempfile.TemporaryDirectory() as folder:
+        path_pkl, path_npz = os.path.join(folder, "model.pkl"), os.path.join(folder, "model.npz")
+        with open(path_pkl, "wb") as f:
+            pickle.dump(model, f)
+        centroids.save(path_npz)
+
+        def load_pkl():
+            with open(path_pkl, "rb") as f:
+                return pickle.load(f)
+        t_load_pkl = timeit(load_pkl, repeat=repeat)
+        t_load_npz = timeit(CentroidModel.load, path_npz, repeat=repeat)
+
+    t_sklearn = timeit(model.predict, rows, repeat=repeat)
+    t_numpy = timeit(centroids.predict, rows, repeat=repeat)
+    agreement = np.mean(model.predict(rows) == centroids.predict(rows))
+    logger.info(f"model loading: pickle {t_load_pkl*1000:.2f} ms, npz {t_load_npz*1000:.2f} ms. "
+                f"Predicting {n_rows} rows, k={k}, {n_clusters} clusters: sklearn {n_rows/t_sklearn:.0f} rows/s, "
+                f"numpy {n_rows/t_numpy:.0f} rows/s, speed up x{t_sklearn/t_numpy:.1f} (same bin for {agreement:.2%})")
+    return t_sklearn, t_numpy
+
+
+def bench_scaling(n_rows=200000, k=4, w=10000):
+    """ Building the input of the clustering (step 2 of plot-me.preprocess): DataFrame scaled column by column then
+        sliced for fit and predict, vs the float32 matrix scaled while loading the shards of the KmerStore.
+        Wall time and peak memory (tracemalloc) of each
+    """
+    import tracemalloc
+    import pandas as pd
+    from plot_me.bio import kmer_columns
+    from plot_me.kmer_store import KmerStore
+    from plot_me.tools import kmer_scaling_ratio
+
+    cols = kmer_columns(k)
+    counts = np.random.default_rng(7).integers(0, 3 * w // 4**k + 1, size=(n_rows, len(cols)), dtype=np.uint16)
+    ratio = kmer_scaling_ratio(k, w)
+
+    def legacy():
+        df = pd.DataFrame(counts.astype(np.float32), columns=cols)  # as read_csv with float32 columns
+        df.insert(0, "taxon", 1)
+        for col in cols:
+            df[col] *= ratio
+        return df[cols].to_numpy(), df[cols].to_numpy()  # one copy for fit, one for predict
+
+    def measure(func):
+        tracemalloc.start()
+        start = perf_counter()
+        result = func()
+        elapsed = perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return result, elapsed, peak
+
+    with tempfile.TemporaryDirectory() as folder:
+        store = KmerStore(os.path.join(folder, "store"), len(cols), k)
+        for part in np.array_split(np.arange(n_rows), 4):  # a few shards
+            store.append(pd.DataFrame({"taxon": 1, "category": "chromosome", "start": 0, "end": w, "name": "NC",
+                                       "fna_path": "genome.fna"}, index=part).join(
+                pd.DataFrame(counts[part], columns=cols, index=part)))
+            store.flush()
+        (fit_legacy, _), t_legacy, m_legacy = measure(legacy)
+        data, t_store, m_store = measure(lambda: store.to_float32(ratio))
+    assert np.array_equal(fit_legacy, data), "scaled matrices differ"
+    logger.info(f"clustering input of {n_rows} segments x {len(cols)} k-mers: DataFrame scaled by column "
+                f"{t_legacy:.2f} s, peak {m_legacy / 2**20:.0f} MB. Store to float32 {t_store:.2f} s, peak "
+                f"{m_store / 2**20:.0f} MB. speed up x{t_legacy/t_store:.1f}, memory /{m_legacy/m_store:.1f}")
+    return t_legacy, t_store
+
+
+def bench_genome(length=20 * 10**6, k=4, w=10000):
+    """ k-mer counting of the segments of a genome (step 0 of plot-me.preprocess): all SeqRecords loaded, then one
+        SeqRecord per segment vs records streamed and windows counted from the sequence buffer.
+        Wall time, and peak memory (tracemalloc, separate run as it slows down allocations) of each
+    """
+    import tracemalloc
+    from Bio import SeqIO
+    from Bio.SeqRecord import SeqRecord
+    from plot_me.bio import count_kmer_windows, read_fasta_sequences, seq_count_kmer_array
+
+    def legacy(path):
+        records = list(SeqIO.parse(path, "fasta"))
+        counts = []
+        for record in records:
+            for start in range(0, len(record.seq) - w, w):
+                segment = SeqRecord(record.seq[start:start + w], record.id, record.name, record.description,
+                                    record.dbxrefs, record.features, record.annotations, record.letter_annotations)
+                counts.append(seq_count_kmer_array(segment.seq, k))
+        return np.array(counts, dtype=np.uint16)
+
+    def streamed(path):
+        return np.concatenate([count_kmer_windows(seq, k, w) for _, seq in read_fasta_sequences(path)])
+
+    def measure(func, path):
+        start = perf_counter()
+        result = func(path)
+        elapsed = perf_counter() - start
+        tracemalloc.start()
+        func(path)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return result, elapsed, peak
+
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "genome.fna")
+        with open(path, "w") as f:
+            for i, (name, size) in enumerate([("chromosome", length // 4)] * 4 + [("plasmid", length // 100)]):
+                seq = random_sequence(size, seed=i)
+                f.write(f">NC_{i} synthetic {name}\n")
+                f.writelines(seq[j:j + 80] + "\n" for j in range(0, size, 80))
+        counts_legacy, t_legacy, m_legacy = measure(legacy, path)
+        counts_stream, t_stream, m_stream = measure(streamed, path)
+    assert np.array_equal(counts_legacy, counts_stream), "k-mer counts of the segments differ"
+    logger.info(f"counting {len(counts_stream)} segments of {w} bp, k={k}, genome of {length / 10**6:.0f} Mbp "
+                f"(4 chromosomes): SeqRecords {t_legacy:.2f} s, peak {m_legacy / 2**20:.0f} MB. Streamed {t_stream:.2f} s, peak "
+                f"{m_stream / 2**20:.0f} MB. speed up x{t_legacy/t_stream:.1f}, memory /{m_legacy/m_stream:.1f}")
+    return t_legacy, t_stream
+
+
+def bench_multi_k(length=20 * 10**6, ks=(3, 4, 5, 6), w=10000):
+    """ k-mer counting of the segments of a genome for several k (parameter sweep): one pass per k vs a single pass at
+        the largest k, the smaller ones derived by marginalization. The sequence is parsed once per pass
+    """
+    from plot_me.bio import count_kmer_windows, count_kmer_windows_multi, read_fasta_sequences
+
+    def per_k(path):
+        return {k: np.concatenate([count_kmer_windows(seq, k, w) for _, seq in read_fasta_sequences(path)]) for k in ks}
+
+    def single_pass(path):
+        counts = [count_kmer_windows_multi(seq, ks, w) for _, seq in read_fasta_sequences(path)]
+        return {k: np.concatenate([c[k] for c in counts]) for k in ks}
+
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "genome.fna")
+        with open(path, "w") as f:
+            for i in range(4):
+                seq = random_sequence(length // 4, seed=i)
+                f.write(f">NC_{i} synthetic chromosome\n")
+                f.writelines(seq[j:j + 80] + "\n" for j in range(0, length // 4, 80))
+        start = perf_counter()
+        counts_per_k = per_k(path)
+        t_per_k = perf_counter() - start
+        start = perf_counter()
+        counts_single = single_pass(path)
+        t_single = perf_counter() - start
+    for k in ks:
+        assert np.array_equal(counts_per_k[k], counts_single[k]), f"{k}-mer counts of the segments differ"
+    logger.info(f"counting {len(counts_single[ks[0]])} segments of {w} bp for k={list(ks)}, genome of "
+                f"{length / 10**6:.0f} Mbp: one pass per k {t_per_k:.2f} s, single pass {t_single:.2f} s. "
+                f"speed up x{t_per_k/t_single:.1f}")
+    return t_per_k, t_single
+
+
+def bench_startup(module="plot_me.classify", max_seconds=1., repeat=5):
+    """ Cold start of an entry point: best wall time of a fresh interpreter running `python -m <module> --help`.
+        Fails if it takes more than max_seconds, or if importing the module loads one of the HEAVY_MODULES
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = perf_counter()
+        subprocess.run([sys.executable, "-m", module, "--help"], check=True, stdout=subprocess.DEVNULL)
+        best = min(best, perf_counter() - start)
+    loaded = subprocess.run([sys.executable, "-c", f"import sys, {module}; "
+                                                   f"print(' '.join(m for m in {HEAVY_MODULES} if m in sys.modules))"],
+                            check=True, stdout=subprocess.PIPE, encoding="utf-8").stdout.split()
+
+    logger.info(f"cold start of {module} --help: {best:.3f} s (limit {max_seconds} s), heavy modules imported: {loaded}")
+    success = best <= max_seconds and not loaded
+    if not success:
+        logger.error(f"start up of {module} has regressed")
+    return success
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    kmer = subparsers.add_parser("kmer", help="k-mer counting, dict vs numpy")
+    kmer.add_argument('-l', '--length', help='Length of the sequence (default=%(default)d)',
+                                        default=10000, type=int, metavar='')
+    kmer.add_argument('-k', '--kmer',   help='Size of the kmers (default=%(default)d)',
+                                        default=4, type=int, metavar='')
+    kmer.add_argument('-r', '--repeat', help='Number of runs, best one is kept (default=%(default)d)',
+                                        default=5, type=int, metavar='')
+
+    binning = subparsers.add_parser("binning", help="read binning, one prediction per read vs batches")
+    binning.add_argument('-n', '--reads',     help='Number of synthetic reads (default=%(default)d)',
+                                              default=5000, type=int, metavar='')
+    binning.add_argument('-l', '--length',    help='Mean length of the reads (default=%(default)d)',
+                                              default=5000, type=int, metavar='')
+    binning.add_argument('-k', '--kmer',      help='Size of the kmers (default=%(default)d)',
+                                              default=4, type=int, metavar='')
+    binning.add_argument('-b', '--batch_size',help='Number of reads per batch (default=%(default)d)',
+                                              default=10000, type=int, metavar='')
+
+    reader = subparsers.add_parser("reader", help="parsing reads, Biopython SeqIO vs raw bytes")
+    reader.add_argument('-n', '--reads',      help='Number of synthetic reads (default=%(default)d)',
+                                              default=20000, type=int, metavar='')
+    reader.add_argument('-l', '--length',     help='Mean length of the reads (default=%(default)d)',
+                                              default=5000, type=int, metavar='')
+    reader.add_argument('-f', '--format',     help='File format (default=%(default)s)',
+                                              default="fastq", choices=("fastq", "fasta"), type=str, metavar='')
+
+    model = subparsers.add_parser("model", help="pickled sklearn model vs npz centroids, loading and predictions")
+    model.add_argument('-n', '--rows',        help='Number of k-mer profiles to predict (default=%(default)d)',
+                                              default=100000, type=int, metavar='')
+    model.add_argument('-k', '--kmer',        help='Size of the kmers (default=%(default)d)',
+                                              default=4, type=int, metavar='')
+    model.add_argument('-b', '--clusters',    help='Number of clusters (default=%(default)d)',
+                                              default=20, type=int, metavar='')
+
+    scaling = subparsers.add_parser("scaling", help="input of the clustering, DataFrame vs float32 matrix from the store")
+    scaling.add_argument('-n', '--rows',      help='Number of segments (default=%(default)d)',
+                                              default=200000, type=int, metavar='')
+    scaling.add_argument('-k', '--kmer',      help='Size of the kmers (default=%(default)d)',
+                                              default=4, type=int, metavar='')
+
+    genome = subparsers.add_parser("genome", help="counting the segments of a genome, SeqRecords vs streamed")
+    genome.add_argument('-l', '--length',     help='Length of the genome (default=%(default)d)',
+                                              default=20 * 10**6, type=int, metavar='')
+    genome.add_argument('-k', '--kmer',       help='Size of the kmers (default=%(default)d)',
+                                              default=4, type=int, metavar='')
+    genome.add_argument('-w', '--window',     help='Length of the segments (default=%(default)d)',
+                                              default=10000, type=int, metavar='')
+
+    multi_k = subparsers.add_parser("multik", help="counting several k, one pass per k vs a single pass")
+    multi_k.add_argument('-l', '--length',    help='Length of the genome (default=%(default)d)',
+                                              default=20 * 10**6, type=int, metavar='')
+    multi_k.add_argument('-k', '--kmer',      help='Sizes of the kmers (default=%(default)s)',
+                                              default=[3, 4, 5, 6], type=int, nargs="+", metavar='')
+    multi_k.add_argument('-w', '--window',    help='Length of the segments (default=%(default)d)',
+                                              default=10000, type=int, metavar='')
+
+    startup = subparsers.add_parser("startup", help="cold start of an entry point, fails if too slow")
+    startup.add_argument('-m', '--module',    help='Module of the entry point (default=%(default)s)',
+                                              default="plot_me.classify", type=str, metavar='')
+    startup.add_argument('-s', '--seconds',   help='Maximum time of the start up (default=%(default).1f)',
+                                              default=1., type=float, metavar='')
+
+    args = parser.parse_args()
+    if args.benchmark == "kmer":
+        bench_kmer_counting(args.length, args.kmer, args.repeat)
+    elif args.benchmark == "binning":
+        bench_binning(args.reads, args.length, args.kmer, args.batch_size)
+    elif args.benchmark == "reader":
+        bench_reader(args.reads, args.length, args.format)
+    elif args.benchmark == "model":
+        bench_model(args.rows, args.kmer, args.clusters)
+    elif args.benchmark == "scaling":
+        bench_scaling(args.rows, args.kmer)
+    elif args.benchmark == "genome":
+        bench_genome(args.length, args.kmer, args.window)
+    elif args.benchmark == "multik":
+        bench_multi_k(args.length, sorted(set(args.kmer)), args.window)
+    elif args.benchmark == "startup":
+        if not bench_startup(args.module, args.seconds):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    arg_parser()
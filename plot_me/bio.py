@@ -8,11 +8,14 @@ Reads Binning Project
 #############################################################################
 common resources for biology related functions and Classes
 """
+from functools import lru_cache
+import os
 import traceback
 
 # todo: check if this logger works
-import ete3.ncbi_taxonomy
+import numpy as np
 
+from plot_me.taxonomy import get_taxonomy
 from plot_me.tools import init_logger
 
 logger = init_logger("bio")
@@ -45,12 +48,8 @@ def seq_count_kmer(seq, kmer_count=None, k=4, ignore_N=True):
         seq: string nucleotide input
         kmer_count: dict with all combinations of nucleotides, initialized with zeros (kmer_template["AAAA"] = 0, kmer_count["AAAC"] = 0...)
         the new string hashing behaviour, BiopythonWarning: Using str(seq) to use the new behaviour
+        Legacy dict version, much slower than seq_count_kmer_array(), kept for benchmarking
     """
-    # todo: numba. to speed the counting by a few folds
-    # todo: add reverse complement into the same count
-    # https://numba.pydata.org/numba-doc/dev/reference/pysupported.html#typed-dict
-    # https://numba.pydata.org/numba-doc/dev/user/performance-tips.html#performance-tips
-    # https://numba.pydata.org/numba-doc/latest/user/parallel.html
     if kmer_count is None:
         kmer_count = kmers_dic(k)
     logger.log(5, 'counting kmers')
@@ -73,35 +72,250 @@ def seq_count_kmer(seq, kmer_count=None, k=4, ignore_N=True):
         return kmer_count
 
 
-ncbi = ete3.ncbi_taxonomy.NCBITaxa()
+# 2-bit encoding of the nucleotides (A=0, C=1, G=2, T=3), any other character (N, IUPAC codes) is set to 4
+nucleotides_codes = np.full(256, 4, dtype=np.uint8)
+for _i, _base in enumerate(nucleotides):
+    nucleotides_codes[ord(_base)] = _i
+    nucleotides_codes[ord(_base.lower())] = _i
+
+
+def seq_to_codes(seq):
+    """ Encode a sequence (str, bytes or Bio.Seq) into a uint8 array of 2-bit codes, 4 for non ACGT characters """
+    if isinstance(seq, str):
+        seq = seq.encode("ascii", "replace")
+    elif not isinstance(seq, (bytes, bytearray, memoryview)):
+        seq = str(seq).encode("ascii", "replace")
+    return nucleotides_codes[np.frombuffer(seq, dtype=np.uint8)]
+
+
+def codes_to_kmer_index(codes, k=4):
+    """ Rolling integer index of each k-mer of an encoded sequence, same order as combinaisons(nucleotides, k)
+        (AA..A=0, AA..C=1, ...). k-mers overlapping a non ACGT character are set to -1
+        Works on the last axis, so a matrix of encoded segments (one per row) gives the k-mers of each row
+    """
+    n = codes.shape[-1] - k + 1
+    if n <= 0:
+        return np.empty(codes.shape[:-1] + (0,), dtype=np.int64)
+    invalid = codes > 3
+    clean = np.where(invalid, 0, codes)
+    index = np.zeros(codes.shape[:-1] + (n,), dtype=np.int64)
+    for j in range(k):
+        index <<= 2
+        index |= clean[..., j:j + n]
+    if invalid.any():
+        # number of invalid characters inside each window of size k
+        cum_invalid = np.concatenate((np.zeros(codes.shape[:-1] + (1,), dtype=np.int64),
+                                      np.cumsum(invalid, axis=-1, dtype=np.int64)), axis=-1)
+        index[cum_invalid[..., k:] - cum_invalid[..., :-k] > 0] = -1
+    return index
+
+
+def seq_count_kmer_array(seq, k=4, canonical=False):
+    """ Count all kmers with numpy, ignore kmers with N or other undecided nucleotides
+        seq: string/bytes/Seq nucleotide input
+        return a dense vector of 4**k counts, in the same column order as combinaisons(nucleotides, k)
+        canonical: merge each k-mer with its reverse complement, see canonical_kmers()
+    """
+    index = codes_to_kmer_index(seq_to_codes(seq), k)
+    counts = np.bincount(index[index >= 0], minlength=4**k)
+    return fold_canonical(counts, k) if canonical else counts
+
+
+def count_kmer_windows(seq, k=4, w=10000, canonical=False, chunk=2**18):
+    """ Count the kmers of the consecutive windows seq[start:start+w], start in range(0, len(seq) - w, w), straight from
+        the sequence buffer (bytes/bytearray), by chunks of whole windows of about chunk nucleotides (or k-mer counters)
+        return a uint16 matrix, one row per window, same columns as seq_count_kmer_array()
+    """
+    return count_kmer_windows_multi(seq, (k, ), w, canonical, chunk)[k]
+
+
+def count_kmer_windows_multi(seq, ks=(4, ), w=10000, canonical=False, chunk=2**18):
+    """ Same as count_kmer_windows() for several k-mer sizes in a single pass: the windows are only counted at the
+        largest k, the counts of each smaller k are derived from the next larger one (marginalize_kmers()), plus the
+        k-mers followed by a window's end or a non ACGT character (kmers_before_boundaries())
+        return {k: uint16 matrix}
+    """
+    ks = sorted(set(ks))
+    top = ks[-1]
+    n_windows = len(range(0, len(seq) - w, w))
+    counts = {k: np.empty((n_windows, len(canonical_kmers(k)) if canonical else 4**k), dtype=np.uint16) for k in ks}
+    per_chunk = max(1, chunk // max(w, 4**top))
+    # each window has its own range of counters, k-mers with N go to an extra one, dropped
+    offsets = np.arange(per_chunk, dtype=np.int64)[:, None] * 4**top
+    view = memoryview(seq)
+    for first in range(0, n_windows, per_chunk):
+        rows = min(per_chunk, n_windows - first)
+        codes = seq_to_codes(view[first * w:(first + rows) * w]).reshape(rows, w)
+        index = codes_to_kmer_index(codes, top)
+        with_n = index < 0
+        index += offsets[:rows]
+        index[with_n] = rows * 4**top
+        chunk_counts = np.bincount(index.ravel(), minlength=rows * 4**top + 1)[:-1].reshape(rows, 4**top)
+        if len(ks) > 1:
+            # positions right after the end of a k-mer that can't be extended by one base: window's end or N
+            boundaries = np.nonzero(codes > 3)
+            boundaries = (np.concatenate((boundaries[0], np.arange(rows))),
+                          np.concatenate((boundaries[1], np.full(rows, w))))
+        for k in range(top, ks[0] - 1, -1):
+            if k < top:
+                chunk_counts = marginalize_kmers(chunk_counts, k + 1) + kmers_before_boundaries(codes, boundaries, k)
+            if k in counts:
+                counts[k][first:first + rows] = fold_canonical(chunk_counts, k) if canonical else chunk_counts
+    return counts
+
+
+def marginalize_kmers(counts, k):
+    """ Counts of the (k-1)-mers from the counts of the k-mers (last axis), by summing over their last base.
+        Each (k-1)-mer is counted once per k-mer it starts, so the last (k-1)-mer of a sequence, and the ones followed
+        by a non ACGT character are missing, see kmers_before_boundaries()
+    """
+    return counts.reshape(counts.shape[:-1] + (4**(k - 1), 4)).sum(axis=-1)
+
+
+def kmers_before_boundaries(codes, boundaries, k):
+    """ Counts of the k-mers ending right before each boundary (row, column) of a matrix of encoded segments (one per
+        row), to complete marginalize_kmers(). Boundaries are the non ACGT characters and the ends of rows (column
+        equal to the width), k-mers starting before the row or overlapping a non ACGT character are ignored
+    """
+    rows, cols = boundaries
+    starts = cols - k
+    inside = starts >= 0
+    rows, starts = rows[inside], starts[inside]
+    index = codes_to_kmer_index(codes[rows[:, None], starts[:, None] + np.arange(k)], k)[:, 0]
+    valid = index >= 0
+    return np.bincount(rows[valid] * 4**k + index[valid], minlength=codes.shape[0] * 4**k).reshape(-1, 4**k)
+
+
+@lru_cache(maxsize=None)
+def reverse_complement_index(k):
+    """ Index of the reverse complement of each k-mer index (A<->T, C<->G with the 2-bit encoding 3 - code) """
+    index = np.arange(4**k, dtype=np.int64)
+    rc_index = np.zeros(4**k, dtype=np.int64)
+    for _ in range(k):
+        rc_index = (rc_index << 2) | (3 - (index & 3))
+        index >>= 2
+    return rc_index
+
+
+@lru_cache(maxsize=None)
+def canonical_kmers(k):
+    """ Index of the canonical k-mers (smallest of the k-mer and its reverse complement), in combinaisons() order.
+        (4**k + 4**(k/2)) / 2 k-mers for even k (palindromes are their own reverse complement), 4**k / 2 for odd k
+    """
+    rc_index = reverse_complement_index(k)
+    return np.flatnonzero(np.arange(4**k) <= rc_index)
+
+
+def fold_canonical(counts, k):
+    """ Merge counts of k-mers with their reverse complement (last axis of 4**k k-mers -> canonical k-mers) """
+    canonical = canonical_kmers(k)
+    rc_canonical = reverse_complement_index(k)[canonical]
+    not_palindrome = canonical != rc_canonical
+    return counts[..., canonical] + counts[..., rc_canonical] * not_palindrome
+
+
+def kmer_columns(k, canonical=False):
+    """ Names of the k-mer columns, for all k-mers or only the canonical ones """
+    all_kmers = combinaisons(nucleotides, k)
+    if not canonical:
+        return list(all_kmers)
+    return [all_kmers[i] for i in canonical_kmers(k)]
 
 
 # #############################################################################
-# Related to taxonomy
-def get_desired_ranks(taxid, desired_ranks, tolist=False):
-    """ Get all taxonomy ids of desired ranks
-        From stackoverflow
-        https://stackoverflow.com/questions/36503042/how-to-get-taxonomic-specific-ids-for-kingdom-phylum-class-order-family-gen
+# Raw reads parsing, without Biopython objects
+def read_fastx_raw(path_or_handle, fmt="fastq", ends=None):
+    """ Lightweight reader of fastq (4 lines per record) or fasta (multi-line) files, working on bytes
+        yields (header, seq, raw_record) for each record: header without the '@'/'>' and line return,
+        the sequence on a single line, and the raw bytes of the record exactly as in the file.
+        ends: list/deque to which the offset of the end of each record is appended before it's yielded, as the
+        number of bytes read from the handle (with the blank lines or text out of the records skipped by the reader)
     """
-    try:
-        lineage = ncbi.get_lineage(taxid)
-        lineage2ranks = ncbi.get_rank(lineage)
-        ranks2lineage = dict((rank, taxid) for (taxid, rank) in lineage2ranks.items())
-        if tolist: return [ranks2lineage.get(rank, 0) for rank in desired_ranks]
-        else:      return {f'{rank}_id': ranks2lineage.get(rank, 0) for rank in desired_ranks}
-    except:
-        print(f"retrieval of the lineage of {taxid} failed")
-        if tolist: return [0 for rank in desired_ranks]
-        else:      return {f'{rank}_id': 0 for rank in desired_ranks}
+    if isinstance(path_or_handle, (str, bytes, os.PathLike)):
+        with open(path_or_handle, "rb") as handle:
+            yield from read_fastx_raw(handle, fmt, ends)
+        return
+
+    lines = iter(path_or_handle)
+    read = 0
+    if fmt == "fastq":
+        for header in lines:
+            read += len(header)
+            if not header.strip():
+                continue
+            try:
+                seq, plus, quality = next(lines), next(lines), next(lines)
+            except StopIteration:
+                raise ValueError(f"Truncated fastq record at the end of the file: "
+                                 f"{header.rstrip().decode(errors='replace')[:100]}") from None
+            read += len(seq) + len(plus) + len(quality)
+            if ends is not None:
+                ends.append(read)
+            yield header[1:].rstrip(b"\r\n"), seq.rstrip(b"\r\n"), header + seq + plus + quality
+
+    elif fmt == "fasta":
+        header, seq_lines = None, []
+        for line in lines:
+            if line.startswith(b">"):
+                if header is not None:
+                    if ends is not None:
+                        ends.append(read)
+                    yield fasta_record(header, seq_lines)
+                header, seq_lines = line, []
+            elif header is not None:
+                seq_lines.append(line)
+            read += len(line)
+        if header is not None:
+            if ends is not None:
+                ends.append(read)
+            yield fasta_record(header, seq_lines)
+    else:
+        raise NotImplementedError(f"Format {fmt} not supported, only fastq and fasta")
+
+
+def read_fasta_sequences(path):
+    """ Stream the records of a fasta file as (header, seq): header without '>' and line return, the sequence as a
+        single bytearray. Only the current record is held in memory, no raw record kept (unlike read_fastx_raw)
+    """
+    with open(path, "rb") as handle:
+        header, seq = None, bytearray()
+        for line in handle:
+            if line.startswith(b">"):
+                if header is not None:
+                    yield header, seq
+                header, seq = line[1:].rstrip(b"\r\n"), bytearray()
+            elif header is not None:
+                seq += line.rstrip()
+        if header is not None:
+            yield header, seq
+
+
+def fasta_record(header, seq_lines):
+    """ (header, seq, raw_record) from the header line and the sequence lines of a fasta record """
+    raw_seq = b"".join(seq_lines)
+    return header[1:].rstrip(b"\r\n"), raw_seq.replace(b"\n", b"").replace(b"\r", b""), header + raw_seq
+
+
+def tag_raw_record(raw_record, header, tag):
+    """ Add a tag in the header of a raw fastq/fasta record, the same way Biopython writes a record after
+        record.description = f"{tag}|{record.description}" : '@<id> <tag>|<original header>'
+    """
+    read_id = header.split(maxsplit=1)[0] if header else b""
+    return b"%c%s %s|%s%s" % (raw_record[0], read_id, tag, header, raw_record[len(header) + 1:])
+
+
+# #############################################################################
+# Related to taxonomy, see plot_me.taxonomy (nodes.dmp / names.dmp of the taxonomy folder)
+def get_desired_ranks(taxid, desired_ranks, tolist=False):
+    """ Get all taxonomy ids of desired ranks (0 if the taxid has no ancestor at this rank, or is unknown) """
+    ranks = get_taxonomy().at_ranks([taxid], desired_ranks)[0].tolist()
+    if tolist: return ranks
+    else:      return {f'{rank}_id': taxid_rank for rank, taxid_rank in zip(desired_ranks, ranks)}
 
 
 def get_list_rank(taxids, desired_rank="species"):
     """ Get the taxonomy id at the species level, from a list of id below species level """
-    res = []
-    for taxid in taxids:
-        name = get_desired_ranks(taxid, [desired_rank], tolist=True)[0]
-        res.append(name)
-    return res
+    return get_taxonomy().at_rank(list(taxids), desired_rank).tolist()
 
 
 
@@ -18,30 +18,36 @@ https://github.com/sylvain-ri/PLoT-ME
 """
 
 import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import csv
+import json
 from datetime import datetime as dt
-from glob import glob
+from glob import glob, escape as glob_escape
 import logging
 from multiprocessing import cpu_count
-# from multiprocessing.pool import Pool
+from multiprocessing.pool import Pool
 import os
 from os import path as osp
 import pickle
+import queue
 import shutil
 import subprocess
-from pathlib import Path
+import threading
 from time import perf_counter
 import re
 
 import numpy as np
-from Bio import SeqRecord, SeqIO
+from Bio import SeqRecord
 from tqdm import tqdm
 
 # Import paths and constants for the whole project
 from plot_me import RECORDS
 from plot_me.tools import init_logger, scale_df_by_length, is_valid_directory, is_valid_file, create_path, \
-    time_to_hms, f_size, bash_process
-from plot_me.bio import kmers_dic, seq_count_kmer
+    time_to_hms, f_size, bash_process, scale_rows_by_length, batches, BufferedWriterPool, open_input, \
+    fastx_format, fastx_base, launch_process, wait_process, total_memory, split_proportionally, \
+    Crc32Lines, file_signature, CentroidModel
+from plot_me.bio import seq_count_kmer_array, read_fastx_raw, tag_raw_record
 
 
 logger = init_logger('classify')
@@ -50,31 +56,39 @@ THREADS            = 1
 CLASSIFIERS        = (('kraken2', 'k35_l31_s7'),
                       ("centrifuge", ''))
 K                  = None
+CANONICAL          = False  # k-mers counted together with their reverse complement, set by the model
 BIN_NB             = None
 DROP_BIN_THRESHOLD = -1  # by default, will be set as 1% / BIN_NB
 
 
-def reads_in_file(file_path):
-    """ Find the number of reads in a file.
-        Count number of lines with bash wc -l and divide by 4 if fastq, otherwise by 2 (fasta) """
-    return round(int(subprocess.check_output(["wc", "-l", file_path]).split()[0]) /
-                     (4 if bin_classify.format == "fastq" else 2))
-
-
 # #############################################################################
 class ReadToBin(SeqRecord.SeqRecord):
     """ General Read. Wrapping SeqIO.Record """
     logger = logging.getLogger('classify.ReadToBin')
-    KMER = {}  # kmers_dic(K)
     FASTQ_PATH = None
     FASTQ_BIN_FOLDER = None
     FILEBASE = ""
     MODEL = None
+    PATH_MODEL = ""
     PARAM = ""
     outputs = {}
+    bin_stats = {}  # {bin_id: [reads, bases]}
     total_reads = 0
     file_has_been_binned = False
     NUMBER_BINNED = 0
+    BATCH_SIZE = 10000  # reads featurized and predicted together, with a single call to MODEL.predict
+    WRITERS = None  # BufferedWriterPool, one buffered handle per bin file
+    WRITE_BUFFER = 4 * 2**20
+    MAX_OPEN_FILES = None  # by default, half of ulimit -n
+    WORKERS = 1  # processes counting k-mers and predicting bins, while the main process reads and writes the reads
+    TAG_BIN_ID = True  # add bin_id=<cluster> in the header of the binned reads
+    COMPRESS_LEVEL = 0  # gzip level of the bin files, 0 for uncompressed
+    ASSIGNMENT = np.dtype([("offset", "<u8"), ("bin", "<u2")])  # assignment log: end of the read in the input, bin
+    CHECKPOINT_EVERY = 60  # seconds between two commits of the binning, to resume it if interrupted
+    MANIFEST = None
+    missing_bins = []  # bins of a valid manifest that aren't on disk, written again from the assignment log
+    resume = None  # checkpoint of an interrupted binning
+    input_offset = 0
 
     def __init__(self, obj):
         # wrap the object
@@ -90,25 +104,32 @@ class ReadToBin(SeqRecord.SeqRecord):
         return getattr(self._wrapped_obj, attr)
 
     @property
-    def kmer_count(self, ignore_N=True):
-        """ common method """
+    def kmer_count(self):
+        """ common method, k-mers with N are ignored """
         if self._kmer_count is None:
-            self._kmer_count = seq_count_kmer(self.seq, self.KMER.copy(), K, ignore_N=ignore_N)
+            self._kmer_count = seq_count_kmer_array(self.seq, K, canonical=CANONICAL)
         return self._kmer_count
 
     @property
-    def path_out(self, cluster=None):
-        return f"{self.FASTQ_BIN_FOLDER}/{self.FILEBASE}.bin-{self.cluster if cluster is None else cluster}.fastq"
+    def path_out(self):
+        return self.path_bin(self.cluster)
+
+    @classmethod
+    def path_bin(cls, cluster):
+        return f"{cls.FASTQ_BIN_FOLDER}/{cls.FILEBASE}.bin-{cluster}.fastq" + (".gz" if cls.COMPRESS_LEVEL > 0 else "")
 
     def scale(self):
         self.logger.log(5, "scaling the read by it's length and k-mer")
-        self.scaled = scale_df_by_length(np.fromiter(self.kmer_count.values(), dtype=int).reshape(-1, 4**K),
+        self.scaled = scale_df_by_length(self.kmer_count.reshape(1, -1),
                                          None, k=K, w=len(self.seq), single_row=True)  # Put into 2D one row
         return self.scaled
 
     def find_bin(self):
         self.logger.log(5, 'finding bins for each read')
-        self.cluster = int(self.MODEL.predict(self.scaled)[0])
+        return self.set_bin(self.MODEL.predict(self.scaled)[0])
+
+    def set_bin(self, cluster):
+        self.cluster = int(cluster)
         self.description = f"bin_id={self.cluster}|{self.description}"
         # self.path_out = f"{self.FASTQ_BIN_FOLDER}/{self.FILEBASE}.bin-{self.cluster}.fastq"
         # Save all output files
@@ -117,8 +138,16 @@ class ReadToBin(SeqRecord.SeqRecord):
 
     def to_fastq(self):
         assert self.path_out is not None, AttributeError("Path of the fastq file must first be defined")
-        with open(self.path_out, "a") as f:
-            SeqIO.write(self, f, bin_classify.format)
+        assert self.WRITERS is not None, AttributeError("Bin files must be opened by ReadToBin.bin_reads()")
+        self.WRITERS.write(self.path_out, self.format(bin_classify.format))
+
+    @classmethod
+    def predict_batch(cls, sequences):
+        """ Count the k-mers of a list of sequences into one matrix, scale it by the reads' length with one
+            broadcast multiplication, and find all their bins with a single call to MODEL.predict """
+        counts = np.array([seq_count_kmer_array(seq, K, canonical=CANONICAL) for seq in sequences])
+        lengths = np.fromiter((len(seq) for seq in sequences), dtype=np.int64, count=len(sequences))
+        return cls.MODEL.predict(scale_rows_by_length(counts, lengths, K))
 
     @classmethod
     def set_fastq_model_and_param(cls, path_fastq, path_model, param, force_binning):
@@ -126,104 +155,487 @@ class ReadToBin(SeqRecord.SeqRecord):
         # todo: load the parameter file from parse_DB.py instead of parsing string.... parameters_RefSeq_binning.txt
         cls.PARAM = param
         cls.FASTQ_PATH = path_fastq
-        folder, file_base = osp.split(osp.splitext(path_fastq)[0])
+        folder, file_base = osp.split(fastx_base(path_fastq))
         # output folder, will host one file for each bin
         cls.FASTQ_BIN_FOLDER = osp.join(folder, param)
+        cls.FILEBASE = file_base
+        cls.outputs = {}
+        cls.bin_stats = {}
+        cls.total_reads = 0
+        cls.file_has_been_binned = False
 
-        cls.total_reads = reads_in_file(cls.FASTQ_PATH)
+        cls.missing_bins = []
+        cls.resume = None
 
-        # skip if reads already binned
+        # skip if reads already binned, with the same input, model and settings. Resume an interrupted binning
         if osp.isdir(cls.FASTQ_BIN_FOLDER):
-            total_binned_reads = 0
-            if not force_binning:
-                # Compute total reads count if it hasn't been forced
-                for path in Path(cls.FASTQ_BIN_FOLDER).rglob("*bin-*.fastq"):
-                    str_path = path.as_posix()
-                    total_binned_reads += reads_in_file(str_path)
-                    _, key, _ = re.split('.bin-|.fastq', str_path)
-                    cls.outputs[int(key)] = str_path
-                cls.logger.debug(f"A folder has been detected, and holds in total {total_binned_reads} reads, "
-                                 f"compared to the {cls.total_reads} in the original fastq file.")
-
-            if force_binning or cls.total_reads != total_binned_reads:
+            manifest = None if force_binning else cls.load_manifest(path_model)
+            checkpoint = None if force_binning or manifest is not None else cls.load_checkpoint(path_model)
+            if manifest is not None:
+                cls.file_has_been_binned = True
+                cls.MANIFEST = manifest
+                cls.total_reads = manifest["reads"]
+                for bin_id, stats in manifest["bins"].items():
+                    cls.outputs[int(bin_id)] = stats["path"] if stats["path"] is not None else cls.path_bin(bin_id)
+                    cls.bin_stats[int(bin_id)] = [stats["reads"], stats["bases"]]
+            elif checkpoint is not None:
+                cls.resume = checkpoint
+            else:
                 last_modif = dt.fromtimestamp(osp.getmtime(cls.FASTQ_BIN_FOLDER))
                 save_folder = f"{cls.FASTQ_BIN_FOLDER}_{last_modif:%Y-%m-%d_%H-%M}"
                 cls.logger.warning(f"Folder existing, renaming to avoid losing files: {save_folder}")
                 os.rename(cls.FASTQ_BIN_FOLDER, save_folder)
-            else:
-                # Flag up if read counts are equal, and no forcing to recount
-                cls.file_has_been_binned = True
         create_path(cls.FASTQ_BIN_FOLDER)
 
-        cls.FILEBASE = file_base
         if not path_model == "full":
-            cls.KMER = kmers_dic(K)
-            with open(path_model, 'rb') as f:
-                cls.MODEL = pickle.load(f)
+            cls.PATH_MODEL = path_model
+
+    @classmethod
+    def path_manifest(cls):
+        return osp.join(cls.FASTQ_BIN_FOLDER, f"{cls.FILEBASE}.manifest.json")
+
+    @classmethod
+    def path_checkpoint(cls):
+        return osp.join(cls.FASTQ_BIN_FOLDER, f"{cls.FILEBASE}.checkpoint.json")
+
+    @classmethod
+    def path_assignments(cls):
+        return osp.join(cls.FASTQ_BIN_FOLDER, f"{cls.FILEBASE}.assignments.bin")
+
+    @classmethod
+    def settings(cls):
+        """ Settings changing the content of the bin files """
+        return {"format": bin_classify.format, "tag_bin_id": cls.TAG_BIN_ID, "compress_level": cls.COMPRESS_LEVEL}
 
     @classmethod
-    def bin_reads(cls):
-        """ Bin all reads from provided file """
-        # Skip binning if already done. Count total number of lines in each binned fastq
+    def bins_state(cls):
+        """ reads / bases / file size of each bin (path is None for the bins streamed to the classifier) """
+        bins = {}
+        for bin_id, (reads, bases) in sorted(cls.bin_stats.items()):
+            path = cls.outputs[bin_id]
+            on_disk = osp.isfile(path)
+            bins[str(bin_id)] = {"path": path if on_disk else None, "reads": reads, "bases": bases,
+                                 "size": osp.getsize(path) if on_disk else 0}
+        return bins
+
+    @staticmethod
+    def dump_json(content, path):
+        """ Write to a temporary file, then rename it, to never leave a partial file """
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(content, f, indent=2)
+        os.replace(f"{path}.tmp", path)
+
+    @classmethod
+    def write_manifest(cls, input_checksum, input_size):
+        """ Record what has been binned: signature and checksum of the input, signature of the model, settings,
+            the reads / bases / file size of each bin, and the assignment log """
+        manifest = {
+            "input": {**file_signature(cls.FASTQ_PATH), "crc32": input_checksum, "uncompressed_size": input_size},
+            "model": file_signature(cls.PATH_MODEL),
+            "settings": cls.settings(),
+            "reads": sum(reads for reads, _ in cls.bin_stats.values()),
+            "bases": sum(bases for _, bases in cls.bin_stats.values()),
+            "bins": cls.bins_state(),
+            "assignments": cls.path_assignments(),
+        }
+        cls.dump_json(manifest, cls.path_manifest())
+        cls.MANIFEST = manifest
+        if osp.isfile(cls.path_checkpoint()):
+            os.remove(cls.path_checkpoint())
+        cls.logger.debug(f"Binning manifest written: {cls.path_manifest()}")
+
+    @classmethod
+    def changed_since(cls, recorded, path_model):
+        """ Reason why a previous manifest or checkpoint doesn't apply anymore, None if input, model and settings
+            are the same. Only checks file signatures: constant time """
+        def same_file(signature, file):
+            current = file_signature(file)
+            return signature["size"] == current["size"] and signature["mtime"] == current["mtime"]
+
+        if not same_file(recorded["input"], cls.FASTQ_PATH):
+            return "the input file has changed"
+        elif not same_file(recorded["model"], path_model):
+            return "the model has changed"
+        elif recorded["settings"] != cls.settings():
+            return f"the settings have changed {recorded['settings']}"
+        return None
+
+    @classmethod
+    def load_manifest(cls, path_model):
+        """ Manifest of a previous binning, if it is still valid (input, model and settings unchanged, all bins on
+            disk with their recorded size), otherwise None. Bins that are not on disk anymore can be re-written from
+            the assignment log, they are listed in cls.missing_bins """
+        path = cls.path_manifest()
+        if not osp.isfile(path):
+            cls.logger.debug(f"No binning manifest: {path}")
+            return None
+        with open(path) as f:
+            manifest = json.load(f)
+
+        reason = cls.changed_since(manifest, path_model)
+        if reason is None:
+            missing = [int(bin_id) for bin_id, stats in manifest["bins"].items()
+                       if stats["path"] is None or not osp.isfile(stats["path"])
+                       or osp.getsize(stats["path"]) != stats["size"]]
+            log = cls.path_assignments()
+            if missing and not (osp.isfile(log) and osp.getsize(log) == manifest["reads"] * cls.ASSIGNMENT.itemsize):
+                reason = f"the bins {missing} are not on disk (streamed or modified), without assignment log to " \
+                         f"write them again"
+            cls.missing_bins = missing
+        if reason is not None:
+            cls.logger.info(f"Previous binning can't be reused, {reason}")
+            return None
+        cls.logger.debug(f"Valid binning manifest, {manifest['reads']} reads in {len(manifest['bins'])} bins: {path}")
+        return manifest
+
+    @classmethod
+    def checkpoint(cls, log, reads):
+        """ Commit the binning done so far: close the bin files (gzip members finished), flush the assignment
+            log, then record the offset in the input and the size of each bin """
+        cls.WRITERS.close()
+        log.flush()
+        os.fsync(log.fileno())
+        cls.dump_json({
+            "input": file_signature(cls.FASTQ_PATH),
+            "model": file_signature(cls.PATH_MODEL),
+            "settings": cls.settings(),
+            "offset": cls.input_offset,
+            "reads": reads,
+            "bins": cls.bins_state(),
+        }, cls.path_checkpoint())
+
+    @classmethod
+    def load_checkpoint(cls, path_model):
+        """ Checkpoint of an interrupted binning of the same input, with the same model and settings """
+        path = cls.path_checkpoint()
+        if not osp.isfile(path):
+            return None
+        with open(path) as f:
+            checkpoint = json.load(f)
+        reason = cls.changed_since(checkpoint, path_model)
+        if reason is not None:
+            cls.logger.info(f"Interrupted binning can't be resumed, {reason}")
+            return None
+        return checkpoint
+
+    @classmethod
+    def resume_checkpoint(cls, fastq):
+        """ Bin files and assignment log back to their state at the checkpoint, then skip the reads already binned
+            in the input (checksum computed on the way). Return the lines of the input left to bin """
+        checkpoint = cls.resume
+        cls.logger.info(f"Resuming an interrupted binning after {checkpoint['reads']} reads")
+        recorded = {stats["path"]: stats["size"] for stats in checkpoint["bins"].values()}
+        for entry in os.scandir(cls.FASTQ_BIN_FOLDER):
+            if entry.name.startswith(f"{cls.FILEBASE}.bin-"):
+                if entry.path in recorded:
+                    os.truncate(entry.path, recorded[entry.path])
+                else:
+                    os.remove(entry.path)
+        os.truncate(cls.path_assignments(), checkpoint["reads"] * cls.ASSIGNMENT.itemsize)
+        for bin_id, stats in checkpoint["bins"].items():
+            cls.outputs[int(bin_id)] = cls.path_bin(bin_id)
+            cls.bin_stats[int(bin_id)] = [stats["reads"], stats["bases"]]
+        cls.input_offset = checkpoint["offset"]
+        lines = Crc32Lines(fastq)
+        lines.skip(cls.input_offset)
+        # the reader skips blank lines between the records
+        ahead = fastq.peek(2**10).lstrip(b"\r\n")[:1]
+        assert ahead in (b"", b"@", b">"), \
+            ValueError(f"The checkpoint's offset {cls.input_offset} isn't at the start of a read in {cls.FASTQ_PATH}, "
+                       f"delete the folder {cls.FASTQ_BIN_FOLDER} to bin it again")
+        return lines
+
+    @classmethod
+    def bin_reads(cls, writers=None):
+        """ Bin all reads from provided file. writers: where to send the reads of each bin (BinStreams),
+            by default a BufferedWriterPool writing the bin files.
+            The bin of each read is appended to the assignment log, with the reads written to the bin files
+            regularly committed by a checkpoint, to resume the binning if it is interrupted.
+        """
+        # Skip binning if already done, according to the manifest of a previous binning
         if cls.file_has_been_binned:
+            if cls.missing_bins:
+                cls.materialize_bins(cls.missing_bins)
             cls.logger.info(f"Fastq has already been binned, skipping reads binning: {cls.FASTQ_PATH}")
+            cls.NUMBER_BINNED = cls.total_reads
             return
 
-        cls.logger.info(f"Binning the reads (count kmers, scale, find_bin, copy to file.bin-<cluster>.fastq")
-        # todo: try to parallelize it, careful of file writing concurrency.
-        #  Dask ? process to load and count kmers, single one for appending read to fastq ?
-        # with Pool(cls.CORES) as pool:
-        #     results = list(tqdm(pool.imap(pll_binning, SeqIO.parse(cls.FASTQ_PATH, "fasta"))))
-        # counter = len(results)
+        cls.logger.info(f"Binning the reads (count kmers, scale, find_bin, copy to file.bin-<cluster>.fastq), "
+                        f"with {cls.WORKERS} worker(s)")
         counter = 0
-        for record in tqdm(SeqIO.parse(cls.FASTQ_PATH, bin_classify.format), total=cls.total_reads,
-                           desc="binning and copying reads to bins", leave=True, dynamic_ncols=True):
-            counter += 1
-            custom_read = ReadToBin(record)
-            # custom_read.kmer_count
-            custom_read.scale()
-            custom_read.find_bin()
-            custom_read.to_fastq()
+        cls.input_offset = 0
+        with tqdm(total=cls.total_reads if cls.total_reads else None, desc="binning and copying reads to bins",
+                  leave=True, dynamic_ncols=True) as progress, \
+                open_input(cls.FASTQ_PATH, THREADS) as fastq:
+            if cls.resume is not None:
+                lines = cls.resume_checkpoint(fastq)
+                counter = cls.resume["reads"]
+                progress.update(counter)
+            else:
+                lines = Crc32Lines(fastq)
+
+            with (writers if writers is not None else
+                  BufferedWriterPool(cls.WRITE_BUFFER, cls.MAX_OPEN_FILES, cls.COMPRESS_LEVEL)) as cls.WRITERS, \
+                    open(cls.path_assignments(), "ab" if cls.resume is not None else "wb") as log:
+                # streamed reads can't be recovered, no checkpoint then
+                checkpoints = isinstance(cls.WRITERS, BufferedWriterPool)
+                last_checkpoint = perf_counter()
+                start, ends = lines.size, deque()  # ends: of the records read, in bytes consumed by the reader
+                for records, clusters in cls.predicted_batches(
+                        batches(read_fastx_raw(lines, bin_classify.format, ends), cls.BATCH_SIZE)):
+                    cls.dispatch(records, clusters)
+                    cls.log_assignments(log, clusters, [start + ends.popleft() for _ in records])
+                    counter += len(records)
+                    progress.update(len(records))
+                    if checkpoints and perf_counter() - last_checkpoint > cls.CHECKPOINT_EVERY:
+                        cls.checkpoint(log, counter)
+                        last_checkpoint = perf_counter()
         cls.logger.info(f"{counter} reads binned into bins: [" + ", ".join(map(str, sorted(cls.outputs.keys()))) + "]")
         cls.NUMBER_BINNED = counter
+        cls.total_reads = counter
+        cls.write_manifest(lines.crc32, lines.size)
         return cls.outputs
 
+    @classmethod
+    def bin_record(cls, raw_record, header, cluster):
+        """ Raw record as written in its bin, with the bin_id=<cluster> tag in the header if TAG_BIN_ID """
+        if cls.TAG_BIN_ID:
+            return tag_raw_record(raw_record, header, b"bin_id=%d" % cluster)
+        return raw_record
+
+    @classmethod
+    def dispatch(cls, records, clusters):
+        """ Copy the raw bytes of each record (header, seq, raw_record) to its bin file """
+        for (header, seq, raw_record), cluster in zip(records, clusters):
+            cluster = int(cluster)
+            if cluster not in cls.outputs:
+                cls.outputs[cluster] = cls.path_bin(cluster)
+                cls.bin_stats[cluster] = [0, 0]
+            cls.bin_stats[cluster][0] += 1
+            cls.bin_stats[cluster][1] += len(seq)
+            cls.WRITERS.write(cls.outputs[cluster], cls.bin_record(raw_record, header, cluster))
+
+    @classmethod
+    def log_assignments(cls, log, clusters, offsets):
+        """ Append the bin of each read to the assignment log, with the offset of the end of the read in the
+            (decompressed) input """
+        assignments = np.empty(len(clusters), dtype=cls.ASSIGNMENT)
+        assignments["offset"] = offsets
+        assignments["bin"] = clusters
+        cls.input_offset = int(assignments["offset"][-1])
+        log.write(assignments.tobytes())
+
+    @classmethod
+    def materialize_bins(cls, bin_ids):
+        """ Write these bin files again from the assignment log, without counting k-mers nor predicting bins """
+        assignments = np.fromfile(cls.path_assignments(), dtype=cls.ASSIGNMENT)
+        cls.logger.info(f"Writing the bins {sorted(bin_ids)} from the assignment log of {len(assignments)} reads")
+        for bin_id in bin_ids:
+            cls.outputs[bin_id] = cls.path_bin(bin_id)
+            if osp.isfile(cls.outputs[bin_id]):
+                os.remove(cls.outputs[bin_id])
+        wanted = set(bin_ids)
+        reads = 0
+        with open_input(cls.FASTQ_PATH, THREADS) as fastq, \
+                BufferedWriterPool(cls.WRITE_BUFFER, cls.MAX_OPEN_FILES, cls.COMPRESS_LEVEL) as writers:
+            for (header, _, raw_record), cluster in zip(read_fastx_raw(fastq, bin_classify.format),
+                                                        assignments["bin"].tolist()):
+                reads += 1
+                if cluster in wanted:
+                    writers.write(cls.outputs[cluster], cls.bin_record(raw_record, header, cluster))
+        assert reads == len(assignments), \
+            ValueError(f"{reads} reads in {cls.FASTQ_PATH}, but {len(assignments)} in the assignment log")
+        cls.write_manifest(cls.MANIFEST["input"]["crc32"], cls.MANIFEST["input"]["uncompressed_size"])
+        cls.missing_bins = []
+
+    @classmethod
+    def predicted_batches(cls, records_batches):
+        """ Yield each batch of records with their bins, in the same order as the input.
+            With several workers, the main process reads the batches and writes the binned reads, while a pool of
+            processes (model loaded once per worker) count the k-mers and predict the bins. The number of batches in
+            flight is bounded to keep the memory in check.
+        """
+        if cls.WORKERS <= 1:
+            for records in records_batches:
+                yield records, cls.predict_batch([seq for _, seq, _ in records])
+            return
+
+        with Pool(cls.WORKERS, initializer=pll_init_binning, initargs=(cls.PATH_MODEL, K, CANONICAL)) as pool:
+            pending = deque()
+            for records in records_batches:
+                pending.append((records, pool.apply_async(pll_binning, ([seq for _, seq, _ in records],))))
+                if len(pending) >= 2 * cls.WORKERS:
+                    records_done, result = pending.popleft()
+                    yield records_done, result.get()
+            while pending:
+                records_done, result = pending.popleft()
+                yield records_done, result.get()
+
     @classmethod
     def sort_bins_by_sizes_and_drop_smalls(cls):
-        """ Sort the fastq bins by their size. drop_bins is the *percentage* below which a bin is ignored """
-        bin_size = {}
-        for f in os.scandir(cls.FASTQ_BIN_FOLDER):
-            bin_nb = int(f.name.split('.')[1].split('-')[1])
-            size = osp.getsize(f)
-            bin_size[size] = bin_nb
-        full_fastq_size = osp.getsize(cls.FASTQ_PATH)
-        minimum_size = full_fastq_size * DROP_BIN_THRESHOLD / 100
+        """ Sort the bins by their number of reads. drop_bins is the *percentage* of reads below which a bin is
+            ignored. Bins streamed to their classifier (not on disk) are removed from the outputs, whatever their
+            number of reads (they were classified while binning) """
+        total_reads = sum(reads for reads, _ in cls.bin_stats.values())
+        minimum_reads = total_reads * DROP_BIN_THRESHOLD / 100
 
         # make a copy first, then empty the dic, and rewrite it in the correct order
         fastq_outputs = ReadToBin.outputs.copy()
         ReadToBin.outputs = {}
         dropped_bins = []
-        dropped_size = 0
-        for size, bin_nb in sorted(bin_size.items(), reverse=True):
-            if size > minimum_size:
+        dropped_reads = 0
+        for bin_nb, (reads, bases) in sorted(cls.bin_stats.items(), key=lambda item: item[1][0], reverse=True):
+            if not osp.isfile(fastq_outputs[bin_nb]):
+                continue
+            if reads > minimum_reads:
                 ReadToBin.outputs[bin_nb] = fastq_outputs[bin_nb]
             else:
                 dropped_bins.append(bin_nb)
-                dropped_size += size
-                cls.logger.debug(f"Reads in bin {bin_nb} has a size of {f_size(size)}, and will be dropped "
-                                 f"(less than {DROP_BIN_THRESHOLD}% of all binned reads {f_size(full_fastq_size)})")
-        cls.logger.warning(f"Dropped bins {dropped_bins}, with total file size of {f_size(dropped_size)}. "
+                dropped_reads += reads
+                cls.logger.debug(f"Bin {bin_nb} has {reads} reads ({bases} bp), and will be dropped "
+                                 f"(less than {DROP_BIN_THRESHOLD}% of all {total_reads} binned reads)")
+        cls.logger.warning(f"Dropped bins {dropped_bins}, with a total of {dropped_reads} reads. "
                         f"Lower parameter drop_bin_threshold to load all bins despite low number of reads in a bin.")
         return ReadToBin.outputs
 
 
-def pll_binning(record):
-    """ Parallel processing of read binning """
-    custom_read = ReadToBin(record)
-    # custom_read.kmer_count
-    custom_read.scale()
-    custom_read.find_bin()
-    custom_read.to_fastq()
+def find_model(path_database):
+    """ Model in the folder of the database, the .npz centroids, or the pickled sklearn model of older databases """
+    models = sorted(file.path for file in os.scandir(path_database)
+                    if file.name.startswith("model.") and file.name.endswith((".npz", ".pkl")))
+    npz = [path for path in models if path.endswith(".npz")]
+    return npz[0] if npz else (models[0] if models else "")
+
+
+def load_model(path_model):
+    """ CentroidModel from a .npz file (milliseconds), or unpickle a sklearn model """
+    if path_model.endswith(".npz"):
+        return CentroidModel.load(path_model)
+    with open(path_model, 'rb') as f:
+        return pickle.load(f)
+
+
+def pll_init_binning(path_model, k, canonical):
+    """ Load the model once per worker of the binning pool """
+    global K, CANONICAL
+    K = k
+    CANONICAL = canonical
+    ReadToBin.MODEL = load_model(path_model)
+
+
+def pll_binning(sequences):
+    """ Parallel processing of read binning, return the bins of a batch of sequences """
+    return ReadToBin.predict_batch(sequences)
+
+
+class KrakenReport:
+    """ kraken2 style report (kraken2 --report, centrifuge-kreport) merged from the reports of several bins.
+        One row per taxon, the tree is the one given by the indentation of the names, with one column per bin for
+        the reads assigned directly to the taxon and the reads of its clade.
+    """
+    def __init__(self, taxids, ranks, names, depths, parents, direct, bins):
+        self.taxids  = taxids    # np.array, taxid 0 is "unclassified"
+        self.ranks   = ranks     # rank codes (U, R, D, P, C, O, F, G, S, G1...)
+        self.names   = names
+        self.depths  = depths    # np.array, 0 for root and unclassified
+        self.parents = parents   # np.array of row numbers, -1 for root and unclassified
+        self.direct  = direct    # np.array (taxa, bins) of reads
+        self.bins    = bins
+        self.clade   = self.clade_reads()
+
+    @staticmethod
+    def read(path):
+        """ Rows of a report: (depth, rank code, taxid, name, reads assigned directly), works with the 2 extra
+            minimizer columns of kraken2 --report-minimizer-data
+        """
+        rows = []
+        with open(path) as f:
+            for line in f:
+                fields = line.rstrip("\n").split("\t")
+                if len(fields) < 6:
+                    continue
+                name = fields[-1].lstrip(" ")
+                rows.append(((len(fields[-1]) - len(name)) // 2, fields[-3].strip(), int(fields[-2]), name,
+                             int(fields[2])))
+        return rows
+
+    @classmethod
+    def merge(cls, reports):
+        """ Sum the reads assigned directly to each taxon in the reports {bin_id: path} """
+        index = {}   # {taxid: row}
+        taxa = []    # [(taxid, rank, name, depth, parent row)]
+        cells = []   # [(row, column, reads)]
+        for column, path in enumerate(reports.values()):
+            lineage = []  # rows of the current taxon's ancestors, by depth
+            for depth, rank, taxid, name, reads in cls.read(path):
+                del lineage[depth:]
+                if taxid not in index:
+                    index[taxid] = len(taxa)
+                    taxa.append((taxid, rank, name, depth, lineage[-1] if lineage else -1))
+                lineage.append(index[taxid])
+                cells.append((index[taxid], column, reads))
+
+        direct = np.zeros((len(taxa), len(reports)), dtype=np.int64)
+        if cells:
+            rows, columns, reads = (np.array(values) for values in zip(*cells))
+            np.add.at(direct, (rows, columns), reads)
+        taxids, ranks, names, depths, parents = zip(*taxa) if taxa else ((), (), (), (), ())
+        return cls(np.array(taxids, dtype=np.int64), list(ranks), list(names), np.array(depths, dtype=np.int64),
+                   np.array(parents, dtype=np.int64), direct, list(reports.keys()))
+
+    def clade_reads(self):
+        """ One pass from the deepest taxa up to the root, each level adding its clade reads to its parents """
+        clade = self.direct.copy()
+        for depth in range(int(self.depths.max(initial=0)), 0, -1):
+            rows = np.flatnonzero(self.depths == depth)
+            np.add.at(clade, self.parents[rows], clade[rows])
+        return clade
+
+    @property
+    def total(self):
+        """ Number of reads, classified or not """
+        return int(self.clade[self.depths == 0].sum())
+
+    def percentages(self):
+        return 100. * self.clade.sum(axis=1) / max(1, self.total)
+
+    def depth_first(self):
+        """ Rows in the order of kraken2: unclassified first, then depth first with the largest clades first """
+        children = {}
+        clade = self.clade.sum(axis=1)
+        for row in sorted(range(len(self.taxids)), key=lambda r: (-clade[r], self.taxids[r])):
+            children.setdefault(self.parents[row], []).append(row)
+        top = sorted(children.get(-1, []), key=lambda r: self.taxids[r] != 0)
+        order, stack = [], top[::-1]
+        while stack:
+            row = stack.pop()
+            order.append(row)
+            stack.extend(children.get(row, [])[::-1])
+        return order
+
+    def write(self, path, per_bin=False):
+        """ Report in kraken2's format. per_bin adds a last column with the clade reads of each bin (bin:reads) """
+        percentages = self.percentages()
+        clade, direct = self.clade.sum(axis=1), self.direct.sum(axis=1)
+        with open(path, "w") as f:
+            for row in self.depth_first():
+                line = f"{percentages[row]:6.2f}\t{clade[row]}\t{direct[row]}\t{self.ranks[row]}\t" \
+                       f"{self.taxids[row]}\t{'  ' * self.depths[row]}{self.names[row]}"
+                if per_bin:
+                    line += "\t" + ",".join(f"{b}:{reads}" for b, reads in zip(self.bins, self.clade[row]) if reads)
+                f.write(line + "\n")
+
+    def to_csv(self, path, rank="S"):
+        """ One row per taxon of this rank, with its clade reads, percentage and clade reads in each bin """
+        percentages = self.percentages()
+        clade = self.clade.sum(axis=1)
+        rows = sorted((row for row, code in enumerate(self.ranks) if code == rank), key=lambda r: -clade[r])
+        with open(path, 'w', newline='') as csv_file:
+            csv_writer = csv.writer(csv_file)
+            csv_writer.writerow(["taxid", "name", "reads", "percentage"] + [f"bin_{b}" for b in self.bins])
+            for row in rows:
+                csv_writer.writerow([self.taxids[row], self.names[row], clade[row], f"{percentages[row]:.4f}",
+                                     *self.clade[row].tolist()])
 
 
 # #############################################################################
@@ -231,7 +643,8 @@ class MockCommunity:
     """ For a fastq file, bin reads, classify them, and compare results """
     
     def __init__(self, path_original_fastq, db_path, full_DB, folder_report, path_binned_fastq={},
-                 classifier_name="kraken2", param="", clf_settings="default", dry_run=False, verbose=False):
+                 classifier_name="kraken2", param="", clf_settings="default", dry_run=False, verbose=False,
+                 max_memory=None, per_bin_report=False):
         self.logger = logging.getLogger('classify.MockCommunity')
 
         assert osp.isfile(path_original_fastq), FileNotFoundError(f"Didn't find original fastq {path_original_fastq}")
@@ -239,7 +652,7 @@ class MockCommunity:
 
         self.path_original_fastq    = path_original_fastq
 
-        self.folder, self.file_name = osp.split(osp.splitext(self.path_original_fastq)[0])
+        self.folder, self.file_name = osp.split(fastx_base(self.path_original_fastq))
         self.path_binned_fastq      = path_binned_fastq              # {<bin i>: <path_file>}
         self.folder_report          = folder_report
         
@@ -247,12 +660,15 @@ class MockCommunity:
         self.db_path         = db_path    # location of the hash table for the classifier
         self.db_type         = "full" if full_DB else "bins"    # Either full or bins
         self.hash_size      = {}
+        self.max_memory      = max_memory if max_memory is not None else int(0.8 * total_memory())
         self.folder_out      = osp.join(self.folder_report, self.file_name)
         self.path_out        = osp.join(self.folder_out, f"{param}.{classifier_name}.{clf_settings}.{self.db_type}")
 
         self.dry_run         = dry_run
         self.verbose         = verbose
         self.cmd             = None
+        self.per_bin_report  = per_bin_report
+        self.report          = None
 
         # Initialization functions
         os.makedirs(self.folder_out, exist_ok=True)
@@ -265,7 +681,7 @@ class MockCommunity:
         elif self.classifier_name == "centrifuge":
             return self.centrifuge
         else:
-            NotImplementedError("This classifier hasn't been implemented")
+            raise NotImplementedError("This classifier hasn't been implemented")
 
     def archive_previous_reports(self):
         """ move existing reports to _archive """
@@ -278,26 +694,80 @@ class MockCommunity:
     def classify(self):
         self.logger.info(f"Classifying reads with {self.db_type} setting")
         if "bins" in self.db_type:
-            for bin_id in self.path_binned_fastq.keys():
-                folder_hash = osp.join(self.db_path, f"{bin_id}")
-                self.logger.debug(f"Path of fastq bin : {self.path_binned_fastq[bin_id]}")
-                self.logger.debug(f"Path of folder of hash bin : {folder_hash}")
-                self.classifier(self.path_binned_fastq[bin_id], folder_hash, arg=f"bin-{bin_id}")
-            # todo: combine reports to Kraken2 format
+            self.classify_bins()
+            if not self.dry_run:
+                self.kraken2_report_merging()
+                self.report_to_csv()
         elif "full" in self.db_type:
             self.classifier(self.path_original_fastq, self.db_path, arg="full")
         else:
             NotImplementedError("The database choice is either full or bins")
                 
-    def centrifuge(self, fastq_input, folder_hash, arg="unknown"):
-        """ Centrifuge calls
+    def classify_bins(self):
+        """ Run the classification of several bins at the same time, while their hash tables fit in max_memory.
+            Largest bins (by reads volume) are started first, each new batch of jobs shares the free threads in
+            proportion to the reads volume of each bin. A bin whose hash table is bigger than max_memory runs alone.
+        """
+        jobs = []  # (reads volume, hash size, bin_id)
+        for bin_id, path in self.path_binned_fastq.items():
+            folder_hash = osp.join(self.db_path, f"{bin_id}")
+            self.logger.debug(f"Path of fastq bin : {path}")
+            self.logger.debug(f"Path of folder of hash bin : {folder_hash}")
+            jobs.append((osp.getsize(path), self.measure_hash(folder_hash, f"bin-{bin_id}"), bin_id))
+        jobs.sort(reverse=True)
+        self.logger.info(f"Scheduling the classification of {len(jobs)} bins, within {f_size(self.max_memory)} of "
+                         f"memory and {THREADS} threads")
+
+        running = {}  # {future: (hash size, threads, bin_id)}
+        errors = []
+        with ThreadPoolExecutor(max_workers=max(1, THREADS)) as executor:
+            while jobs or running:
+                memory_free = self.max_memory - sum(job[0] for job in running.values())
+                threads_free = THREADS - sum(job[1] for job in running.values())
+                starting = []
+                for job in list(jobs):
+                    if len(starting) >= threads_free:
+                        break
+                    if job[1] <= memory_free or (not running and not starting):
+                        if job[1] > self.max_memory:
+                            self.logger.warning(f"hash table of bin {job[2]} ({f_size(job[1])}) is bigger than the "
+                                                f"memory budget, running it alone")
+                        starting.append(job)
+                        jobs.remove(job)
+                        memory_free -= job[1]
+                        if memory_free < 0:
+                            break
+                for (size, hash_size, bin_id), threads in zip(
+                        starting, split_proportionally(threads_free, [job[0] for job in starting])):
+                    future = executor.submit(self.classify_bin, bin_id, threads)
+                    running[future] = (hash_size, threads, bin_id)
+                    self.logger.debug(f"bin {bin_id} classification started with {threads} threads, "
+                                      f"{len(running)} running, {len(jobs)} waiting")
+
+                done, _ = wait(running.keys(), return_when=FIRST_COMPLETED)
+                for future in done:
+                    _, _, bin_id = running.pop(future)
+                    try:
+                        future.result()
+                    except ChildProcessError as e:
+                        self.logger.error(e)
+                        errors.append(bin_id)
+        if errors:
+            raise ChildProcessError(f"Classification failed for the bins {errors}")
+
+    def classify_bin(self, bin_id, threads):
+        fastq_input = self.path_binned_fastq[bin_id]
+        cmds = self.classifier(fastq_input, osp.join(self.db_path, f"{bin_id}"), arg=f"bin-{bin_id}",
+                               threads=threads, run=False)
+        self.run_commands(cmds, fastq_input, self.classifier_name)
+
+    def centrifuge(self, fastq_input, folder_hash, arg="unknown", threads=None, run=True):
+        """ Centrifuge calls, return the commands (classification, then kraken2 style report)
             https://ccb.jhu.edu/software/centrifuge/manual.shtml#command-line
         """
-        hashes_file = [osp.join(folder_hash, f"cf_index.{i}.cf") for i in range(1, 4)]
         hash_root = osp.join(folder_hash, "cf_index")
-        assert osp.isfile(hashes_file[0]), FileNotFoundError(f"Hash table not found ! {hash_root}*")
-        self.hash_size[arg] = sum(osp.getsize(f) for f in hashes_file)
-        self.logger.info(f'start to classify reads from file ({f_size(fastq_input)}) {fastq_input}')
+        self.measure_hash(folder_hash, arg)
+        self.log_input(fastq_input)
         self.logger.info(f'with centrifuge, {arg}. hash table is ({f_size(self.hash_size[arg])}) {hash_root}*')
         out_path = f"{self.path_out}.{arg}" if self.db_type == "bins" else f"{self.path_out}"
         out_file = f"{out_path}.out"
@@ -305,62 +775,259 @@ class MockCommunity:
         self.cmd = [
             "centrifuge", "-x", hash_root, "-U", fastq_input,
             "-S", out_file, "--report-file", f"{out_path}.centrifuge-report.tsv",
-            "--time", "--threads", f"{THREADS}",
+            "--time", "--threads", f"{THREADS if threads is None else threads}",
         ]
-        if self.dry_run:
-            self.logger.debug(" ".join(self.cmd))
-        else:
-            bash_process(self.cmd, f"launching centrifuge classification on {fastq_input}")
-            # Then do the kraken2 report
-            cmd2 = ["centrifuge-kreport", "-x", hash_root, out_file, ">", f"{out_path}.report"]
-            bash_process(" ".join(cmd2), f"launching centrifuge kreport on {fastq_input}")
+        # Then do the kraken2 report
+        cmd2 = " ".join(["centrifuge-kreport", "-x", hash_root, out_file, ">", f"{out_path}.report"])
+        if run:
+            self.run_commands([self.cmd, cmd2], fastq_input, "centrifuge")
+        return [self.cmd, cmd2]
 
-    def kraken2(self, fastq_input, folder_hash, arg="unknown"):
+    def kraken2(self, fastq_input, folder_hash, arg="unknown", threads=None, run=True):
         if "hash.k2d" in folder_hash: folder_hash = osp.dirname(folder_hash)
         hash_file = osp.join(folder_hash, "hash.k2d")
-        assert osp.isfile(hash_file), FileNotFoundError(f"Hash table not found ! {hash_file}")
-        self.hash_size[arg] = osp.getsize(hash_file)
-        self.logger.info(f'start to classify reads from file ({f_size(fastq_input)}) {fastq_input}')
+        self.measure_hash(folder_hash, arg)
+        self.log_input(fastq_input)
         self.logger.info(f'with kraken2, {arg}. hash table is ({f_size(hash_file)}) {hash_file}')
         formatted_out = f"{self.path_out}.{arg}" if self.db_type == "bins" else f"{self.path_out}"
         self.logger.info(f'output is {formatted_out}.out')
         self.cmd = [
-            "kraken2", "--threads", f"{THREADS}",
+            "kraken2", "--threads", f"{THREADS if threads is None else threads}",
             "--db", folder_hash,
+            *(["--gzip-compressed"] if fastq_input.endswith(".gz") else []),
             fastq_input,
             "--output", f"{formatted_out}.out",
             "--report", f"{formatted_out}.report",
         ]
-        if self.dry_run:
-            self.logger.debug(" ".join(self.cmd))
+        if run:
+            self.run_commands([self.cmd], fastq_input, "kraken2")
+        return [self.cmd]
+
+    def index_files(self, folder_hash):
+        """ Files of the classifier's index (hash table) in this folder """
+        if self.classifier_name == "kraken2":
+            if "hash.k2d" in folder_hash: folder_hash = osp.dirname(folder_hash)
+            return [osp.join(folder_hash, "hash.k2d")]
+        elif self.classifier_name == "centrifuge":
+            return [osp.join(folder_hash, f"cf_index.{i}.cf") for i in range(1, 4)]
         else:
-            bash_process(self.cmd, f"launching kraken2 classification on {fastq_input}")
-            
-    def kraken2_report_merging(self):
-        self.logger.info('Merging kraken2 reports')
-        # todo: merging reports to species level
-        raise NotImplementedError()
+            raise NotImplementedError("This classifier hasn't been implemented")
+
+    def measure_hash(self, folder_hash, arg):
+        """ Size of the hash table, which is what the classifier loads in memory """
+        files = self.index_files(folder_hash)
+        assert osp.isfile(files[0]), FileNotFoundError(f"Hash table not found ! {files[0]}")
+        self.hash_size[arg] = sum(osp.getsize(f) for f in files if osp.isfile(f))
+        return self.hash_size[arg]
+
+    def log_input(self, fastq_input):
+        if osp.isfile(fastq_input):
+            self.logger.info(f'start to classify reads from file ({f_size(fastq_input)}) {fastq_input}')
+        else:
+            self.logger.info(f'start to classify reads from {fastq_input}')
+
+    def run_commands(self, cmds, fastq_input, name):
+        """ Run the classification command, then its post-processing ones """
+        if self.dry_run:
+            for cmd in cmds:
+                self.logger.debug(cmd if isinstance(cmd, str) else " ".join(cmd))
+            return
+        bash_process(cmds[0], f"launching {name} classification on {fastq_input}")
+        for cmd in cmds[1:]:
+            bash_process(cmd, f"launching {name} post-processing on {fastq_input}")
+
+    def bin_reports(self):
+        """ {bin_id: path} of the kraken2 style reports of the bins (streamed ones included) """
+        reports = {}
+        for path in glob(f"{glob_escape(self.path_out)}.bin-*.report"):
+            bin_id = path[len(self.path_out) + len(".bin-"):-len(".report")]
+            if bin_id.isdigit():
+                reports[int(bin_id)] = path
+        return dict(sorted(reports.items()))
 
-    def report_to_csv(self):
-        raise NotImplementedError()
-        # todo: create .csv per species
+    def kraken2_report_merging(self):
+        """ One kraken2 report for the whole fastq file, from the reports of each bin """
+        reports = self.bin_reports()
+        self.logger.info(f'Merging {len(reports)} kraken2 reports into {self.path_out}.report')
+        time_start = perf_counter()
+        self.report = KrakenReport.merge(reports)
+        self.report.write(f"{self.path_out}.report", per_bin=self.per_bin_report)
+        self.logger.info(f"Merged report: {self.report.total} reads, {len(self.report.taxids)} taxa, "
+                         f"in {time_to_hms(time_start, perf_counter(), short=True)}")
+        return self.report
+
+    def report_to_csv(self, rank="S"):
+        """ Reads per species (or other rank code) of the merged report, with the reads coming from each bin """
+        if self.report is None:
+            self.kraken2_report_merging()
+        path_csv = f"{self.path_out}.{rank}.csv"
+        self.report.to_csv(path_csv, rank)
+        self.logger.info(f"Reads per taxa of rank {rank} saved to {path_csv}")
 
     def __repr__(self):
         return f"Fastq file located at <{self.path_original_fastq}>, ready to be classified with " \
                f"{self.classifier_name} with the DB <{self.db_type}> located at {self.db_path}"
         
 
+class BinStream:
+    """ Feed the reads of one bin to its classifier through a pipe (stdin), while the reads are being binned.
+        The records are gathered into chunks, queued in a bounded buffer, and written to the pipe by a thread.
+        When the buffer is full, write() blocks until the classifier catches up (back-pressure).
+    """
+    def __init__(self, cmds, name, chunk_size=4 * 2**20, queue_chunks=4):
+        """ cmds: classification command (reading the reads from stdin), then its post-processing ones """
+        self.logger = logging.getLogger('classify.BinStream')
+        self.cmds         = cmds
+        self.name         = name
+        self.chunk_size   = chunk_size
+        self.chunk        = bytearray()
+        self.queue        = queue.Queue(maxsize=queue_chunks)
+        self.error        = None
+        self.bytes_fed    = 0
+        self.proc         = launch_process(cmds[0], f"streaming {name} to", stdin=subprocess.PIPE)
+        self.feeder       = threading.Thread(target=self.feed, daemon=True)
+        self.feeder.start()
+
+    @property
+    def buffer_size(self):
+        """ Maximum memory held by this stream's buffer """
+        return self.chunk_size * (self.queue.maxsize + 2)
+
+    def feed(self):
+        """ Thread writing the queued chunks into the classifier. On error, keep draining the queue to not block
+            the binning, the error is raised by close() """
+        while True:
+            chunk = self.queue.get()
+            if chunk is None:
+                break
+            if self.error is not None:
+                continue
+            try:
+                self.proc.stdin.write(chunk)
+            except (BrokenPipeError, OSError) as e:
+                self.error = e
+        try:
+            self.proc.stdin.close()
+        except (BrokenPipeError, OSError) as e:
+            self.error = self.error or e
+
+    def write(self, data):
+        self.chunk += data
+        self.bytes_fed += len(data)
+        if len(self.chunk) >= self.chunk_size:
+            self.queue.put(bytes(self.chunk))
+            self.chunk = bytearray()
+
+    def close(self):
+        """ Send the last reads, wait for the classifier to finish, then run the post-processing commands """
+        if self.chunk:
+            self.queue.put(bytes(self.chunk))
+            self.chunk = bytearray()
+        self.queue.put(None)
+        self.feeder.join()
+        wait_process(self.proc)
+        if self.error is not None:
+            raise ChildProcessError(f"could not stream the reads of {self.name} to: {self.proc.cmd}") from self.error
+        for cmd in self.cmds[1:]:
+            bash_process(cmd, f"post-processing {self.name} with")
+        self.logger.debug(f"{f_size(self.bytes_fed)} of reads streamed for {self.name}")
+
+    def kill(self):
+        self.proc.kill()
+        self.queue.put(None)
+        self.feeder.join()
+        self.proc.wait()
+
+
+class BinStreams:
+    """ Drop-in replacement of the BufferedWriterPool used by ReadToBin.bin_reads(), sending the reads of some bins
+        straight to their classifier (BinStream), instead of writing them to a bin file then reading them again.
+        As all the streamed classifiers run at the same time, bins are streamed (smallest hash table first) while
+        their hash tables and buffers fit in <max_memory>. The other bins are spilled to disk, as usual.
+    """
+    def __init__(self, community, bins, max_memory, disk_writers, chunk_size=4 * 2**20, queue_chunks=4):
+        """ bins: {bin_id: path of the bin file}. disk_writers: BufferedWriterPool for the spilled bins """
+        self.logger = logging.getLogger('classify.BinStreams')
+        self.disk    = disk_writers
+        self.streams = {}  # {path: BinStream}
+
+        sizes = {}
+        for bin_id in bins.keys():
+            try:
+                sizes[bin_id] = community.measure_hash(osp.join(community.db_path, f"{bin_id}"), f"bin-{bin_id}")
+            except AssertionError as e:
+                self.logger.warning(f"bin {bin_id} will be written to disk: {e}")
+        stream_buffer = chunk_size * (queue_chunks + 2)
+        streamed, used = [], 0
+        for bin_id, size in sorted(sizes.items(), key=lambda item: item[1]):
+            if used + size + stream_buffer > max_memory:
+                break
+            streamed.append(bin_id)
+            used += size + stream_buffer
+        self.logger.info(f"Streaming {len(streamed)}/{len(bins)} bins to their classifier "
+                         f"({f_size(used)} for a memory budget of {f_size(max_memory)}), the others are written "
+                         f"to disk: {sorted(streamed)}")
+        threads = max(1, THREADS // max(1, len(streamed)))
+        for bin_id in streamed:
+            cmds = community.classifier("/dev/stdin", osp.join(community.db_path, f"{bin_id}"),
+                                        arg=f"bin-{bin_id}", threads=threads, run=False)
+            self.streams[bins[bin_id]] = BinStream(cmds, f"bin-{bin_id}", chunk_size, queue_chunks)
+
+    def write(self, path, data):
+        if path in self.streams:
+            self.streams[path].write(data)
+        else:
+            self.disk.write(path, data)
+
+    def close(self):
+        """ Close the bin files, and wait for all streamed classifications """
+        self.disk.close()
+        errors = []
+        for path, stream in self.streams.items():
+            try:
+                stream.close()
+            except ChildProcessError as e:
+                self.logger.error(e)
+                errors.append(stream.name)
+        if errors:
+            raise ChildProcessError(f"Classification failed for the streamed bins {errors}")
+
+    def kill(self):
+        self.disk.close()
+        for stream in self.streams.values():
+            stream.kill()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.kill()
+
+
 # #############################################################################
 # Defaults and main method
 
 def bin_classify(list_fastq, path_report, path_database, classifier, full_DB=False, threads=cpu_count(),
                  f_record="~/logs/classify_records.csv", clf_settings="", drop_bin_threshold=DROP_BIN_THRESHOLD,
-                 skip_clas=False, force_binning=False):
+                 skip_clas=False, force_binning=False, batch_size=ReadToBin.BATCH_SIZE,
+                 write_buffer=ReadToBin.WRITE_BUFFER, max_open_files=ReadToBin.MAX_OPEN_FILES, binning_workers=1,
+                 tag_bin_id=True, compress_bins=0, stream=False, max_memory=None, per_bin_report=False):
     """ Should load a file, do all the processing """
     logger.info("\n*********************************************************************************************************")
     logger.info("**** Starting script **** \n ")
     global THREADS
     THREADS = threads
+    ReadToBin.BATCH_SIZE = batch_size
+    ReadToBin.WRITE_BUFFER = write_buffer
+    ReadToBin.MAX_OPEN_FILES = max_open_files
+    ReadToBin.WORKERS = binning_workers
+    ReadToBin.TAG_BIN_ID = tag_bin_id
+    ReadToBin.COMPRESS_LEVEL = compress_bins
+    if max_memory is None:
+        max_memory = int(0.8 * total_memory())
 
     # preparing csv record file
     if not osp.isfile(f_record):
@@ -372,7 +1039,7 @@ def bin_classify(list_fastq, path_report, path_database, classifier, full_DB=Fal
     logger.info("let's classify reads!")
 
     # Find the model
-    global K, BIN_NB, DROP_BIN_THRESHOLD
+    global K, CANONICAL, BIN_NB, DROP_BIN_THRESHOLD
     if full_DB:
         path_model = "full"
         K          = 0
@@ -384,22 +1051,27 @@ def bin_classify(list_fastq, path_report, path_database, classifier, full_DB=Fal
         if "hash.k2d" not in os.listdir(path_to_hash):
             FileNotFoundError(f"hash.k2d not found in folder: {path_to_hash}")
     else:
-        path_model = ""
-        for file in os.scandir(path_database):
-            if file.name.startswith("model.") and file.name.endswith(".pkl"):
-                path_model = file.path
-                break
+        path_model = find_model(path_database)
         assert osp.isfile(path_model), FileNotFoundError(f"didn't find the ML model in {path_database}... {path_model}")
+        ReadToBin.MODEL = load_model(path_model)
 
-        # Parse the model name to find parameters:
-        basename = path_model.split("/model.")[1]
-        clusterer, bin_nb, k, w, omitted, _ = re.split('_b|_k|_s|_o|.pkl', basename)
+        if isinstance(ReadToBin.MODEL, CentroidModel):
+            clusterer, bin_nb, k, w = (ReadToBin.MODEL.clusterer, ReadToBin.MODEL.n_clusters, ReadToBin.MODEL.k,
+                                       ReadToBin.MODEL.w)
+            omitted, CANONICAL = "-".join(ReadToBin.MODEL.omitted), ReadToBin.MODEL.canonical
+        else:
+            # Pickled sklearn model of older databases, parse the model name to find parameters:
+            basename = path_model.split("/model.")[1]
+            clusterer, bin_nb, k, w, omitted, _ = re.split('_b|_k|_s|_o|.pkl', basename)
+            CANONICAL = getattr(ReadToBin.MODEL, "canonical", w.endswith("_canonical"))
+            w      = w.replace("_canonical", "")
         K      = int(k)
         BIN_NB = int(bin_nb)
         DROP_BIN_THRESHOLD = drop_bin_threshold if drop_bin_threshold != -1 else 1. / BIN_NB
         path_to_hash = osp.join(path_database, classifier, clf_settings)
         logger.debug(f"path_to_hash: {path_to_hash}")
-        logger.debug(f"Found parameters: clusterer={clusterer}, bin number={BIN_NB}, k={K}, w={w}, omitted={omitted}")
+        logger.debug(f"Found parameters: clusterer={clusterer}, bin number={BIN_NB}, k={K}, w={w}, omitted={omitted}, "
+                     f"canonical={CANONICAL}")
 
     # Set the folder with hash tables
     param = osp.basename(path_database)
@@ -410,12 +1082,7 @@ def bin_classify(list_fastq, path_report, path_database, classifier, full_DB=Fal
     for i, file in enumerate(list_fastq):
         try:
             assert osp.isfile(file), FileNotFoundError(f"file number {i} not found: {file}")
-            if file.lower().endswith(".fastq"):
-                bin_classify.format = "fastq"
-            elif file.lower().endswith(".fasta"):
-                bin_classify.format = "fasta"
-            else:
-                raise NotImplementedError("The file is neither ending with .fasta nor with .fastq")
+            bin_classify.format = fastx_format(file)
             # setting time
             base_name = osp.basename(file)
             key = base_name
@@ -423,23 +1090,40 @@ def bin_classify(list_fastq, path_report, path_database, classifier, full_DB=Fal
             t[key]["start"] = perf_counter()
 
             logger.info(f"Opening fastq file ({i+1}/{len(list_fastq)}) {f_size(file)}, {base_name}")
+            fastq_classifier = None
             # Binning
             if not full_DB:
                 ReadToBin.set_fastq_model_and_param(file, path_model, param, force_binning)
-                ReadToBin.bin_reads()
+                streams = None
+                if stream and not skip_clas and not ReadToBin.file_has_been_binned and ReadToBin.resume is not None:
+                    logger.info("Binning resumed from a checkpoint, all bins are written to disk (not streamed)")
+                elif stream and not skip_clas and not ReadToBin.file_has_been_binned:
+                    # Classify the reads of some bins while binning, the bins that don't fit in memory go to disk
+                    fastq_classifier = MockCommunity(
+                        path_original_fastq=file, db_path=path_to_hash, full_DB=full_DB, folder_report=path_report,
+                        classifier_name=classifier, param=param, max_memory=max_memory,
+                        per_bin_report=per_bin_report)
+                    streams = BinStreams(fastq_classifier, {b: ReadToBin.path_bin(b) for b in range(BIN_NB)},
+                                         max_memory, BufferedWriterPool(write_buffer, max_open_files, compress_bins),
+                                         chunk_size=write_buffer)
+                ReadToBin.bin_reads(streams)
                 ReadToBin.sort_bins_by_sizes_and_drop_smalls()
                 t[key]["binning"] = perf_counter()
                 t[key]["reads_nb"] = ReadToBin.NUMBER_BINNED
 
             if not skip_clas:
-                fastq_classifier = MockCommunity(
-                    path_original_fastq=file, db_path=path_to_hash, full_DB=full_DB, folder_report=path_report,
-                    path_binned_fastq=ReadToBin.outputs, classifier_name=classifier, param=param)
+                if fastq_classifier is None:
+                    fastq_classifier = MockCommunity(
+                        path_original_fastq=file, db_path=path_to_hash, full_DB=full_DB, folder_report=path_report,
+                        path_binned_fastq=ReadToBin.outputs, classifier_name=classifier, param=param,
+                        max_memory=max_memory, per_bin_report=per_bin_report)
+                else:
+                    # only the bins spilled to disk are left to classify
+                    fastq_classifier.path_binned_fastq = ReadToBin.outputs
 
                 fastq_classifier.classify()
                 t[key]["classify"] = perf_counter()
                 t[key]["hashes"] = fastq_classifier.hash_size
-            # todo: process reports to have one clean one
 
         except Exception as e:
             logger.exception(e)
@@ -499,7 +1183,9 @@ def arg_parser():
                                                      '`.../PLoT-ME-data/no-binning/o<omitted>`.')
     parser.add_argument('path_reports',         help='Folder for output reports', type=is_valid_directory)
 
-    parser.add_argument('-i', '--input_fastq',  help='List of input files in fastq format, space separated.',
+    parser.add_argument('-i', '--input_fastq',  help='List of input files in fastq format, space separated. '
+                                                     'Can be gzip compressed (.fastq.gz), BGZF files are decompressed '
+                                                     'with multiple threads.',
                                                 default=[], type=is_valid_file, nargs="+", metavar='')
     parser.add_argument('-c', '--classifier',   help="classifier's name and its parameters, space separated. "
                                                      "Ex: '--classifier kraken k35_l31_s7', or '-c centrifuge'. "
@@ -509,9 +1195,9 @@ def arg_parser():
     parser.add_argument('-f', '--full_index',   help='Use the full index', action='store_true')
     parser.add_argument('-t', '--threads',      help='Number of threads (default=%(default)d)',
                                                 default=cpu_count(), type=int, metavar='')
-    parser.add_argument('-d', '--drop_bin_threshold', help='Drop fastq bins smaller than x percent of the initial '
-                                                           'fastq. Helps to avoid loading hash tables for very few '
-                                                           'reads (default = 1%% / <number of bins>)',
+    parser.add_argument('-d', '--drop_bin_threshold', help='Drop fastq bins with less than x percent of the reads '
+                                                           'of the initial fastq. Helps to avoid loading hash tables '
+                                                           'for very few reads (default = 1%% / <number of bins>)',
                                                 default=DROP_BIN_THRESHOLD, type=float, metavar='')
     parser.add_argument('-r', '--record',       help='Record the time spent for each run in CSV format (default=%(default)s)',
                                                 default=RECORDS, type=str, metavar='')
@@ -521,16 +1207,58 @@ def arg_parser():
     parser.add_argument('--force_binning',      help='If reads have already been binned, binning is skipped, unless '
                                                      'this flag is activated',
                                                 action='store_true')
+    parser.add_argument('-b', '--batch_size',   help='Number of reads featurized and assigned to bins together '
+                                                     '(default=%(default)d)',
+                                                default=ReadToBin.BATCH_SIZE, type=int, metavar='')
+    parser.add_argument('--write_buffer',       help='Size of the write buffer of each bin file, in MB '
+                                                     '(default=%(default)d)',
+                                                default=ReadToBin.WRITE_BUFFER // 2**20, type=int, metavar='')
+    parser.add_argument('--max_open_files',     help='Maximum number of bin files kept open, the least recently '
+                                                     'used is closed beyond (default: half of ulimit -n)',
+                                                default=None, type=int, metavar='')
+    parser.add_argument('--binning-workers', '--binning_workers',
+                                                help='Number of processes counting k-mers and assigning reads to bins. '
+                                                     'The bin files are identical to single core binning '
+                                                     '(default=%(default)d)',
+                                                default=1, type=int, metavar='', dest='binning_workers')
+    parser.add_argument('--no_bin_id',          help='Copy the reads to their bin without adding bin_id=<bin> '
+                                                     'in their header',
+                                                action='store_true')
+    parser.add_argument('-z', '--compress_bins',help='Write the bin files gzip compressed, with this compression level '
+                                                     '(1 if no value given, 0: uncompressed). kraken2 and centrifuge '
+                                                     'read gzip files directly',
+                                                default=0, const=1, nargs='?', type=int, metavar='')
+    parser.add_argument('--stream',             help='Send the reads of each bin straight to its classifier while '
+                                                     'binning, instead of writing the bin files. Bins whose hash '
+                                                     'tables don\'t fit in --max-memory are written to disk. '
+                                                     'Streamed bins are classified whatever their number of reads '
+                                                     '(--drop_bin_threshold only applies to bins on disk). Not used '
+                                                     'when resuming an interrupted binning',
+                                                action='store_true')
+    parser.add_argument('--max-memory', '--max_memory',
+                                                help='Memory budget in GB for the hash tables loaded at the same time. '
+                                                     'Bins are classified concurrently while their hash tables fit '
+                                                     '(default: 80%% of the physical memory)',
+                                                default=None, type=float, metavar='', dest='max_memory')
+    parser.add_argument('--per-bin-report', '--per_bin_report',
+                                                help='Add a last column to the merged kraken2 report, with the '
+                                                     'reads of each clade coming from each bin (bin:reads)',
+                                                action='store_true', dest='per_bin_report')
 
     args = parser.parse_args()
     logger.debug(f"Script {__file__} called with {args}")
-    if len(args.classifier) is 1:
+    if len(args.classifier) == 1:
         args.classifier.append('')
 
     bin_classify(args.input_fastq, args.path_reports, args.path_plot_me,
                  classifier=args.classifier[0], full_DB=args.full_index, threads=args.threads, f_record=args.record,
                  drop_bin_threshold=args.drop_bin_threshold, skip_clas=args.skip_classification,
-                 clf_settings=args.classifier[1], force_binning=args.force_binning)
+                 clf_settings=args.classifier[1], force_binning=args.force_binning, batch_size=args.batch_size,
+                 write_buffer=args.write_buffer * 2**20, max_open_files=args.max_open_files,
+                 binning_workers=args.binning_workers, tag_bin_id=not args.no_bin_id,
+                 compress_bins=args.compress_bins, stream=args.stream,
+                 max_memory=None if args.max_memory is None else int(args.max_memory * 10**9),
+                 per_bin_report=args.per_bin_report)
 
 
 if __name__ == '__main__':
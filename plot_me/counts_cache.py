@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""
+#############################################################################
+Cache of the k-mer counts of each genome's segments (step 0 of
+ plot-me.preprocess), shared by all output folders. Entries are addressed by
+ the checksum of the .fna content and the counting parameters (k, w,
+ canonical), so a moved, renamed or re-downloaded but identical genome isn't
+ counted again. The cache is kept under a size cap, the least recently used
+ entries are evicted first.
+Usage: plot-me.cache stats | evict [options]
+
+#############################################################################
+Sylvain @ GIS / Biopolis / Singapore
+Sylvain RIONDET <sylvainriondet@gmail.com>
+PLoT-ME: Pre-classification of Long-reads for Memory Efficient Taxonomic assignment
+https://github.com/sylvain-ri/PLoT-ME
+#############################################################################
+"""
+import argparse
+import hashlib
+import os
+import os.path as osp
+from time import time
+
+import numpy as np
+
+from plot_me import PLOT_ME_ROOT
+from plot_me.tools import init_logger, f_size
+
+
+logger = init_logger("counts_cache")
+# Cache folder used when none is given, can be set with $PLOT_ME_CACHE
+DEFAULT_PATH = os.environ.get("PLOT_ME_CACHE", PLOT_ME_ROOT.joinpath("cache").as_posix())
+DEFAULT_SIZE = 20 * 10**9
+
+
+class CountsCache:
+    """ <path>/<2 first characters of the key>/<key>.npz, with the segments' columns not depending on where the genome
+        is (category, start, end, record name and description) and their k-mer counts (uint16).
+        The modification time of an entry is its last use (LRU). Hits and misses are appended to <path>/stats.tsv
+    """
+    SUFFIX = ".npz"
+
+    def __init__(self, path=None, max_bytes=DEFAULT_SIZE):
+        self.path       = DEFAULT_PATH if path is None else path
+        self.max_bytes  = max_bytes
+        self.path_stats = osp.join(self.path, "stats.tsv")
+        os.makedirs(self.path, exist_ok=True)
+
+    @staticmethod
+    def checksum(path_fna, block=2**20):
+        """ Hash of the content of a file """
+        digest = hashlib.blake2b(digest_size=20)
+        with open(path_fna, "rb") as f:
+            for chunk in iter(lambda: f.read(block), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    @staticmethod
+    def params(k, w, canonical=False):
+        return f"k{k}_s{w}{'_canonical' if canonical else ''}"
+
+    @classmethod
+    def key(cls, checksum, k, w, canonical=False):
+        return f"{checksum}.{cls.params(k, w, canonical)}"
+
+    def entry_path(self, key):
+        return osp.join(self.path, key[:2], key + self.SUFFIX)
+
+    # ##########################################################################
+    # Entries
+    def get(self, key):
+        """ (segments' columns, counts) of an entry, None if not cached. Marks the entry as recently used """
+        path = self.entry_path(key)
+        try:
+            with np.load(path, allow_pickle=False) as entry:
+                columns = {col: entry[col] for col in entry.files if col != "counts"}
+                counts = entry["counts"]
+            os.utime(path)
+        except FileNotFoundError:
+            self.record("miss", key, 0)
+            return None
+        except Exception as e:
+            logger.warning(f"Unreadable cache entry {path} ({e}), counting again")
+            self.record("miss", key, 0)
+            return None
+        self.record("hit", key, counts.nbytes)
+        return columns, counts
+
+    def put(self, key, columns, counts):
+        """ Add an entry (written to a temporary file first, concurrent writers of the same key are fine) """
+        path = self.entry_path(key)
+        os.makedirs(osp.dirname(path), exist_ok=True)
+        path_tmp = f"{path}.{os.getpid()}.tmp"
+        with open(path_tmp, "wb") as f:
+            np.savez(f, counts=counts, **columns)
+        os.replace(path_tmp, path)
+
+    def entries(self):
+        """ [(last use, size, path)] of all entries, least recently used first """
+        found = []
+        for folder in os.scandir(self.path):
+            if not folder.is_dir():
+                continue
+            for file in os.scandir(folder.path):
+                if file.name.endswith(self.SUFFIX):
+                    stat = file.stat()
+                    found.append((stat.st_mtime, stat.st_size, file.path))
+        return sorted(found)
+
+    def evict(self, max_bytes=None):
+        """ Delete the least recently used entries until the cache is below max_bytes. Returns (entries, bytes) freed """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        removed, freed = 0, 0
+        for _, size, path in entries:
+            if total - freed <= max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:  # evicted by another run
+                pass
+            removed += 1
+            freed += size
+        if removed:
+            logger.info(f"Evicted {removed} entries ({f_size(freed)}) from the k-mer counts cache {self.path}")
+        return removed, freed
+
+    # ##########################################################################
+    # Statistics
+    def record(self, event, key, nbytes):
+        """ Append a line to stats.tsv (single small write in append mode, safe with concurrent workers) """
+        with open(self.path_stats, "a") as f:
+            f.write(f"{time():.0f}\t{event}\t{key}\t{nbytes}\n")
+
+    def stats(self):
+        """ {parameters: [hits, misses, bytes served]} from stats.tsv """
+        per_params = {}
+        if not osp.isfile(self.path_stats):
+            return per_params
+        with open(self.path_stats) as f:
+            for line in f:
+                _, event, key, nbytes = line.rstrip("\n").split("\t")
+                counters = per_params.setdefault(key.split(".", 1)[1], [0, 0, 0])
+                counters[0 if event == "hit" else 1] += 1
+                counters[2] += int(nbytes)
+        return per_params
+
+    def __repr__(self):
+        return f"CountsCache at {self.path}, limited to {f_size(self.max_bytes)}"
+
+
+def print_stats(cache):
+    entries = cache.entries()
+    print(f"k-mer counts cache at {cache.path}: {len(entries)} entries, {f_size(sum(e[1] for e in entries))}")
+    per_params = cache.stats()
+    if not per_params:
+        print("No lookups recorded yet")
+        return
+    print(f"{'parameters':<20} {'hits':>8} {'misses':>8} {'hit rate':>9} {'served':>10}")
+    for params, (hits, misses, served) in sorted(per_params.items()):
+        print(f"{params:<20} {hits:>8} {misses:>8} {hits / (hits + misses):>9.1%} {f_size(served):>10}")
+    hits, misses = (sum(counters[i] for counters in per_params.values()) for i in (0, 1))
+    print(f"{'all':<20} {hits:>8} {misses:>8} {hits / (hits + misses):>9.1%}")
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-c', '--cache',    help='Cache folder (default=%(default)s)',
+                                            default=DEFAULT_PATH, type=str, metavar='')
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("stats", help="entries, size and hit rates per parameters (k, w)")
+    evict = subparsers.add_parser("evict", help="delete the least recently used entries")
+    evict.add_argument('-s', '--size',      help='Size to keep, in GB (default=%(default).1f)',
+                                            default=DEFAULT_SIZE / 10**9, type=float, metavar='')
+
+    args = parser.parse_args()
+    cache = CountsCache(args.cache)
+    if args.command == "stats":
+        print_stats(cache)
+    elif args.command == "evict":
+        cache.evict(int(args.size * 10**9))
+        print_stats(cache)
+
+
+if __name__ == '__main__':
+    arg_parser()
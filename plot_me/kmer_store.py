@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+"""
+#############################################################################
+Store of the k-mer counts of all genomes' segments, written by step 1 of
+ plot-me.preprocess and read by the clustering. Counts are kept in shards of
+ contiguous uint16 matrices (.npy, opened with mmap), the segments' metadata
+ (taxon, category, start/end, record name, fna path) in dictionary encoded
+ tables next to them. New genomes are appended as new shards, the existing
+ shards are only rewritten to remove genomes (incremental update).
+
+#############################################################################
+Sylvain @ GIS / Biopolis / Singapore
+Sylvain RIONDET <sylvainriondet@gmail.com>
+PLoT-ME: Pre-classification of Long-reads for Memory Efficient Taxonomic assignment
+https://github.com/sylvain-ri/PLoT-ME
+#############################################################################
+"""
+import json
+import os
+import os.path as osp
+
+import numpy as np
+import pandas as pd
+
+from plot_me.tools import init_logger
+
+
+logger = init_logger("kmer_store")
+STORE_VERSION = 1
+
+
+class KmerStore:
+    """ Folder with store.json (shards and genomes' count files already added), and for each shard
+        <shard>.counts.npy (segments x k-mers, uint16) and <shard>.meta.npz (codes and values of each metadata column)
+    """
+    META_COLUMNS    = ("taxon", "category", "start", "end", "name", "fna_path")
+    META_INT        = ("taxon", "start", "end")
+    META_CATEGORIES = ("category", "name", "fna_path")
+    SHARD_BYTES     = 256 * 2**20  # counts buffered before writing a shard
+
+    def __init__(self, path, n_kmers=None, k=None, canonical=False):
+        self.path       = path
+        self.path_index = osp.join(path, "store.json")
+        if osp.isfile(self.path_index):
+            with open(self.path_index) as f:
+                self.index = json.load(f)
+            assert n_kmers is None or n_kmers == self.index["n_kmers"], \
+                ValueError(f"Store {path} has {self.index['n_kmers']} k-mers per segment, not {n_kmers}")
+        else:
+            self.index = {"version": STORE_VERSION, "k": k, "canonical": canonical, "n_kmers": n_kmers,
+                          "dtype": "uint16", "shards": [], "sources": []}
+        self.sources       = set(self.index["sources"])
+        self.pending       = []  # [(metadata DataFrame, counts)] not written yet
+        self.pending_rows  = 0
+        self.pending_files = []
+
+    @property
+    def shards(self):
+        return [shard["name"] for shard in self.index["shards"]]
+
+    @property
+    def rows(self):
+        return sum(shard["rows"] for shard in self.index["shards"])
+
+    @property
+    def n_kmers(self):
+        return self.index["n_kmers"]
+
+    @property
+    def nbytes(self):
+        return self.rows * self.n_kmers * np.dtype(self.index["dtype"]).itemsize
+
+    def shard_path(self, shard, kind):
+        return osp.join(self.path, f"{shard}.{kind}")
+
+    # ##########################################################################
+    # Writing
+    def append(self, df, source=None):
+        """ Add the segments of a DataFrame: metadata columns first, then the counts of each k-mer (the last n_kmers
+            columns). source is the file they come from, to skip it when appending again
+        """
+        counts = np.ascontiguousarray(df.iloc[:, -self.n_kmers:].to_numpy(dtype=np.uint16))
+        self.pending.append((df[list(self.META_COLUMNS)], counts))
+        self.pending_rows += counts.shape[0]
+        if source is not None:
+            self.pending_files.append(source)
+        if self.pending_rows * self.n_kmers * 2 >= self.SHARD_BYTES:
+            self.flush()
+
+    def flush(self):
+        """ Write the pending segments as a new shard, then record it in store.json """
+        if not self.pending and not self.pending_files:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        if self.pending:
+            shard = f"shard-{len(self.index['shards']):05d}"
+            self.write_shard(shard, pd.concat([m for m, _ in self.pending], ignore_index=True),
+                             np.concatenate([c for _, c in self.pending]))
+            self.index["shards"].append({"name": shard, "rows": self.pending_rows})
+            logger.debug(f"Wrote {shard} of {self.pending_rows} segments into {self.path}")
+        self.index["sources"].extend(self.pending_files)
+        self.sources.update(self.pending_files)
+        self.pending, self.pending_rows, self.pending_files = [], 0, []
+        self.save_index()
+
+    def write_shard(self, shard, meta, counts):
+        """ Write (or replace) the metadata and counts of a shard, through temporary files """
+        columns = {col: meta[col].to_numpy(dtype=np.int64) for col in self.META_INT}
+        for col in self.META_CATEGORIES:
+            codes, values = pd.factorize(meta[col].astype(str))
+            columns[f"{col}.codes"] = codes.astype(np.int32)
+            columns[f"{col}.values"] = np.array(values, dtype=str)
+        path_meta, path_counts = self.shard_path(shard, "meta.npz"), self.shard_path(shard, "counts.npy")
+        with open(path_meta + ".tmp", "wb") as f:
+            np.savez(f, **columns)
+        with open(path_counts + ".tmp", "wb") as f:
+            np.save(f, counts)
+        os.replace(path_meta + ".tmp", path_meta)
+        os.replace(path_counts + ".tmp", path_counts)
+
+    def save_index(self):
+        path_tmp = self.path_index + ".tmp"
+        with open(path_tmp, "w") as f:
+            json.dump(self.index, f)
+        os.replace(path_tmp, self.path_index)
+
+    def remove(self, fna_paths, sources=()):
+        """ Drop the segments of these genomes (fna_path), rewriting only the shards holding some of them, and forget
+            these sources so they can be appended again. Emptied shards are kept, with 0 rows. Returns the rows dropped
+        """
+        self.flush()
+        fna_paths = set(fna_paths)
+        dropped = 0
+        for shard in self.index["shards"]:
+            meta = self.shard_meta(shard["name"])
+            keep = ~meta.fna_path.isin(fna_paths).to_numpy()
+            if keep.all():
+                continue
+            counts = np.array(self.shard_counts(shard["name"])[keep])
+            self.write_shard(shard["name"], meta[keep].reset_index(drop=True), counts)
+            dropped += shard["rows"] - counts.shape[0]
+            shard["rows"] = counts.shape[0]
+            self.save_index()
+            logger.debug(f"Rewrote {shard['name']} without the segments of removed genomes, {shard['rows']} left")
+        sources = set(sources)
+        self.index["sources"] = [source for source in self.index["sources"] if source not in sources]
+        self.sources -= sources
+        if osp.isdir(self.path):
+            self.save_index()
+        return dropped
+
+    # ##########################################################################
+    # Reading
+    def shard_counts(self, shard):
+        """ Counts of a shard, memory mapped """
+        return np.load(self.shard_path(shard, "counts.npy"), mmap_mode="r")
+
+    def shard_meta(self, shard):
+        with np.load(self.shard_path(shard, "meta.npz"), allow_pickle=False) as columns:
+            meta = pd.DataFrame({col: columns[col] for col in self.META_INT})
+            for col in self.META_CATEGORIES:
+                # same dtype of categories for every shard, even an empty one
+                meta[col] = pd.Categorical.from_codes(columns[f"{col}.codes"], pd.Index(columns[f"{col}.values"], dtype=str))
+        return meta[list(self.META_COLUMNS)]
+
+    def counts(self):
+        """ Counts of all segments, without copy if there's a single shard """
+        shards = [self.shard_counts(shard) for shard in self.shards]
+        if len(shards) == 1:
+            return shards[0]
+        return np.concatenate(shards) if shards else np.empty((0, self.n_kmers), dtype=np.uint16)
+
+    def to_float32(self, scale=1.):
+        """ Counts of all segments in one C-contiguous float32 matrix, each shard multiplied by scale straight from its
+            memory map into its rows (single pass, no intermediate copy) """
+        data = np.empty((self.rows, self.n_kmers), dtype=np.float32)
+        for shard, start, end in zip(self.shards, self.offsets()[:-1], self.offsets()[1:]):
+            np.multiply(self.shard_counts(shard), np.float32(scale), out=data[start:end])
+        return data
+
+    def offsets(self):
+        """ First row of each shard, and the total number of rows """
+        return np.cumsum([0] + [shard["rows"] for shard in self.index["shards"]])
+
+    def take(self, rows):
+        """ Counts of some segments (sorted row numbers), reading only these rows of each shard """
+        rows = np.asarray(rows, dtype=np.int64)
+        offsets = self.offsets()
+        bounds = np.searchsorted(rows, offsets)
+        parts = [self.shard_counts(shard)[rows[start:end] - offsets[i]]
+                 for i, (shard, start, end) in enumerate(zip(self.shards, bounds[:-1], bounds[1:])) if end > start]
+        return np.concatenate(parts) if parts else np.empty((0, self.n_kmers), dtype=np.uint16)
+
+    def chunks(self, chunk_rows):
+        """ Yield (first row, counts) of consecutive chunks of at most chunk_rows segments """
+        offsets = self.offsets()
+        for start in range(0, self.rows, chunk_rows):
+            end = min(start + chunk_rows, self.rows)
+            parts = [self.shard_counts(shard)[max(start, first) - first:min(end, last) - first]
+                     for shard, first, last in zip(self.shards, offsets[:-1], offsets[1:]) if first < end and start < last]
+            yield start, parts[0] if len(parts) == 1 else np.concatenate(parts)
+
+    def meta(self):
+        """ Metadata of all segments, one row per segment in the order of counts() """
+        metas = [self.shard_meta(shard) for shard in self.shards]
+        if len(metas) <= 1:
+            return metas[0] if metas else pd.DataFrame(columns=list(self.META_COLUMNS))
+        meta = pd.concat(metas, ignore_index=True)
+        for col in self.META_CATEGORIES:
+            meta[col] = pd.api.types.union_categoricals([m[col] for m in metas])
+        return meta
+
+    def __repr__(self):
+        return f"KmerStore of {self.rows} segments x {self.n_kmers} k-mers in {len(self.shards)} shards at {self.path}"
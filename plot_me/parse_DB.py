@@ -3,11 +3,13 @@
 #############################################################################
 Project to divide a Database of Genomes (RefSeq) according to their
  k-mer frequency, for a lower RAM requirement of taxonomic classifiers
-Needs a lot of disk space, and RAM according to the largest genome to process.
+Needs a lot of disk space. The k-mer counting streams the genomes, one record
+ (or one chunk of a long chromosome) in memory at a time.
 
 *** STEPS ***
 0 -> Scan the given RefSeq, count kmer frequencies per segment for each genome
-1 -> Combine these counts into a single file
+     (several k: counted once at the largest k, the smaller ones derived from it)
+1 -> Combine these counts into a single store (memory mapped shards of counts)
 2 -> Scale the values by the length of segments and combination of kmers,
      and apply a clustering algorithm (KMean, mini batch KMeans)
      to find the cluster association of each segment (RAM intensive)
@@ -22,9 +24,16 @@ Needs a lot of disk space, and RAM according to the largest genome to process.
   then refers to library preparation and index building
   (kraken2 --add_library and --build respectively).
 
+*** UPDATE ***
+-u/--update -> For a new RefSeq release: the genomes are compared with the manifest
+  of the previous run (size, modification time, taxon). Only new and changed genomes
+  are counted, their segments are assigned with the existing model (--refit to train
+  it again from its centroids), removed genomes are dropped, and only the bins whose
+  .fna files changed get their library and index rebuilt.
+
 Using large k (5+) and small s (10000-) yield very large kmer counts, costing
- high amounts of RAM (esp. when combining all kmer counts together,
- RAM needs to reach ~30GB or more). Currently working on this (July 2020)
+ high amounts of RAM for the clustering (the matrix of all segments' k-mer
+ counts, ~30GB or more).
 
 #############################################################################
 Sylvain @ GIS / Biopolis / Singapore
@@ -36,12 +45,13 @@ https://github.com/sylvain-ri/PLoT-ME
 
 import argparse
 from glob import glob
+import json
 import shutil
-from copy import deepcopy
 from itertools import islice
 from multiprocessing import cpu_count, Pool
 from pathlib import Path
 
+import numpy as np
 from numpy import float32
 import os
 import os.path as osp
@@ -54,16 +64,20 @@ import traceback
 from Bio import SeqIO
 from Bio.SeqRecord import SeqRecord
 # from Bio.Seq import Seq
-from sklearn.cluster import KMeans, MiniBatchKMeans
+# sklearn is imported by clustering_segments() only
 # from sklearn.decomposition import PCA
 
 from tqdm import tqdm
 
 # Import paths and constants for the whole project
 from plot_me import LOGS
-from plot_me.tools import ScanFolder, is_valid_directory, init_logger, create_path, scale_df_by_length, \
-    time_to_hms, delete_folder_if_exists, bash_process, f_size
-from plot_me.bio import kmers_dic, ncbi, seq_count_kmer, combinaisons, nucleotides
+from plot_me.tools import ScanFolder, is_valid_directory, init_logger, create_path, scale_counts, \
+    time_to_hms, delete_folder_if_exists, bash_process, f_size, CentroidModel, kmer_scaling_ratio, peak_memory
+from plot_me.bio import count_kmer_windows_multi, kmer_columns, read_fasta_sequences
+from plot_me.kmer_store import KmerStore
+from plot_me.counts_cache import CountsCache, DEFAULT_SIZE as CACHE_SIZE
+from plot_me import taxonomy as ncbi_taxonomy
+from plot_me.taxonomy import get_taxonomy
 
 
 logger = init_logger('parse_DB')
@@ -78,9 +92,9 @@ class Genome:
     categories = ["plasmid", "chloroplast", "scaffold", "contig",
                   "chromosome", "complete genome", "whole genome shotgun sequence", ]
     K = 0
+    CANONICAL = False
     col_kmers = []
     col_types = {}
-    kmer_count_zeros = {}
 
     def __init__(self, fna_file, taxon, window_size, k=-1):
         logger.log(0, "Created genome object")
@@ -106,50 +120,66 @@ class Genome:
                     self.records[cat].append(record)
                     break
 
-    def yield_genome_split(self):
-        """ Split a genome/plasmid into multiple segments, to count the k-mer
-            or to create the .fna files for kraken2-build
+    def yield_records(self):
+        """ Stream the records of the .fna file as (category, name, description, sequence bytes), one record in memory
+            at a time. Records without any known category are skipped, like load_genome()
+        """
+        for header, seq in read_fasta_sequences(self.path_fna):
+            description = header.decode().rstrip()
+            for cat in self.categories:
+                if cat in description:
+                    yield cat, description.split(maxsplit=1)[0] if description else "", description, seq
+                    break
+
+    def count_kmers(self, ks=None):
+        """ Count the kmer distribution of each segment while streaming the records. Segments are counted straight from
+            the sequence (no SeqRecord per segment), in the order of the categories, then of the records in the file
+            ks: k-mer sizes to count, in a single pass at the largest one (default: self.k only)
+            Returns the segments' columns not depending on the file's path and taxon (category, start, end, record
+            name and description), and their counts for each k {k: counts}
+        """
+        # With Genome.CANONICAL, single counter for AAAT and its reverse complement ATTT
+        ks = sorted(set(ks)) if ks else [self.k]
+        segments = {cat: [] for cat in self.categories}
+        counts   = {cat: [] for cat in self.categories}
+        for cat, name, description, seq in self.yield_records():
+            counts[cat].append(count_kmer_windows_multi(seq, ks, w=self.window_size, canonical=self.CANONICAL))
+            segments[cat].extend((cat, start, start + self.window_size, name, description)
+                                 for start in range(0, len(seq) - self.window_size, self.window_size))
+        rows = [row for cat in self.categories for row in segments[cat]]
+        columns = {col: np.array([row[i] for row in rows], dtype=np.int64 if col in ("start", "end") else str)
+                   for i, col in enumerate(("category", "start", "end", "name", "description"))}
+        return columns, {k: np.concatenate([c[k] for cat in self.categories for c in counts[cat]]
+                                           + [np.empty((0, len(kmer_columns(k, self.CANONICAL))), dtype=np.uint16)])
+                         for k in ks}
+
+    def kmers_to_df(self, columns, counts, path_kmers, k=None):
+        """ Save the segments and their kmer counts (from count_kmers) to the kmer folder as pandas DataFrame
+            k: size of the k-mers counted, if not Genome.K
         """
-        for cat in self.categories:
-            for record in self.records[cat]:
-
-                full_seq = record.seq
-                len_genome = len(full_seq)
-                for start in range(0, len_genome - self.window_size, self.window_size):
-                    end = min(start + self.window_size, len_genome - 1)
-                    # Include the taxonomy id, start and end of the segment into the description
-                    description = f"|kraken:taxid|{self.taxon}|s:{start}-e:{end-1}|{record.description}"
-                    segment = SeqRecord(full_seq[start:end],
-                                        record.id, record.name, description, record.dbxrefs,
-                                        record.features, record.annotations, record.letter_annotations)
-                    yield (segment, self.taxon, cat, start, end)
-
-    def count_kmers_to_df(self, path_kmers):
-        """ Take all splits, count the kmer distribution and save to the kmer folder as pandas DataFrame """
-        # todo: consider combining forward and backward kmers as well as complements.
-        #  Single counter for AAAT, TAAA, TTTA and ATTT
-
-        for_csv = []
-        for segment, taxon, cat, start, end in self.yield_genome_split():
-            kmer_count = seq_count_kmer(str(segment.seq), deepcopy(self.kmer_count_zeros), k=self.k)
-            for_csv.append((taxon, cat, start, end, segment.name, segment.description, self.path_fna,
-                            *kmer_count.values() ))
-        # kmer_keys = list(self.kmer_count_zeros.keys())
-        df = pd.DataFrame(for_csv, columns=main.cols_types)
+        col_kmers = self.col_kmers if k is None or k == self.K else kmer_columns(k, self.CANONICAL)
+        cols_spe = list(main.cols_types)[:-len(self.col_kmers)]
+        df = pd.DataFrame({
+            "taxon": self.taxon, "category": columns["category"], "start": columns["start"], "end": columns["end"],
+            "name": columns["name"],
+            # Include the taxonomy id, start and end of the segment into the description
+            "description": [f"|kraken:taxid|{self.taxon}|s:{start}-e:{end-1}|{description}" for start, end, description
+                            in zip(columns["start"].tolist(), columns["end"].tolist(), columns["description"].tolist())],
+            "fna_path": self.path_fna,
+        }, columns=cols_spe)
+        df = pd.concat([df, pd.DataFrame(counts, columns=col_kmers)], axis=1)
         df.taxon       = df.taxon.astype('category')
         df.category    = df.category.astype('category')
         df.name        = df.name.astype('category')
         df.fna_path    = df.fna_path.astype('category')
-        for col in self.col_kmers:
-            df[col] = df[col].astype("uint16")
         df.to_pickle(path_kmers)
         logger.debug(f"saved kmer count to {path_kmers}")
 
     @classmethod
-    def set_k_kmers(cls, k):
+    def set_k_kmers(cls, k, canonical=False):
         cls.K = k
-        cls.col_kmers = combinaisons(nucleotides, k)
-        cls.kmer_count_zeros = kmers_dic(k)
+        cls.CANONICAL = canonical
+        cls.col_kmers = kmer_columns(k, canonical)
 
 
 def create_n_folders(path, n, delete_existing=False):
@@ -170,7 +200,7 @@ def add_file_with_parameters(folder, add_description=""):
     with open(path, 'w') as f:
         f.write(f"script = {__file__} \n"
                 f"From RefSeq located at: {main.folder_database} \n"
-                f"k={main.k}, w={main.w} (segments size), \n"
+                f"k={main.k}, w={main.w} (segments size), canonical k-mers={main.canonical}, \n"
                 f"folders *containing* these strings have been omitted: " + ", ".join(main.omit_folders) + ". \n"
                 f"{add_description}")
 
@@ -223,22 +253,58 @@ check_step.can_skip   = "111110"  # By default skip step that has been started,
 
 
 def parallel_kmer_counting(fastq, ):
-    if osp.isfile(fastq.path_target):
+    """ Count the k-mers of one genome, streaming its records, or take them from the cache. The counts of the smaller k
+        of parallel_kmer_counting.lower_k are derived from the same counting pass.
+        Returns (counting time, peak RSS of the worker, all found in the cache) """
+    targets = {main.k: fastq.path_target}
+    for k, folder_kmers in parallel_kmer_counting.lower_k.items():
+        targets[k] = kmer_counts_path(fastq.path_abs, main.folder_database, folder_kmers, k)
+    targets = {k: path for k, path in targets.items() if not osp.isfile(path)}
+    if not targets:
         logger.debug(f"File already existing, skipping ({fastq.path_target})")
         return
     with open(fastq.path_check) as f:
         taxon = int(f.read())
+    start = perf_counter()
     genome = Genome(fastq.path_abs, taxon, window_size=main.w, k=main.k)
-    genome.load_genome()
-    genome.count_kmers_to_df(fastq.path_target)
+    cache, found = parallel_kmer_counting.cache, {}
+    if cache is not None:
+        checksum = cache.checksum(fastq.path_abs)
+        keys = {k: cache.key(checksum, k, main.w, main.canonical) for k in targets}
+        for k in targets:
+            cached = cache.get(keys[k])
+            if cached is not None:
+                columns, found[k] = cached
+    missing = [k for k in targets if k not in found]
+    if missing:
+        columns, counted = genome.count_kmers(missing)
+        if cache is not None:
+            for k in missing:
+                cache.put(keys[k], columns, counted[k])
+        found.update(counted)
+    for k, path in targets.items():
+        create_path(path)
+        genome.kmers_to_df(columns, found[k], path, k)
+    duration, peak = perf_counter() - start, peak_memory()
+    logger.debug(f"{'Counted' if missing else 'Cached'} {f_size(fastq.path_abs)} {fastq.path_abs} (k={sorted(targets)}) "
+                 f"in {duration:.2f}s, peak RSS {f_size(peak)}")
+    return duration, peak, not missing
+
+
+parallel_kmer_counting.cache   = None  # CountsCache shared by all output folders, or None
+parallel_kmer_counting.lower_k = {}    # {k: folder of its counts} for smaller k derived from the counts at main.k
 
 
 @check_step
-def scan_RefSeq_kmer_counts(scanning, folder_kmers, stop=-1):
+def scan_RefSeq_kmer_counts(scanning, folder_kmers, stop=-1, lower_k=None):
     """ Scan through RefSeq, split genomes into segments, count their k-mer, save in similar structure
         Compatible with 2019 RefSeq format hopefully
+        lower_k: {k: folder_kmers} of smaller k whose counts are derived from the same pass, instead of scanning again
     """
     create_path(folder_kmers)
+    parallel_kmer_counting.lower_k = {k: folder for k, folder in (lower_k or {}).items() if k < main.k}
+    for folder in parallel_kmer_counting.lower_k.values():
+        create_path(folder)
     # scanning folder Class set up:
     # todo: change the kmer_count into the k_s_ notation
     ScanFolder.set_folder_scan_options(scanning=scanning, target=folder_kmers,
@@ -248,13 +314,22 @@ def scan_RefSeq_kmer_counts(scanning, folder_kmers, stop=-1):
     logger.info("scanning through all genomes in refseq to count kmer distributions " + scanning)
 
     # Count in parallel. islice() to take a part of an iterable
-    Genome.set_k_kmers(main.k)
+    Genome.set_k_kmers(main.k, main.canonical)
     with Pool(main.cores) as pool:
         results = list(tqdm(pool.imap(parallel_kmer_counting, islice(ScanFolder.tqdm_scan(with_tqdm=False),
                                                                      stop if stop>0 else None)),
                             total=ScanFolder.count_root_files(), dynamic_ncols=True))
 
     logger.info(f"{len(results)} genomes have been scanned and kmer counted.")
+    counted = [result for result in results if result is not None]
+    if counted:
+        durations, peaks, hits = zip(*counted)
+        logger.info(f"Counted {len(counted)} new genomes, {np.mean(durations):.2f}s per genome "
+                    f"(longest {max(durations):.2f}s), peak RSS of a worker {f_size(max(peaks))}")
+    if parallel_kmer_counting.cache is not None:
+        logger.info(f"{sum(hits) if counted else 0} genomes taken from the cache, out of {len(counted)}. "
+                    f"{parallel_kmer_counting.cache}")
+        parallel_kmer_counting.cache.evict()
 
 
 @check_step
@@ -281,25 +356,45 @@ def combine_genome_kmer_counts(folder_kmers, path_df):
 
 
 @check_step
-def append_genome_kmer_counts(folder_kmers, path_df):
-    """ Combine single dataframes into one. Might need high memory """
-    logger.info(f"Appending all kmer frequencies from {folder_kmers} into a single file {path_df}")
+def append_genome_kmer_counts(folder_kmers, path_store, remove=()):
+    """ Append the k-mer counts of each genome to the store, as new shards. Genomes already in the store are skipped
+        remove : genomes (paths) dropped from the store first (update), their counts are appended again if still there
+    """
+    logger.info(f"Appending all kmer frequencies from {folder_kmers} into the store {path_store}")
+    store = KmerStore(path_store, len(kmer_columns(main.k, main.canonical)), main.k, main.canonical)
+    if remove:
+        dropped = store.remove(remove, [kmer_counts_path(path, main.folder_database, folder_kmers) for path in remove])
+        logger.info(f"Dropped {dropped} segments of {len(remove)} added, changed or removed genomes from the store")
     added = 0
     ScanFolder.set_folder_scan_options(scanning=folder_kmers, target="", ext_find=(f".{main.k}mer_count.pd", ),
                                        ext_check="", ext_create="", skip_folders=main.omit_folders)
-    # Append all the df. Don't write the index. Write the header only for the first frame
     for file in ScanFolder.tqdm_scan():
-        if added == 0:
-            pd.read_pickle(file.path_abs).to_csv(path_df, mode='w', index=False, header=True)
-        else:
-            pd.read_pickle(file.path_abs).to_csv(path_df, mode='a', index=False, header=False)
+        if file.path_abs in store.sources:
+            continue
+        store.append(pd.read_pickle(file.path_abs), source=file.path_abs)
         added += 1
-    logger.info(f"Combined file of {added} {main.k}-mer counts ({osp.getsize(path_df)/10**9:.2f} GB) save at {path_df}")
+    store.flush()
+    logger.info(f"Added {added} {main.k}-mer counts to the store ({f_size(store.nbytes)}): {store}")
+
+
+def stratified_sample(taxa, n, seed=3):
+    """ Row numbers of at most n segments per taxon, drawn uniformly. Same as a reservoir sampling of each taxon:
+        keep the n segments with the smallest random priorities of their taxon """
+    priorities = np.random.default_rng(seed).random(len(taxa))
+    order = np.lexsort((priorities, taxa))
+    sorted_taxa = taxa[order]
+    rank_in_taxon = np.arange(len(taxa)) - np.searchsorted(sorted_taxa, sorted_taxa, side="left")
+    return np.sort(order[rank_in_taxon < n])
 
 
 @check_step
-def clustering_segments(path_kmer_counts, output_pred, path_model, n_clusters, model_name="minikm"):
-    """ Given a database of segments of genomes in fastq files, split it in n clusters/bins """
+def clustering_segments(path_store, output_pred, path_model, n_clusters, model_name="minikm",
+                        chunk_rows=None, sample_per_taxon=None):
+    """ Given a database of segments of genomes in fastq files, split it in n clusters/bins
+        chunk_rows       : out-of-core training, only this number of segments are loaded at once. The model (minikm
+                           only) is trained with shuffled chunks, then the segments are assigned chunk by chunk
+        sample_per_taxon : train on at most this number of segments per taxon (all segments are assigned)
+    """
     assert model_name in clustering_segments.models, f"model {model_name} is not implemented"
     # Paths
     create_path(output_pred)
@@ -307,47 +402,33 @@ def clustering_segments(path_kmer_counts, output_pred, path_model, n_clusters, m
     k = main.k
     w = main.w
 
-    # https://www.codementor.io/@guidotournois/4-strategies-to-deal-with-large-datasets-using-pandas-qdw3an95k
-    # filename = "data.csv"
-    # n = sum(1 for line in open(filename)) - 1  # Calculate number of rows in file
-    # s = n // 10  # sample size of 10%
-    # skip = sorted(random.sample(range(1, n + 1), n - s))  # n+1 to compensate for header
-    # df = pandas.read_csv(filename, skiprows=skip)
-
-    path_pkl_kmer_counts = path_kmer_counts.replace(".csv", ".pd")
-    if osp.isfile(path_pkl_kmer_counts):
-        logger.info(f"Clustering the genomes' segments into {n_clusters} bins. Loading combined kmer counts "
-                    f"(file size: {osp.getsize(path_pkl_kmer_counts)/10**9:.2f} GB) ...")
-        df = pd.read_pickle(path_pkl_kmer_counts)
+    store = KmerStore(path_store)
+    logger.info(f"Clustering the genomes' segments into {n_clusters} bins. Loading combined kmer counts "
+                f"({f_size(store.nbytes)}) from {store}")
+    assert store.n_kmers == len(kmer_columns(k, main.canonical)), \
+        ValueError(f"The store has {store.n_kmers} k-mers per segment, not the count of k={k}")
+    segments = store.meta()
+    training = None
+    if sample_per_taxon is not None:
+        training = stratified_sample(segments.taxon.to_numpy(), sample_per_taxon)
+        logger.info(f"Training on {len(training)} segments, at most {sample_per_taxon} per taxon")
+
+    if chunk_rows is None:
+        # ## 1 ## Scaling by length and kmers, while loading the counts into a single float32 matrix
+        data = store.to_float32(kmer_scaling_ratio(k, w))
+        df_mem = data.nbytes
+        logger.info(f"Kmer counts loaded and scaled to the length of the segments. "
+                    f"Matrix: {f_size(df_mem)} - shape: {data.shape}")
     else:
-        logger.info(f"Clustering the genomes' segments into {n_clusters} bins. Loading combined kmer counts "
-                    f"(file size: {osp.getsize(path_kmer_counts)/10**9:.2f} GB) ...")
-        df = pd.read_csv(path_kmer_counts, dtype=main.cols_types)
-        logger.info(f"save pickle copy for faster loading {path_pkl_kmer_counts}")
-        # Soon DEPRECATED, set my the loading type
-        # (Need to set again as categories)
-        df.category    = df.category.astype('category')
-        df.name        = df.name.astype('category')
-        df.fna_path    = df.fna_path.astype('category')
-        df.description = df.description.astype('category')
-        df.to_pickle(path_pkl_kmer_counts)
-
-    cols_kmers = df.columns[-4**k:]
-    cols_spe = df.columns[:-4**k]
-    logger.debug(f"cols_kmers={cols_kmers[:5]} {cols_kmers[-5:]}")
-
-    # ## 1 ## Scaling by length and kmers
-    df_mem = df.memory_usage(deep=False).sum()
-    logger.info(f"Kmer counts loaded, scaling the values to the length of the segments. "
-                f"DataFrame size: {df_mem/10**9:.2f} GB - shape: {df.shape}")
-
-    # todo: save intermediate data
-    scale_df_by_length(df, cols_kmers, k, w)
+        assert model_name == "minikm", NotImplementedError(f"Out-of-core training needs minikm, not {model_name}")
+        data = None
+        df_mem = min(chunk_rows, store.rows) * store.n_kmers * (2 + 4)  # uint16 counts + scaled float32
 
     # ## 2 ## Could add PCA
 
     # Model learning
     logger.info(f"Data takes {df_mem/10**9:.2f} GB. Training {model_name}...")
+    from sklearn.cluster import KMeans, MiniBatchKMeans
     if model_name == "kmeans":
         ml_model = KMeans(n_clusters=n_clusters, n_jobs=main.cores, random_state=3)
     elif model_name == "minikm":
@@ -356,31 +437,180 @@ def clustering_segments(path_kmer_counts, output_pred, path_model, n_clusters, m
         logger.error(f"No model defined for {model_name}.")
         raise NotImplementedError
 
-    ml_model.fit(df[cols_kmers])
-
-    # Model saving
-    with open(path_model, 'wb') as f:
-        pickle.dump(ml_model, f)
-    logger.info(f"{model_name} model saved for k={k} s={w} at {path_model}, now predicting bins for each segment...")
+    if data is None:
+        train_out_of_core(ml_model, store, training, chunk_rows)
+    else:
+        ml_model.fit(data if training is None else data[training])
+    save_model(ml_model, path_model, model_name)
 
     # ## 3 ##
-    predicted = ml_model.predict(df[cols_kmers])
-    df["cluster"] = predicted
-
-    df[list(cols_spe) + ["cluster"]].to_pickle(output_pred)
-    logger.info(f"Defined {n_clusters} clusters, assignments here: {output_pred} with ML model {model_name}.")
+    segments["cluster"] = predict_segments(ml_model, store, data, chunk_rows, output_pred.replace(".pd", ".clusters.npy"))
+    segments.to_pickle(output_pred)
+    logger.info(f"Defined {n_clusters} clusters, assignments here: {output_pred} with ML model {model_name}. "
+                f"Peak memory so far: {f_size(peak_memory())}")
     return
 
 
 clustering_segments.models = ("minikm", "kmeans")
+clustering_segments.epochs = 5  # passes over the segments for the out-of-core training
+
+
+def train_out_of_core(ml_model, store, rows, chunk_rows, seed=3):
+    """ partial_fit of a MiniBatchKMeans with shuffled chunks of segments from the store (None for all segments).
+        Each chunk reads its rows (sorted) from the memory mapped shards, then is shuffled and given by mini-batches
+    """
+    rows = np.arange(store.rows) if rows is None else rows
+    rng = np.random.default_rng(seed)
+    logger.info(f"Training out-of-core on {len(rows)} segments, {clustering_segments.epochs} epochs "
+                f"of chunks of {chunk_rows} segments")
+    for epoch in range(clustering_segments.epochs):
+        shuffled = rng.permutation(rows)
+        for i in tqdm(range(0, len(shuffled), chunk_rows), desc=f"epoch {epoch + 1}", dynamic_ncols=True):
+            chunk = scale_counts(store.take(np.sort(shuffled[i:i + chunk_rows])), main.k, main.w)
+            rng.shuffle(chunk)
+            for batch in range(0, len(chunk), ml_model.batch_size):
+                ml_model.partial_fit(chunk[batch:batch + ml_model.batch_size])
+    return ml_model
+
+
+def save_model(ml_model, path_model, model_name):
+    """ Pickle the sklearn model, and save its lightweight copy with the parameters (.npz) for plot-me.classify """
+    # Record the k-mer profile, for plot-me.classify to count the reads' k-mers the same way
+    ml_model.canonical = main.canonical
+    with open(path_model, 'wb') as f:
+        pickle.dump(ml_model, f)
+    path_centroids = path_model.replace(".pkl", ".npz")
+    CentroidModel.from_sklearn(ml_model, main.k, main.w, main.omit_folders, main.canonical, model_name).save(path_centroids)
+    logger.info(f"{model_name} model saved for k={main.k} s={main.w} at {path_model} (centroids: {path_centroids}), "
+                f"now predicting bins for each segment...")
 
 
-def pll_copy_segments_to_bin(df):
+def predict_segments(ml_model, store, data=None, chunk_rows=None, path_clusters=None):
+    """ Bin of each segment of the store, from the scaled matrix (data), or chunk by chunk from the store into a
+        memory mapped .npy (path_clusters) when data is None
+    """
+    if data is not None:
+        return ml_model.predict(data)
+    clusters = np.lib.format.open_memmap(path_clusters, mode="w+", dtype=np.int32, shape=(store.rows,))
+    for start, counts in tqdm(store.chunks(chunk_rows), total=-(-store.rows // chunk_rows), dynamic_ncols=True):
+        clusters[start:start + len(counts)] = ml_model.predict(scale_counts(counts, main.k, main.w))
+    clusters.flush()
+    return np.asarray(clusters)
+
+
+# #############################################################################
+# Incremental update, for new RefSeq releases
+def kmer_counts_path(path_genome, folder_database, folder_kmers, k=None):
+    """ k-mer counts of a genome written by step 0 (same path as ScanFolder.path_target), for main.k by default """
+    path_rel = osp.relpath(osp.abspath(path_genome), folder_database)
+    return osp.abspath(osp.splitext(osp.join(folder_kmers, path_rel))[0] + f".{main.k if k is None else k}mer_count.pd")
+
+
+def refseq_manifest(folder_database):
+    """ {path of each genome counted by step 0: [size, modification time (ns), taxon]} """
+    ScanFolder.set_folder_scan_options(scanning=folder_database, target="", ext_find=(".fastq", ".fq", ".fna"),
+                                       ext_check=".taxon", ext_create="", skip_folders=main.omit_folders)
+    manifest = {}
+    for file in ScanFolder.walk_dir(log=False):
+        stat = os.stat(file.path_abs)
+        with open(file.path_check) as f:
+            manifest[file.path_abs] = [stat.st_size, stat.st_mtime_ns, int(f.read())]
+    return manifest
+
+
+def save_manifest(path_manifest, genomes, pending=()):
+    """ Genomes the bins have been made of, and the (bin, taxon) .fna files rewritten by an update whose libraries and
+        indexes haven't been rebuilt yet """
+    path_tmp = path_manifest + ".tmp"
+    with open(path_tmp, "w") as f:
+        json.dump({"version": 1, "folder_database": main.folder_database, "genomes": genomes,
+                   "pending": sorted(pending)}, f)
+    os.replace(path_tmp, path_manifest)
+    logger.debug(f"Manifest of {len(genomes)} genomes saved at {path_manifest}")
+
+
+def refseq_changes(path_manifest, genomes, folder_database, folder_kmers):
+    """ Genomes added, changed (size, modification time or taxon) or removed since the manifest of the previous run.
+        The k-mer counts of changed and removed genomes are deleted, for step 0 to count them again.
+        Returns the paths of all these genomes, and the (bin, taxon) pairs left pending by an interrupted update
+    """
+    assert osp.isfile(path_manifest), FileNotFoundError(f"No manifest of a previous run at {path_manifest}, "
+                                                        f"run plot-me.preprocess without --update first")
+    with open(path_manifest) as f:
+        previous = json.load(f)
+    added   = set(genomes) - set(previous["genomes"])
+    removed = set(previous["genomes"]) - set(genomes)
+    changed = {path for path in set(genomes) & set(previous["genomes"]) if genomes[path] != previous["genomes"][path]}
+    pending = {tuple(pair) for pair in previous["pending"]}
+    logger.info(f"Since the previous run: {len(added)} genomes added, {len(changed)} changed, {len(removed)} removed, "
+                f"{len(pending)} (bin, taxon) files pending")
+
+    for path in changed | removed:
+        path_counts = kmer_counts_path(path, folder_database, folder_kmers)
+        if osp.isfile(path_counts):
+            os.remove(path_counts)
+    return sorted(added | changed | removed), pending
+
+
+@check_step
+def update_clustering(path_store, output_pred, path_model, genomes, model_name="minikm", refit=False, chunk_rows=None):
+    """ Bins of the segments of new or changed genomes, predicted with the existing model. With refit, the model is
+        trained again starting from its centroids (warm start), and all segments are assigned again.
+        genomes : paths of the added, changed and removed genomes, their previous segments are dropped
+        Returns the (bin, taxon) pairs whose segments changed, the .fna files of the bins to rewrite
+    """
+    store = KmerStore(path_store)
+    k, w = main.k, main.w
+    previous = pd.read_pickle(output_pred)
+    gone = previous.fna_path.isin(genomes).to_numpy()
+    segments = store.meta()
+    new = segments.fna_path.isin(genomes).to_numpy()
+    assert (~gone).sum() == (~new).sum(), \
+        ValueError(f"The store and the previous bins of the segments ({output_pred}) differ, run the clustering again")
+    with open(path_model, 'rb') as f:
+        ml_model = pickle.load(f)
+
+    if refit:
+        assert chunk_rows is None or model_name == "minikm", \
+            NotImplementedError(f"Out-of-core training needs minikm, not {model_name}")
+        logger.info(f"Training {model_name} again from its {ml_model.n_clusters} centroids, on {store.rows} segments")
+        ml_model = type(ml_model)(**{**ml_model.get_params(), "init": ml_model.cluster_centers_, "n_init": 1})
+        data = store.to_float32(kmer_scaling_ratio(k, w)) if chunk_rows is None else None
+        if data is None:
+            train_out_of_core(ml_model, store, None, chunk_rows)
+        else:
+            ml_model.fit(data)
+        save_model(ml_model, path_model, model_name)
+        clusters = predict_segments(ml_model, store, data, chunk_rows, output_pred.replace(".pd", ".clusters.npy"))
+    else:
+        clusters = np.empty(store.rows, dtype=previous.cluster.dtype)
+        clusters[~new] = previous.cluster.to_numpy()[~gone]
+        rows = np.flatnonzero(new)
+        step = len(rows) if chunk_rows is None else chunk_rows
+        for i in range(0, len(rows), max(step, 1)):
+            clusters[rows[i:i + step]] = ml_model.predict(scale_counts(store.take(rows[i:i + step]), k, w))
+    segments["cluster"] = clusters
+
+    # (bin, taxon) of the segments removed, added, or moved to another bin by the refit
+    moved = previous.cluster.to_numpy()[~gone] != clusters[~new]
+    touched = pd.concat([previous.loc[gone, ["cluster", "taxon"]], segments.loc[new, ["cluster", "taxon"]],
+                         previous.loc[~gone].loc[moved, ["cluster", "taxon"]],
+                         segments.loc[~new].loc[moved, ["cluster", "taxon"]]])
+    affected = sorted({(int(cluster), int(taxon)) for cluster, taxon in zip(touched.cluster, touched.taxon)})
+    segments.to_pickle(output_pred)
+    logger.info(f"{new.sum()} new segments assigned, {gone.sum()} removed, {moved.sum()} moved. "
+                f"{len(affected)} (bin, taxon) files to rewrite, in bins {sorted({b for b, _ in affected})}")
+    return affected
+
+
+def pll_copy_segments_to_bin(task):
     """ Function for parallel copying of segments of genomes to a bin, file path and bin number in a dataframe
         Input is only ONE .fna file, which has to be split into segments, but these might be recombined
         if their bin association are consecutive.
+        Segments are written into private shards, <bin>/<taxon>.fna.<task number>.part, one buffered handle per bin,
+        concatenated afterwards by merge_segments_shards(). Returns (task number, taxon, {bin: shard}, bytes written)
     """
-    df = df[1]
+    task_nb, (_, df) = task
     taxon = df.taxon.iloc[0]
     genome_path = df.fna_path.iloc[0]
     logger.debug(f"Got the segments clustering: {df.shape} (nb of segments, nb of bins) "
@@ -392,71 +622,119 @@ def pll_copy_segments_to_bin(df):
     # todo: probably memory or integer size issue somewhere here
     # First get the real segmentation depending on cluster continuity of the segments
     # Aggregate segments with same cluster (consecutive values of cluster), get start, end and description updated
-    count = 0
-    for i, df_split in df.groupby([(df.cluster != df.cluster.shift()).cumsum()]):
-        cluster_id = df_split.cluster.iloc[0]
-        description= df_split.description.iloc[0]
-        category   = df_split.category.iloc[0]
-        name       = df_split.name.iloc[0]
-        start      = df_split.start.iloc[0]
-        end        = df_split.end.iloc[-1]
-
-        path_bin_segment = osp.join(pll_copy_segments_to_bin.path_db_bins, str(cluster_id), f"{taxon}.fna")
-
-        descr = description.replace(" ", "_").replace(" ", "_")  # To avoid issues with bash. Space and non-breaking space
-        descr_splits = descr.split("|")
-        description_new = "|".join(descr_splits[:3] + [f"s:{start}-e:{end-1}"] + descr_splits[4:])
-
-        # Need to find the genome/plasmid/ and the right chromosome
-        for seq in genome.records[category]:
-            if seq.name == name:
-                logger.log(5, f"Adding combined segment {i}, start={start}, end={end-1}, id={seq.id}, "
-                              f"from {(end-start)/main.w} seqs, to bin {cluster_id}, file: {path_bin_segment}")
-
-                segment = SeqRecord(seq.seq[start:end], seq.id, seq.name, description_new, seq.dbxrefs,
-                                    seq.features, seq.annotations, seq.letter_annotations)
-                # Append the combined segment to avoid multiple files for the same taxon
-                with open(path_bin_segment, "a") as f:
-                    SeqIO.write(segment, f, "fasta")
-                count += 1
-                break
-    return
+    shards = {}
+    handles = {}
+    try:
+        for i, df_split in df.groupby((df.cluster != df.cluster.shift()).cumsum()):
+            cluster_id = df_split.cluster.iloc[0]
+            if pll_copy_segments_to_bin.only is not None and (cluster_id, taxon) not in pll_copy_segments_to_bin.only:
+                continue
+            category   = df_split.category.iloc[0]
+            name       = df_split.name.iloc[0]
+            start      = df_split.start.iloc[0]
+            end        = df_split.end.iloc[-1]
+
+            # Need to find the genome/plasmid/ and the right chromosome
+            for seq in genome.records[category]:
+                if seq.name == name:
+                    descr = seq.description.replace(" ", "_").replace(" ", "_")  # To avoid issues with bash. Space and non-breaking space
+                    description_new = f"|kraken:taxid|{taxon}|s:{start}-e:{end-1}|{descr}"
+                    logger.log(5, f"Adding combined segment {i}, start={start}, end={end-1}, id={seq.id}, "
+                                  f"from {(end-start)/main.w} seqs, to bin {cluster_id}")
+
+                    segment = SeqRecord(seq.seq[start:end], seq.id, seq.name, description_new, seq.dbxrefs,
+                                        seq.features, seq.annotations, seq.letter_annotations)
+                    if cluster_id not in handles:
+                        shards[cluster_id] = osp.join(pll_copy_segments_to_bin.path_db_bins, str(cluster_id),
+                                                      f"{taxon}.fna.{task_nb}.part")
+                        handles[cluster_id] = open(shards[cluster_id], "w", buffering=pll_copy_segments_to_bin.buffer)
+                    SeqIO.write(segment, handles[cluster_id], "fasta")
+                    break
+    finally:
+        written = 0
+        for handle in handles.values():
+            written += handle.tell()
+            handle.close()
+    return task_nb, taxon, shards, written
 
 
 pll_copy_segments_to_bin.path_db_bins = ""
+pll_copy_segments_to_bin.buffer = 2**20
+pll_copy_segments_to_bin.only = None  # (bin, taxon) pairs to write, all if None
 
 
-@check_step
-def split_genomes_to_bins(path_bins_assignments, path_db_bins, clusters):
-    """ Write .fna files from the clustering into n bins """
-    logger.info(f"deleting existing sub-folders to avoid duplicates by append to existing files at: {path_db_bins}")
-    create_n_folders(path_db_bins, clusters, delete_existing=True)
+def pll_merge_segments_shards(item):
+    """ Concatenate the shards of a (bin, taxon), in the order of their task, into <bin>/<taxon>.fna """
+    path_fna, shards = item
+    if len(shards) == 1:
+        os.replace(shards[0], path_fna)
+        return
+    with open(path_fna, "wb") as f_out:
+        for shard in shards:
+            with open(shard, "rb") as f_in:
+                shutil.copyfileobj(f_in, f_out, pll_copy_segments_to_bin.buffer)
+            os.remove(shard)
 
+
+@check_step
+def split_genomes_to_bins(path_bins_assignments, path_db_bins, clusters, only=None):
+    """ Write .fna files from the clustering into n bins
+        Each .fna file of RefSeq is a task writing its segments into private shards, then the shards of each
+        (bin, taxon) are concatenated in the order of the tasks: no concurrent appends, and the same files whatever
+        the number of cores.
+        only : (bin, taxon) pairs to rewrite (update), other files are kept. Returns the number of files written
+    """
     # Load bin assignment of each segment
     logger.info(f"loading cluster/bin assignment for each genomes' window "
                 f"({osp.getsize(path_bins_assignments)/10**9:.2f} GB): {path_bins_assignments}")
     df = pd.read_pickle(path_bins_assignments)
 
-    # Split it per file to allow parallel processing
+    if only is None:
+        logger.info(f"deleting existing sub-folders to avoid duplicates by append to existing files at: {path_db_bins}")
+        create_n_folders(path_db_bins, clusters, delete_existing=True)
+    else:
+        only = {(int(cluster_id), int(taxon)) for cluster_id, taxon in only}
+        logger.info(f"Rewriting {len(only)} (bin, taxon) .fna files in {path_db_bins}")
+        create_n_folders(path_db_bins, clusters)
+        for cluster_id, taxon in only:
+            path_fna = osp.join(path_db_bins, str(cluster_id), f"{taxon}.fna")
+            if osp.isfile(path_fna):
+                os.remove(path_fna)
+        # every genome of these taxa is needed to write their files again
+        df = df[df.taxon.isin({taxon for _, taxon in only})]
+
+    # Split it per file to allow parallel processing, sorted by file path
     logger.debug(f"Split the DF of segments assignments per fna file ({path_bins_assignments}")
-    df_per_fna = df.groupby(["fna_path"])
+    df_per_fna = df.groupby("fna_path", sort=True, observed=True)
 
-    # Copy in parallel
     pll_copy_segments_to_bin.path_db_bins = path_db_bins
+    pll_copy_segments_to_bin.only = only
     add_file_with_parameters(path_db_bins, add_description=f"cluster number = {clusters}")
 
     logger.info(f"Copy genomes segments to their respective bin into {path_db_bins}")
-    Genome.set_k_kmers(main.k)
-    try:
-        with Pool(main.cores) as pool:  # file copy don't need many cores (main.cores)
-            results = list(tqdm(pool.imap(pll_copy_segments_to_bin, df_per_fna), total=len(df_per_fna), dynamic_ncols=True))
-    except:
-        logger.warning(f"Multiprocessing failed, launching single core version")
-        results = []
-        for part in tqdm(df_per_fna, total=len(df_per_fna), dynamic_ncols=True):
-            results.append(pll_copy_segments_to_bin(part))
-
-    logger.info(f"{len(results)} genomes have been split into {path_db_bins}")
+    Genome.set_k_kmers(main.k, main.canonical)
+    time_start = perf_counter()
+    with Pool(main.cores) as pool:  # file copy don't need many cores (main.cores)
+        results = list(tqdm(pool.imap(pll_copy_segments_to_bin, enumerate(df_per_fna)),
+                            total=len(df_per_fna), dynamic_ncols=True))
+        written = sum(result[3] for result in results)
+        time_copy = perf_counter()
+        logger.info(f"{len(results)} genomes have been split into shards, {f_size(written)} at "
+                    f"{f_size(written / max(time_copy - time_start, 1e-9))}/s")
+
+        # Merge the shards of each (bin, taxon), in the order of the tasks
+        to_merge = {}
+        for task_nb, taxon, shards, _ in sorted(results, key=lambda result: result[0]):
+            for cluster_id, shard in shards.items():
+                to_merge.setdefault(osp.join(path_db_bins, str(cluster_id), f"{taxon}.fna"), []).append(shard)
+        for _ in tqdm(pool.imap_unordered(pll_merge_segments_shards, to_merge.items()),
+                      total=len(to_merge), dynamic_ncols=True):
+            pass
+    time_merge = perf_counter()
+    logger.info(f"{len(to_merge)} (bin, taxon) .fna files written into {path_db_bins}, merged at "
+                f"{f_size(written / max(time_merge - time_copy, 1e-9))}/s. Overall {f_size(written)} at "
+                f"{f_size(written / max(time_merge - time_start, 1e-9))}/s")
+    return len(to_merge)
 
 
 def classifier_param_checker(l_param):
@@ -475,20 +753,27 @@ def classifier_param_checker(l_param):
 
 
 @check_step
-def add_library(path_refseq_binned, path_bins_hash, n_clusters, classifier):
+def add_library(path_refseq_binned, path_bins_hash, n_clusters, classifier, bins=None):
     """ launch kraken2-build add-to-library. DELETE EXISTING FOLDER !!
         https://htmlpreview.github.io/?https://github.com/DerrickWood/kraken2/blob/master/docs/MANUAL.html#custom-databases
+        bins : only these bins (update), their existing library and index are deleted first
     """
     create_n_folders(path_bins_hash, n_clusters)
     add_file_with_parameters(path_bins_hash, add_description=f"cluster number = {n_clusters}")
+    if bins is not None:
+        logger.info(f"Deleting the library and index of the bins {bins}, to build them again")
+        for cluster in bins:
+            shutil.rmtree(osp.join(path_bins_hash, str(cluster)))
+            os.makedirs(osp.join(path_bins_hash, str(cluster)))
 
     logger.info(f"{classifier} add_to_library, {n_clusters} clusters, under {path_bins_hash} ")
-    for cluster in tqdm(range(n_clusters), dynamic_ncols=True):
+    for cluster in tqdm(range(n_clusters) if bins is None else bins, dynamic_ncols=True):
         bin_id = f"{cluster}/"
 
         if "kraken2" in classifier:
             # if library exist in another folder (other classifier parameters, but same binning param), make a link to it !
-            existing_lib = glob(f"{osp.dirname(path_bins_hash)}/*/{bin_id}/library")
+            # (not when updating, the other one might not be up to date)
+            existing_lib = glob(f"{osp.dirname(path_bins_hash)}/*/{bin_id}/library") if bins is None else []
             path_new_lib = osp.join(path_bins_hash, bin_id, "library")
 
             # If library has already been done, skip it
@@ -519,16 +804,17 @@ def add_library(path_refseq_binned, path_bins_hash, n_clusters, classifier):
 
 
 @check_step
-def build_indexes(path_taxonomy, path_classifier, n_clusters, p):
-    """ launch kraken build on each bin
+def build_indexes(path_taxonomy, path_classifier, n_clusters, p, bins=None):
+    """ launch kraken build on each bin (only these bins if given, update)
         https://htmlpreview.github.io/?https://github.com/DerrickWood/kraken2/blob/master/docs/MANUAL.html#custom-databases
         Skip skipping by checking if folder exists: **check_step NO FOLDER CHECK** (DON'T REMOVE)
     """
     assert osp.isdir(path_taxonomy), logger.error(f"Path to taxonomy doesn't seem to be a directory: {path_taxonomy}")
     add_file_with_parameters(path_classifier, add_description=f"cluster = {n_clusters} \ntaxonomy = {path_taxonomy}")
 
-    logger.info(f"{p['name']} build its {n_clusters} indexes, will take lots of time. Under: {path_classifier}")
-    for cluster in tqdm(range(n_clusters), dynamic_ncols=True):
+    logger.info(f"{p['name']} build its {n_clusters if bins is None else len(bins)} indexes, will take lots of time. "
+                f"Under: {path_classifier}")
+    for cluster in tqdm(range(n_clusters) if bins is None else bins, dynamic_ncols=True):
         bin_id = f"{cluster}/"
 
         if "kraken2" in p['name']:
@@ -630,37 +916,86 @@ def kraken2_clean(path_bins_hash, n_clusters):
     logger.info(f"Cleaning done")
 
 
+def output_paths(folder_output, k, window, n_clusters=0, omit_folders=(), canonical=False, ml_model="minikm",
+                 classifier_param=CLASSIFIERS[0]):
+    """ Folders and files of a setting, under the PLoT-ME data folder. Named after the parameters they depend on:
+        k-mer counts per (k, w), their store per omitted folders, then the model, bins and indexes per number of bins
+    """
+    s_canonical = "_canonical" if canonical else ""
+    param_k_s = f"k{k}_s{window}{s_canonical}"
+    o_omitted = "" if len(omit_folders) == 0 else "o" + "-".join(omit_folders)
+    string_param = f"{ml_model}_b{n_clusters}_{param_k_s}_{o_omitted}"
+    folder_intermediate_files = osp.join(folder_output, param_k_s, "kmer_counts")
+    folder_by_model = osp.join(folder_output, param_k_s, string_param)
+    param, s_param = classifier_param_checker(classifier_param)
+    return {
+        "param_k_s":    param_k_s,
+        "o_omitted":    o_omitted,
+        "string_param": string_param,
+        "kmer_counts":  osp.join(folder_intermediate_files, f"counts.{param_k_s}"),
+        "store":        osp.join(folder_intermediate_files, f"all-counts.{param_k_s}_{o_omitted}.store"),
+        "by_model":     folder_by_model,
+        "manifest":     osp.join(folder_by_model, f"manifest.{string_param}.json"),
+        "model":        osp.join(folder_by_model, f"model.{string_param}.pkl"),
+        "clustering":   osp.join(folder_by_model, f"segments-clustered.{string_param}.pd"),
+        "binned":       osp.join(folder_by_model, "RefSeq_binned"),
+        "index":        osp.join(folder_by_model, param['name'], s_param),
+    }
+
+
+def check_window(window, ks):
+    """ K-mer counts of a window are stored as uint16, they must not wrap around """
+    most = window - min(ks) + 1
+    assert most <= np.iinfo(np.uint16).max, \
+        ValueError(f"Windows of {window} bp have up to {most} k-mers, the uint16 counts can't exceed "
+                   f"{np.iinfo(np.uint16).max}: use a smaller window")
+
+
 #   **************************************************    MAIN   **************************************************   #
 def main(folder_database, folder_output, n_clusters, k, window, cores=cpu_count(), skip_existing="111110",
          early_stop=len(check_step.can_skip)-1, omit_folders=("plant", "vertebrate"),
          path_taxonomy="", full_DB=False, k2_clean=False,
-         ml_model=clustering_segments.models[0], classifier_param=CLASSIFIERS[0]):
+         ml_model=clustering_segments.models[0], classifier_param=CLASSIFIERS[0], canonical=False,
+         chunk_rows=None, sample_per_taxon=None, update=False, refit=False, cache=None, cache_size=CACHE_SIZE,
+         lower_k=()):
     """ Pre-processing of RefSeq database to split genomes into windows, then count their k-mers
         Second part, load all the k-mer counts into one single Pandas dataframe
         Third train a clustering algorithm on the k-mer frequencies of these genomes' windows
         folder_database : RefSeq root folder
         folder_output   : empty root folder to store kmer counts
+        canonical       : count k-mers and their reverse complement together (about half the number of features)
+        chunk_rows      : out-of-core clustering, by chunks of this number of segments (bounds the RAM needed)
+        sample_per_taxon: train the clustering on at most this number of segments per taxon
+        update          : only count the genomes added or changed since the previous run (manifest), assign their
+                          segments with the existing model, and rebuild the bins that changed. Runs all steps
+        refit           : with update, train the model again from its centroids, and assign all segments again
+        cache           : folder of the k-mer counts cache shared by all runs (default ~/PLoT-ME/cache)
+        cache_size      : size limit of the cache in bytes, least recently used entries evicted. 0 to disable it
+        lower_k         : smaller k-mer sizes, whose counts are derived from the counting at k (step 0 only), written
+                          to their own folders for the runs with these k
     """
     logger.info("\n*********************************************************************************************************")
     logger.info("**** Starting script **** \n ")
     try:
         # Common folder name keeping parameters
-        param_k_s = f"k{k}_s{window}"
-        o_omitted = "" if len(omit_folders) == 0 else "o" + "-".join(omit_folders)
-        folder_intermediate_files = osp.join(folder_output, param_k_s, "kmer_counts")
+        paths = output_paths(folder_output, k, window, n_clusters, omit_folders, canonical, ml_model, classifier_param)
         # Parameters
         main.folder_database= folder_database
         main.omit_folders   = omit_folders
         main.k              = k
         main.w              = window
         main.cores          = cores
+        main.canonical      = canonical
+        parallel_kmer_counting.cache = CountsCache(cache, cache_size) if cache_size > 0 else None
+        if path_taxonomy:
+            ncbi_taxonomy.DEFAULT_PATH = path_taxonomy
         # Set all columns type
         cols_types = {
             "taxon": int, "category": 'category',
             "start": int, "end": int,
             "name": 'category', "description": 'category', "fna_path": 'category',
         }
-        for key in kmers_dic(main.k).keys():
+        for key in kmer_columns(main.k, main.canonical):
             cols_types[key] = float32
         main.cols_types = cols_types
 
@@ -670,46 +1005,72 @@ def main(folder_database, folder_output, n_clusters, k, window, cores=cpu_count(
         check_step.can_skip   = skip_existing        # Set the skip variable for the decorator of each step
         # Check classifier/kraken2's parameters
         param, s_param = classifier_param_checker(classifier_param)
+        check_window(window, (k, *lower_k))
         # Check that taxonomy wasn't forgotten
         if '0' in check_step.can_skip[5:] and check_step.early_stop >= 5:
             assert osp.isdir(path_taxonomy), NotADirectoryError
 
         if full_DB:
             # Run kraken2 on the full RefSeq, without binning, for reference
-            path_full_hash = osp.join(folder_output, "no-binning", o_omitted, param['name'], s_param)
+            path_full_hash = osp.join(folder_output, "no-binning", paths["o_omitted"], param['name'], s_param)
             kraken2_full_add_lib(folder_database, path_full_hash)
             kraken2_full_build_hash(path_taxonomy, path_full_hash, param)
             if k2_clean: kraken2_clean(path_full_hash, 1)
 
         else:
+            path_individual_kmer_counts = paths["kmer_counts"]
+            assert all(lower < k for lower in lower_k), ValueError(f"k-mer sizes {lower_k} should be smaller than {k}")
+            folders_lower_k = {lower: output_paths(folder_output, lower, window, canonical=canonical)["kmer_counts"]
+                               for lower in lower_k}
+            # Genomes the bins will be made of, changes since the previous run for an update
+            path_manifest = paths["manifest"]
+            genomes = refseq_manifest(folder_database)
+            if update:
+                changes, pending = refseq_changes(path_manifest, genomes, folder_database, path_individual_kmer_counts)
+                check_step.can_skip = "0" * len(check_step.can_skip)  # each step only processes the changes
+
             #    KMER COUNTING
             # get kmer distribution for each window of each genome, parallel folder with same structure
-            path_individual_kmer_counts = osp.join(folder_intermediate_files, f"counts.k{k}_s{window}")
-            scan_RefSeq_kmer_counts(folder_database, path_individual_kmer_counts)
+            scan_RefSeq_kmer_counts(folder_database, path_individual_kmer_counts, lower_k=folders_lower_k)
 
             # combine all kmer distributions into one single file
-            path_stacked_kmer_counts = osp.join(folder_intermediate_files, f"all-counts.k{k}_s{window}_{o_omitted}.csv")
-            append_genome_kmer_counts(path_individual_kmer_counts, path_stacked_kmer_counts)
+            path_stacked_kmer_counts = paths["store"]
+            append_genome_kmer_counts(path_individual_kmer_counts, path_stacked_kmer_counts,
+                                      remove=changes if update else ())
 
             #    CLUSTERING
             # From kmer distributions, use clustering to set the bins per segment
-            string_param = f"{ml_model}_b{n_clusters}_k{main.k}_s{main.w}_{o_omitted}"
-            folder_by_model = osp.join(folder_output, param_k_s, string_param)
-            path_model = osp.join(folder_by_model, f"model.{string_param}.pkl")
-            path_segments_clustering = osp.join(folder_by_model, f"segments-clustered.{string_param}.pd")
-            clustering_segments(path_stacked_kmer_counts, path_segments_clustering, path_model, n_clusters, ml_model)
+            path_model = paths["model"]
+            path_segments_clustering = paths["clustering"]
+            if update:
+                affected = update_clustering(path_stacked_kmer_counts, path_segments_clustering, path_model, changes,
+                                             ml_model, refit=refit, chunk_rows=chunk_rows)
+                if affected is not None:
+                    # the changes are in the assignments now, record them with the files left to rewrite
+                    pending = pending | set(affected)
+                    save_manifest(path_manifest, genomes, pending)
+                bins = sorted({cluster_id for cluster_id, _ in pending})
+            else:
+                clustering_segments(path_stacked_kmer_counts, path_segments_clustering, path_model, n_clusters,
+                                    ml_model, chunk_rows=chunk_rows, sample_per_taxon=sample_per_taxon)
+                pending, bins = None, None
 
             #    CREATING THE DATABASES
             # create the DB for each bin (copy parts of each .fna genomes into a folder with taxonomy id)
-            path_refseq_binned = osp.join(folder_by_model, f"RefSeq_binned")
-            split_genomes_to_bins(path_segments_clustering, path_refseq_binned, n_clusters)
+            path_refseq_binned = paths["binned"]
+            written = split_genomes_to_bins(path_segments_clustering, path_refseq_binned, n_clusters, only=pending)
+            if written is not None and not update:
+                save_manifest(path_manifest, genomes)
 
             # Run kraken2-build add libray
-            path_bins_hash = osp.join(folder_by_model, param['name'], s_param)
-            add_library(path_refseq_binned, path_bins_hash, n_clusters, param['name'])
+            path_bins_hash = paths["index"]
+            add_library(path_refseq_binned, path_bins_hash, n_clusters, param['name'], bins=bins)
 
             # Run kraken2-build make hash tables
-            build_indexes(path_taxonomy, path_bins_hash, n_clusters, param)
+            build_indexes(path_taxonomy, path_bins_hash, n_clusters, param, bins=bins)
+            if update and check_step.early_stop >= 5:
+                save_manifest(path_manifest, genomes)
+                logger.info(f"Update done, {len(bins)} bins rebuilt: {bins}")
 
             # Cleaning
             if k2_clean and "kraken2" in param['name']: kraken2_clean(path_bins_hash, n_clusters)
@@ -736,6 +1097,7 @@ main.omit_folders    = ""
 main.k               = 0
 main.w               = 0
 main.cores           = 0
+main.canonical       = False
 main.cols_types      = {}
 
 
@@ -751,12 +1113,18 @@ def arg_parser():
                                                  "of the classifiers. Allocate around twice as much space as NCBI RefSeq. ",
                                             type=is_valid_directory)
 
-    parser.add_argument('-k', '--kmer',     help='Size of the kmers (default=%(default)d)',
-                                            default=4,          type=int, metavar='')
+    parser.add_argument('-k', '--kmer',     help='Size of the kmers. With several sizes (ex: -k 3 4 5 6), all are counted '
+                                                 'in a single pass at the largest one (step 0), then the other steps '
+                                                 'run for each size, largest first (default=%(default)s)',
+                                            default=[4], type=int, nargs="+", metavar='')
     parser.add_argument('-w', '--window',   help='Segments/windows size to split genomes into (default=%(default)d)',
                                             default=10000,      type=int, metavar='')
     parser.add_argument('-b', '--bins',     help='Number of bins/clusters to split the DB into (default=%(default)d)',
                                             default=10,         type=int, metavar='')
+    parser.add_argument('--canonical',      help='Count each k-mer together with its reverse complement (canonical '
+                                                 'k-mers), roughly halving the number of features. Recorded in '
+                                                 'the model, plot-me.classify counts reads the same way',
+                                            action='store_true')
 
     parser.add_argument('-t', '--threads',  help='Number of threads (default=%(default)d)',
                                             default=cpu_count(), type=int,  metavar='')
@@ -786,16 +1154,46 @@ def arg_parser():
                                                    "step 3 (--early), and build their index based on the .fna files "
                                                    "in PLoT-ME/<param>/'RefSeq_binned'",
                                             default=CLASSIFIERS[0], type=str, nargs="+", metavar='')
+    parser.add_argument('--chunk-rows', '--chunk_rows',
+                                            help='Out-of-core clustering: load only this number of segments at '
+                                                 'once, to train the model with shuffled chunks and assign the '
+                                                 'segments chunk by chunk. Bounds the RAM of step 2 '
+                                                 '(default: all segments in RAM)',
+                                            default=None, type=int, metavar='', dest='chunk_rows')
+    parser.add_argument('--sample-per-taxon', '--sample_per_taxon',
+                                            help='Train the clustering on at most this number of segments per '
+                                                 'taxon, drawn at random (default: all segments)',
+                                            default=None, type=int, metavar='', dest='sample_per_taxon')
+    parser.add_argument('--cache',          help='Cache of the k-mer counts of each genome, shared by all output folders '
+                                                 'and runs (same .fna content, k, w and canonical) '
+                                                 '(default: $PLOT_ME_CACHE or ~/PLoT-ME/cache)',
+                                            default=None, type=str, metavar='')
+    parser.add_argument('--cache-size', '--cache_size',
+                                            help='Size limit of the cache in GB, least recently used genomes are '
+                                                 'evicted. 0 disables the cache (default=%(default).1f)',
+                                            default=CACHE_SIZE / 10**9, type=float, metavar='', dest='cache_size')
+    parser.add_argument('-u', '--update',   help='Update the database with a new RefSeq release: only the genomes added or '
+                                                 'changed since the previous run are counted, their segments are '
+                                                 'assigned with the existing model, removed genomes are purged, and '
+                                                 'only the bins that changed are rebuilt. Runs all steps (ignores -s)',
+                                            action='store_true')
+    parser.add_argument('--refit',          help='With --update, train the clustering again starting from the '
+                                                 'existing centroids, then assign all segments again',
+                                            action='store_true')
     # parser.add_argument('-m', '--ml_model', help='name of the model to use for clustering',
     #                                         choices=clustering_segments.models, type=str, metavar='',
     #                                         default=clustering_segments.models[0])
     args = parser.parse_args()
 
     logger.info(f"Script {__file__} called with {args}")
-    main(folder_database=args.path_database, folder_output=args.path_plot_me, n_clusters=args.bins,
-         k=args.kmer, window=args.window, cores=args.threads, skip_existing=args.skip_existing,
-         early_stop=args.early, omit_folders=tuple(args.omit), path_taxonomy=args.taxonomy,
-         full_DB=args.full_index, classifier_param=args.classifier, k2_clean=args.clean)
+    kmers = sorted(set(args.kmer), reverse=True)
+    for k in kmers[:1] if args.full_index else kmers:
+        main(folder_database=args.path_database, folder_output=args.path_plot_me, n_clusters=args.bins,
+             k=k, window=args.window, cores=args.threads, skip_existing=args.skip_existing,
+             early_stop=args.early, omit_folders=tuple(args.omit), path_taxonomy=args.taxonomy,
+             full_DB=args.full_index, classifier_param=args.classifier, k2_clean=args.clean, canonical=args.canonical,
+             chunk_rows=args.chunk_rows, sample_per_taxon=args.sample_per_taxon, update=args.update, refit=args.refit,
+             cache=args.cache, cache_size=int(args.cache_size * 10**9), lower_k=kmers[1:] if k == kmers[0] else ())
 
 
 # python ~/Scripts/Reads_Binning/plot_me/classify.py -t 4 -d bins /hdd1000/Reports/ /ssd1500/Segmentation/3mer_s5000/clustered_by_minikm_3mer_s5000_omitted_plant_vertebrate/ -i /ssd1500/Segmentation/Test-Data/Synthetic_from_Genomes/2019-12-05_100000-WindowReads_20-BacGut/2019-12-05_100000-WindowReads_20-BacGut.fastq /ssd1500/Segmentation/Test-Data/Synthetic_from_Genomes/2019-11-26_100000-SyntReads_20-BacGut/2019-11-26_100000-SyntReads_20-BacGut.fastq /ssd1500/Segmentation/Test-Data/ONT_Silico_Communities/Mock_10000-uniform-bacteria-l1000-q8.fastq /ssd1500/Segmentation/Test-Data/ONT_Silico_Communities/Mock_100000-bacteria-l1000-q10.fastq
@@ -847,7 +1245,7 @@ def kmer_pkl_path(kmer_folder, fna_path, taxo_ext="gff"):
             f.write(taxo)
 
     # todo: check here to retrieve species' name
-    bacteria_name = ncbi.translate_to_names([taxo])[0]
+    bacteria_name = get_taxonomy().names([int(taxo)])[0]
     # path_taxo_names = "/home/ubuntu/Data/Segmentation/Kraken_10_clusters_V1/Kraken2_building/taxonomy/names.dmp"
     # taxo_table = pd.read_csv(path_taxo_names, sep="\t|\t")
     # query = taxo_table[(taxo_table.taxo == int(taxo)) & (taxo_table.class_name == "scientific name")]
@@ -1,82 +1,314 @@
 #!/usr/bin/env python3
 """
 #############################################################################
-Run parse_DB.py with multiple parameters
+Parameter sweep of plot-me.preprocess: a grid of k, w, number of bins,
+ omitted folders and classifiers is expanded into a graph of the steps of
+ parse_DB, each step being shared by all the settings that depend on it:
+   count    per w          step 0, all k in one pass (the largest k)
+   combine  per k, w, omit step 1
+   cluster  per ..., b     step 2
+   bins     per ..., b     step 3
+   library  per ..., b, classifier name (kraken2 libraries are reused by all its parameters)
+   index    per ..., b, classifier and its parameters   steps 4-5
+Independent nodes run in parallel, within the given cores and memory.
+Each completed node leaves a marker in <path_plot_me>/sweep/, with its parameters.
+ An interrupted sweep resumes from the nodes not marked, or marked with other
+ parameters (delete a marker to run a node again, and the nodes after it).
+Usage: plot-me.sweep <path_database> <taxonomy> <path_plot_me> -k 3 4 5 -w 5000 10000 -b 10 20 [options]
 
 #############################################################################
 Sylvain @ GIS / Biopolis / Singapore
-Sylvain Jun-Zhe RIONDET <Riondet_Sylvain_from.tp@gis.a-star.edu.sg>
-Started on 2019-12-11
-Reads Binning Project
+Sylvain RIONDET <sylvainriondet@gmail.com>
+PLoT-ME: Pre-classification of Long-reads for Memory Efficient Taxonomic assignment
+https://github.com/sylvain-ri/PLoT-ME
 #############################################################################
 """
-
 import argparse
-import datetime as dt
-from multiprocessing.pool import Pool
-import pandas as pd
-from tqdm import tqdm
+import json
+from multiprocessing import cpu_count, Process
+from multiprocessing.connection import wait
+import os
+import os.path as osp
+import signal
+import sys
+from time import perf_counter, time
+
+from plot_me import parse_DB
+from plot_me.counts_cache import DEFAULT_SIZE as CACHE_SIZE
+from plot_me.kmer_store import KmerStore
+from plot_me.tools import init_logger, is_valid_directory, f_size, time_to_hms
 
-import parse_DB
-from tools import ArgumentParserWithDefaults
 
+logger = init_logger("parse_multi")
+STEPS = len(parse_DB.check_step.can_skip)
+WORKER_MEMORY = 2 * 2**30  # rough peak memory of a worker of the parallel steps (counting, copying segments, libraries)
+RUN_ONLY = ("cores", "cache", "cache_size")  # parameters of a node that don't change its outputs
 
-def main(k, cores, skip_existing):
-    """ record which param have been done
-        date	cluster	k	w	clf_param	omit
+
+class Node:
+    """ Steps of parse_DB.main up to `last` for one setting, run in their own process once all the nodes it depends on
+        are done. The earlier steps are skipped (their outputs exist), the last one is always run
     """
-    history = "/home/ubuntu/Scripts/Reads_Binning/plot_me/tried_param.tsv"
-
-    # with Pool(8) as pool:  # file copy don't need many cores (main.cores)
-    #     results = list(tqdm(pool.imap(pll_copy_segments_to_bin, islice(df_per_fna, stop if stop > 0 else None)),
-    #                         total=len(df_per_fna)))
-
-    n_clusters = 20
-    classifier_param = ["kraken2", "35", "31", "7"]  # ["kraken2", "25", "22", "4"]
-    omit_folders = ("plant", "vertebrate")
-
-    for k in (k, ):
-        for w in (5000, 10000, 25000):
-            omit = ",".join(omit_folders)
-            f_clf_param = ",".join(classifier_param)
-            s_param = f"{dt.datetime.now():%Y-%m-%d_%H-%M}\t{n_clusters}\t{k}\t{w}\t{f_clf_param}\t{omit}"
-            print(s_param)
-
-            # skip already done
-            df = pd.read_csv(history, sep="\t")
-            if df[(df.k == k) & (df.w == w) & (df.cluster == n_clusters) & (df.clf_param == f_clf_param)].shape[0] > 0:
-                print("skipped")
-                continue
-
-            parse_DB.main(
-                folder_database="/mnt/data/NCBI/20190704/refseq",
-                folder_output="/mnt/data/Segmentation",
-                n_clusters=n_clusters,
-                k=k,
-                window=w,
-                cores=cores,
-                skip_existing=skip_existing,
-                force_recount=False,
-                early_stop=6,
-                omit_folders=omit_folders,
-                path_taxonomy="/mnt/data/taxonomy",
-                ml_model="minikm",
-                full_DB=False,
-                classifier_param=classifier_param,
-                k2_clean=False)
-
-            print("done")
-            with open(history, 'a') as f:
-                f.write(s_param + "\n")
+    def __init__(self, name, last, kwargs, deps=(), cores=1):
+        self.name     = name
+        self.last     = last
+        self.kwargs   = {**kwargs, "cores": cores, "early_stop": last,
+                         "skip_existing": "1" * last + "0" * (STEPS - last)}
+        self.deps     = list(deps)
+        self.cores    = cores
+        self.estimate = None
 
+    @property
+    def paths(self):
+        kw = self.kwargs
+        return parse_DB.output_paths(kw["folder_output"], kw["k"], kw["window"], kw["n_clusters"], kw["omit_folders"],
+                                     kw["canonical"], kw["ml_model"], kw["classifier_param"])
 
+    def memory(self):
+        """ Rough peak memory, in bytes, from the outputs of the nodes it depends on (estimated once they're done) """
+        if self.estimate is None:
+            store = KmerStore(self.paths["store"]) if self.last == 2 else None
+            if store is not None and store.n_kmers is not None and store.rows > 0:
+                chunk_rows = self.kwargs["chunk_rows"]
+                in_ram = store.rows if chunk_rows is None else min(chunk_rows, store.rows)
+                # float32 matrix and its scaled copy, metadata of the segments
+                self.estimate = in_ram * store.n_kmers * 4 * 2 + store.rows * 64
+            elif self.last == 5:
+                # kraken2-build / centrifuge-build, about the size of the largest bin's genomes
+                bins = {}
+                for root, _, files in os.walk(self.paths["binned"]):
+                    bin_id = osp.relpath(root, self.paths["binned"]).split(os.sep)[0]
+                    bins[bin_id] = bins.get(bin_id, 0) + sum(osp.getsize(osp.join(root, f)) for f in files)
+                self.estimate = max(bins.values(), default=0) + WORKER_MEMORY
+            else:
+                self.estimate = self.cores * WORKER_MEMORY
+        return self.estimate
 
-if __name__ == '__main__':
-    # Option to display default values, metavar='' to remove ugly capitalized option's names
-    parser = ArgumentParserWithDefaults(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
-    parser.add_argument('-k', '--kmer',      default=4, type=int, help='Size of the kmers', metavar='')
-    parser.add_argument('-c', '--cores',     default=4, type=int, help='number of cores', metavar='')
-    parser.add_argument('-s', '--skip_existing',     default="110000", type=str, help='skip steps', metavar='')
+    def signature(self):
+        """ Parameters changing the outputs of the node, as recorded in its marker """
+        return json.loads(json.dumps({key: value for key, value in self.kwargs.items() if key not in RUN_ONLY},
+                                     default=str))
+
+    def is_done(self, path_marker):
+        """ Marker present and written with the same parameters (a marker of an older sweep doesn't count) """
+        if not osp.isfile(path_marker):
+            return False
+        with open(path_marker) as f:
+            recorded = json.load(f).get("kwargs", {})
+        if {key: value for key, value in recorded.items() if key not in RUN_ONLY} != self.signature():
+            logger.warning(f"Marker of {self.name} written with other parameters, the node is run again")
+            return False
+        return True
+
+    def __repr__(self):
+        return f"Node {self.name} (steps to {self.last}, {self.cores} cores)"
+
+
+def run_node(last, kwargs):
+    """ Entry point of a node's process. parse_DB.main logs the errors, the exit code tells if all steps went through """
+    signal.signal(signal.SIGINT, signal.default_int_handler)  # parse_DB.main stops on Ctrl-C, unlike the sweep
+    parse_DB.main(**kwargs)
+    sys.exit(0 if parse_DB.check_step.step_nb > last else 1)
+
+
+def sweep_nodes(folder_database, folder_output, path_taxonomy, ks, windows, bins, omits, classifiers,
+                node_cores=cpu_count(), early_stop=STEPS - 1, canonical=False, chunk_rows=None, sample_per_taxon=None,
+                cache=None, cache_size=CACHE_SIZE):
+    """ Nodes of the sweep, each one after the nodes it depends on. Parameters are lists of values of parse_DB.main's
+        (omits: list of omitted folders, classifiers: list of classifier_param)
+    """
+    ks = sorted(set(ks), reverse=True)
+    for w in windows:
+        parse_DB.check_window(w, ks)
+    common = dict(folder_database=folder_database, folder_output=folder_output, path_taxonomy=path_taxonomy,
+                  canonical=canonical, ml_model=parse_DB.clustering_segments.models[0], chunk_rows=chunk_rows,
+                  sample_per_taxon=sample_per_taxon, cache=cache, cache_size=cache_size,
+                  n_clusters=bins[0], classifier_param=classifiers[0])
+    # counting skips only the folders omitted by every setting, the combine step of each setting filters the others
+    omit_all = tuple(folder for folder in omits[0] if all(folder in omit for omit in omits))
+    nodes = []
+
+    def add(name, last, deps=(), cores=1, **kwargs):
+        if last <= early_stop:
+            nodes.append(Node(name, last, {**common, **kwargs}, deps, cores))
+        return name
+
+    for w in windows:
+        o_omitted = parse_DB.output_paths(folder_output, ks[0], w, omit_folders=omit_all)["o_omitted"]
+        count = add(f"count.s{w}{'_canonical' if canonical else ''}.k{'-'.join(map(str, ks))}_{o_omitted}", 0,
+                    cores=node_cores, k=ks[0], window=w, omit_folders=omit_all, lower_k=ks[1:])
+        for k in ks:
+            for omit in omits:
+                omit = tuple(omit)
+                paths = parse_DB.output_paths(folder_output, k, w, omit_folders=omit, canonical=canonical)
+                combine = add(f"combine.{paths['param_k_s']}_{paths['o_omitted']}", 1, [count],
+                              k=k, window=w, omit_folders=omit)
+                for b in bins:
+                    setting = dict(k=k, window=w, omit_folders=omit, n_clusters=b)
+                    string_param = parse_DB.output_paths(folder_output, canonical=canonical, **setting)["string_param"]
+                    cluster = add(f"cluster.{string_param}", 2, [combine], **setting)
+                    binned = add(f"bins.{string_param}", 3, [cluster], cores=node_cores, **setting)
+                    libraries = {}
+                    for classifier in classifiers:
+                        name = classifier[0]
+                        if name not in libraries:
+                            libraries[name] = add(f"library.{string_param}.{name}", 4, [binned], cores=node_cores,
+                                                  classifier_param=classifier, **setting)
+                    for classifier in classifiers:
+                        _, s_param = parse_DB.classifier_param_checker(classifier)
+                        # centrifuge takes the seqid2taxid.map of the kraken2 library
+                        deps = [libraries[classifier[0]]] + ([libraries["kraken2"]] if classifier[0] == "centrifuge"
+                                                             and "kraken2" in libraries else [])
+                        add(f"index.{string_param}.{classifier[0]}_{s_param}", 5, deps, cores=node_cores,
+                            classifier_param=classifier, **setting)
+    return nodes
+
+
+def run_sweep(nodes, folder_done, cores=cpu_count(), memory=None, dry_run=False):
+    """ Run the nodes not done yet, in parallel as long as their cores and estimated memory fit (a node is started
+        anyway when nothing else runs). Nodes depending on a failed one are abandoned.
+        Returns the names of the nodes not done (failed, abandoned, or not started after an interruption)
+    """
+    memory = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") if memory is None else memory
+    os.makedirs(folder_done, exist_ok=True)
+    marker = {node.name: osp.join(folder_done, f"{node.name}.done") for node in nodes}
+    done = {node.name for node in nodes if node.is_done(marker[node.name])}
+    # a node run again changes the outputs of all the nodes after it (nodes are listed after their dependencies)
+    for node in nodes:
+        if node.name in done and not all(dep in done for dep in node.deps):
+            logger.warning(f"{node.name} is run again, after the nodes it depends on")
+            done.remove(node.name)
+            if not dry_run:
+                os.remove(marker[node.name])
+    waiting = [node for node in nodes if node.name not in done]
+    logger.info(f"Sweep of {len(nodes)} nodes, {len(done)} already done, {len(waiting)} to run "
+                f"with {cores} cores and {f_size(memory)} of memory")
+    if dry_run:
+        for node in nodes:
+            logger.info(f"{'done' if node.name in done else 'todo'}\t{node}\tafter {node.deps}")
+        return set()
+
+    failed, running = set(), {}  # running: {sentinel: (process, node, start)}
+    start_sweep = perf_counter()
+    # Ctrl-C: no new node, the running ones are interrupted (same process group) and the sweep ends after them
+    interrupted = []
+    previous_handler = signal.signal(signal.SIGINT, lambda signum, frame: interrupted.append(signum))
+    try:
+        while (waiting and not interrupted) or running:
+            for node in [node for node in waiting if any(dep in failed for dep in node.deps)]:
+                logger.error(f"Abandoned {node.name}, a node it depends on failed")
+                waiting.remove(node)
+                failed.add(node.name)
+            used_cores = sum(node.cores for _, node, _ in running.values())
+            used_memory = sum(node.memory() for _, node, _ in running.values())
+            for node in [node for node in waiting if all(dep in done for dep in node.deps) and not interrupted]:
+                if running and (used_cores + node.cores > cores or used_memory + node.memory() > memory):
+                    continue
+                process = Process(target=run_node, args=(node.last, node.kwargs), name=node.name)
+                process.start()
+                running[process.sentinel] = (process, node, perf_counter())
+                used_cores += node.cores
+                used_memory += node.memory()
+                waiting.remove(node)
+                logger.info(f"Started {node}, estimated memory {f_size(node.memory())}. "
+                            f"{len(running)} running, {len(waiting)} waiting")
+            if not running:
+                break
+            for sentinel in wait(list(running)):
+                process, node, start = running.pop(sentinel)
+                process.join()
+                end = perf_counter()
+                if process.exitcode == 0:
+                    done.add(node.name)
+                    with open(marker[node.name] + ".tmp", "w") as f:
+                        json.dump({"node": node.name, "finished": time(), "duration": end - start, "deps": node.deps,
+                                   "kwargs": node.kwargs}, f, default=str)
+                    os.replace(marker[node.name] + ".tmp", marker[node.name])
+                    logger.info(f"Done {node.name} in {time_to_hms(start, end)}")
+                else:
+                    failed.add(node.name)
+                    logger.error(f"Failed {node.name} (exit code {process.exitcode}), see the log above")
+    finally:
+        # on an error of the sweep itself, don't leave the nodes running on their own
+        for process, node, _ in running.values():
+            logger.error(f"Stopping {node.name}")
+            process.terminate()
+        for process, _, _ in running.values():
+            process.join()
+        signal.signal(signal.SIGINT, previous_handler)
+    if interrupted:
+        logger.error(f"User interrupted, {len(waiting)} nodes not started. Run the sweep again to resume")
+    logger.info(f"Sweep ended in {time_to_hms(start_sweep, perf_counter())}: {len(done)} nodes done, "
+                f"{len(failed)} failed {sorted(failed)}")
+    return {node.name for node in nodes if node.name not in done}
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    parser.add_argument('path_database',    help='Database root folder. Supported format: RefSeq 2019',
+                                            type=is_valid_directory)
+    parser.add_argument('taxonomy',         help='path to taxonomy (absolute path)',    type=is_valid_directory)
+    parser.add_argument('path_plot_me',     help="Data folder for PLoT-ME, same as plot-me.preprocess",
+                                            type=is_valid_directory)
+
+    parser.add_argument('-k', '--kmer',     help='Sizes of the kmers (default=%(default)s)',
+                                            default=[4], type=int, nargs="+", metavar='')
+    parser.add_argument('-w', '--window',   help='Segments/windows sizes (default=%(default)s)',
+                                            default=[10000], type=int, nargs="+", metavar='')
+    parser.add_argument('-b', '--bins',     help='Numbers of bins/clusters (default=%(default)s)',
+                                            default=[10], type=int, nargs="+", metavar='')
+    parser.add_argument('-o', '--omit',     help='Folders/families to omit, space separated. Repeat the option for '
+                                                 'several settings, ex: -o plant vertebrate -o plant (default: plant '
+                                                 'vertebrate)',
+                                            default=None, nargs="*", type=str, metavar='', action="append")
+    parser.add_argument('-c', '--classifier', help="classifier's name and its parameters, space separated. Repeat the "
+                                                   "option for several classifiers, ex: '-c kraken2 k 35 l 31 s 7 "
+                                                   "-c kraken2 k 25 l 22 s 4' (default: kraken2 k 35 l 31 s 7)",
+                                            default=None, type=str, nargs="+", metavar='', action="append")
+    parser.add_argument('--canonical',      help='Count each k-mer together with its reverse complement',
+                                            action='store_true')
+
+    parser.add_argument('-t', '--threads',  help='Number of cores for the whole sweep (default=%(default)d)',
+                                            default=cpu_count(), type=int, metavar='')
+    parser.add_argument('--node-threads', '--node_threads',
+                                            help='Number of cores of each counting, binning and classifier node, the '
+                                                 'combine and clustering nodes use one (default: --threads)',
+                                            default=None, type=int, metavar='', dest='node_threads')
+    parser.add_argument('-m', '--memory',   help='Memory for the whole sweep in GB, nodes start while their estimated '
+                                                 'memory fits (default: physical memory)',
+                                            default=None, type=float, metavar='')
+    parser.add_argument('-e', '--early',    help="Last step of the sweep, ex: 3 to stop at the bins, without "
+                                                 "classifiers' indexes (default=%(default)d)",
+                                            default=STEPS - 1, type=int, metavar='',)
+    parser.add_argument('-n', '--dry-run', '--dry_run',
+                                            help='Only display the nodes, done or to do, and what they depend on',
+                                            action='store_true', dest='dry_run')
+    parser.add_argument('--chunk-rows', '--chunk_rows',
+                                            help='Out-of-core clustering, see plot-me.preprocess',
+                                            default=None, type=int, metavar='', dest='chunk_rows')
+    parser.add_argument('--sample-per-taxon', '--sample_per_taxon',
+                                            help='Train the clustering on at most this number of segments per taxon',
+                                            default=None, type=int, metavar='', dest='sample_per_taxon')
+    parser.add_argument('--cache',          help='Cache of the k-mer counts of each genome (default: $PLOT_ME_CACHE '
+                                                 'or ~/PLoT-ME/cache)',
+                                            default=None, type=str, metavar='')
+    parser.add_argument('--cache-size', '--cache_size',
+                                            help='Size limit of the cache in GB, 0 disables it (default=%(default).1f)',
+                                            default=CACHE_SIZE / 10**9, type=float, metavar='', dest='cache_size')
     args = parser.parse_args()
 
-    main(args.kmer, args.cores, args.skip_existing)
+    logger.info(f"Script {__file__} called with {args}")
+    nodes = sweep_nodes(args.path_database, args.path_plot_me, args.taxonomy, args.kmer, args.window, args.bins,
+                        args.omit or [("plant", "vertebrate")], args.classifier or [parse_DB.CLASSIFIERS[0]],
+                        node_cores=args.node_threads or args.threads, early_stop=args.early, canonical=args.canonical,
+                        chunk_rows=args.chunk_rows, sample_per_taxon=args.sample_per_taxon, cache=args.cache,
+                        cache_size=int(args.cache_size * 10**9))
+    not_done = run_sweep(nodes, osp.join(args.path_plot_me, "sweep"), args.threads,
+                         None if args.memory is None else int(args.memory * 10**9), args.dry_run)
+    if not_done:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    arg_parser()
@@ -13,18 +13,15 @@
 import os
 import os.path as osp
 
-# import ete3.ncbi_taxonomy
-import matplotlib.pyplot as plt
 import pandas as pd
 import numpy as np
-from sklearn.metrics import auc
+# matplotlib and sklearn are imported by the functions using them, they take seconds to load
 
-from plot_me.bio import ncbi, get_list_rank
-from plot_me.tools import PATHS
+from plot_me.bio import get_list_rank
+from plot_me.taxonomy import get_taxonomy
 
 
-pd.set_option('precision', 5)
-# ncbi = ete3.ncbi_taxonomy.NCBITaxa()
+pd.set_option('display.precision', 5)
 
 
 class Report:
@@ -95,39 +92,32 @@ class Report:
         self.report.iloc[:, 0] /= self.nb_assigned
 
     def prec_recall(self, gt_species):
-        """ Get a set containing the species present. change to ratio instead of absolute number after working on the report """
-        #         print(self.title)
-        # Floor the numbers by multiplying by 'rounding', then floor with numpy, then dividing again.
-        rounding = 10 ** 5
-        thresholds = ((self.report.iloc[:, 0] * rounding).apply(np.floor) / rounding).unique()
-        thresholds.sort()
-        data = []
-
-        for i, threshold in enumerate(thresholds):
-            found = set(self.report[self.report.iloc[:, 0] >= threshold].index)
-            tp = len(set.intersection(found, gt_species))
-            fn = len(gt_species) - tp
-            fp = len(found) - tp
-            data.append((threshold, tp, fn, fp,))
-
-        df_auc = pd.DataFrame(data, columns=["threshold", "tp", "fn", "fp"])
+        """ Precision and recall for each abundance threshold, comparing the species found to a set of species """
+        prec_recall_batch([self], gt_species)
+
+    def set_prec_recall(self, thresholds, counts):
+        """ counts is a (thresholds, 3) array of tp, fn, fp """
+        df_auc = pd.DataFrame(counts, columns=["tp", "fn", "fp"])
+        df_auc.insert(0, "threshold", thresholds)
         df_auc["recall"] = df_auc.tp / (df_auc.tp + df_auc.fn)
         df_auc["precision"] = df_auc.tp / (df_auc.tp + df_auc.fp)
         df_auc[["recall", "precision"]] = df_auc[["recall", "precision"]].fillna(0)
         # Extend the last precision to 0 recall, as we don't have abundance threshold down to 0%
         df_auc.loc[df_auc.index.max() + 1] = df_auc.iloc[-1]
-        df_auc.recall.iloc[-1] = 0
+        df_auc.loc[df_auc.index[-1], "recall"] = 0
 
         self.df_auc = df_auc
         self.thresholds = thresholds
         self.recall = df_auc["recall"].tolist()
         self.precision = df_auc["precision"].tolist()
+        from sklearn.metrics import auc
         self.auc = auc(self.recall, self.precision)
 
     def plot_pr(self, nb=5, total=10, string_gt=""):
         # todo: thicker line, dotted line
         ratio = (total - nb) / total
         label = f"auc={self.auc:.3f}, ({self.nb_assigned}/{self.nb_reads}) : {self.title}"
+        import matplotlib.pyplot as plt
         plt.plot(self.recall, self.precision,  # alpha=0.7,
                  linewidth=2 + 3 * ratio, linestyle=self.line_style[self.obj_id % len(self.line_style)],
                  marker='+', markersize=10 + 4 * ratio, markeredgewidth=1 + 2 * ratio,
@@ -138,6 +128,47 @@ class Report:
         return f"Report from {self.title} DB classification, {self.folder}"
 
 
+def prec_recall_curves(abundances, gt_species, rounding=10 ** 5):
+    """ Precision/recall curves of several reports at once. abundances is a list of pd.Series indexed by taxon.
+        The thresholds of a report are its abundances floored to 1/rounding. A single sort of all abundances and
+        thresholds (thresholds first when equal), then cumulative sums of the abundances above each threshold, and
+        of those in the ground truth, give the species found (tp + fp) and the true positives at every threshold.
+        Returns a list of (sorted unique thresholds, (thresholds, 3) array of tp, fn, fp), one per report
+    """
+    sizes = np.array([len(abundance) for abundance in abundances], dtype=np.int64)
+    values = np.concatenate([abundance.to_numpy(dtype=float) for abundance in abundances] + [np.empty(0)])
+    in_gt = np.concatenate([abundance.index.isin(list(gt_species)) for abundance in abundances] + [np.empty(0, bool)])
+    groups = np.repeat(np.arange(len(abundances)), sizes)
+    thresholds = np.floor(values * rounding) / rounding
+    n = values.shape[0]
+
+    is_value = np.repeat([False, True], n)
+    order = np.lexsort((is_value, np.concatenate([thresholds, values]), np.concatenate([groups, groups])))
+    values_above = np.cumsum(is_value[order])
+    gt_above = np.cumsum(np.concatenate([np.zeros(n, bool), in_gt])[order])
+    rows = ~is_value[order]
+    group, threshold = groups[order[rows]], thresholds[order[rows]]
+    # counts of the previous groups, and the total per group, to turn the cumulative sums into counts >= threshold
+    starts = np.concatenate([[0], np.cumsum(sizes)])
+    gt_starts = np.concatenate([[0], np.cumsum(in_gt)])[starts]
+    found = starts[group + 1] - values_above[rows]
+    tp = gt_starts[group + 1] - gt_above[rows]
+
+    unique = np.ones(group.shape[0], dtype=bool)
+    unique[1:] = (group[1:] != group[:-1]) | (threshold[1:] != threshold[:-1])
+    group, threshold, found, tp = group[unique], threshold[unique], found[unique], tp[unique]
+    counts = np.stack([tp, len(gt_species) - tp, found - tp], axis=1)
+    bounds = np.searchsorted(group, np.arange(len(abundances) + 1))
+    return [(threshold[start:end], counts[start:end]) for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def prec_recall_batch(reports, gt_species):
+    """ Precision, recall and AUC of several Report with one call to prec_recall_curves """
+    curves = prec_recall_curves([report.report.iloc[:, 0] for report in reports], gt_species)
+    for report, (thresholds, counts) in zip(reports, curves):
+        report.set_prec_recall(thresholds, counts)
+
+
 class ReportsAnalysis:
 
     def __init__(self, folder, string_full, string_bins, path_ground_truth):
@@ -192,7 +223,7 @@ class ReportsAnalysis:
         gt_stats["species"] = get_list_rank(gt_stats.taxon)
         gt_stats = gt_stats.groupby("species").sum()[["count"]].sort_values("count", ascending=False)
         gt_stats.reset_index(inplace=True)
-        gt_stats["name"] = ncbi.translate_to_names(gt_stats.species)
+        gt_stats["name"] = get_taxonomy().names(gt_stats.species)
         gt_stats["percentage"] = gt_stats["count"] * 100 / gt_stats["count"].sum()
         self.gt_stats = gt_stats
 
@@ -210,12 +241,12 @@ class ReportsAnalysis:
     def prec_recall(self, select=-1):
         self.gt_species = set(self.gt_stats.species.unique())
         if select < 0:
-            for k in self.reports.keys():
-                self.reports[k].prec_recall(self.gt_species)
+            prec_recall_batch(list(self.reports.values()), self.gt_species)
         else:
             self.reports[select].prec_recall(self.gt_species)
 
     def plot_pr(self):
+        import matplotlib.pyplot as plt
         plt.plot(self.report.recall, self.report.precision)
         plt.axis([0, 1, 0, 1])
         plt.xlabel("Recall")
@@ -227,7 +258,7 @@ def compare_setups(reports):
     comparison = pd.concat(reports, axis=1)
     comparison.fillna(0, inplace=True)                   # non found taxon are NaN
     comparison = comparison[(comparison.T != 0).any()]   # Remove full zeros rows
-    comparison["species_name"] = ncbi.get_taxid_translator(comparison.index).values()
+    comparison["species_name"] = get_taxonomy().names(comparison.index)
 #     comparison.drop(columns=["cluster"], inplace=True)
     return comparison
 
@@ -279,17 +310,18 @@ def plot_auc_comparison(gt, reports, fig_path, title=f"AUC for various parameter
     r = gt.report
     r = r[r.ground_truth > 0].copy()
     r["percentage"] = round(r.ground_truth * 100, 2)
-    r["species"] = ncbi.translate_to_names(r.index)
+    r["species"] = get_taxonomy().names(r.index)
     r.drop(columns=["ground_truth"], inplace=True)
     r.sort_values(by=["percentage", "species"], ascending=[False, True], inplace=True)
     string_gt = "\n * GroundTruth * \n" + r[r.percentage > 0].to_string(index=False)
 
     legend = []
     gt_set = set(gt.report.index)
+    import matplotlib.pyplot as plt
     fig = plt.figure(figsize=(10, 6))
     plt.rcParams.update({'font.size': 12})
+    prec_recall_batch(list(reports.values()), gt_set)
     for i, k in enumerate(reports.keys()):
-        reports[k].prec_recall(gt_set)
         reports[k].plot_pr(i, len(reports))
         legend.append(reports[k].legend)
 
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""
+#############################################################################
+NCBI taxonomy from the nodes.dmp and names.dmp of a taxonomy folder (the one
+ given to plot-me.preprocess / kraken2), as numpy arrays indexed by taxid.
+Parsed once, then cached next to the .dmp files. Works offline, and all
+ queries (lineage, rank, LCA, names) take whole arrays of taxids.
+
+#############################################################################
+Sylvain @ GIS / Biopolis / Singapore
+Sylvain RIONDET <sylvainriondet@gmail.com>
+PLoT-ME: Pre-classification of Long-reads for Memory Efficient Taxonomic assignment
+https://github.com/sylvain-ri/PLoT-ME
+#############################################################################
+"""
+import os
+import os.path as osp
+
+import numpy as np
+
+from plot_me import PLOT_ME_ROOT
+from plot_me.tools import init_logger
+
+
+logger = init_logger("taxonomy")
+# Taxonomy folder used when none is given, can be set by plot-me.preprocess or with $PLOT_ME_TAXONOMY
+DEFAULT_PATH = os.environ.get("PLOT_ME_TAXONOMY", PLOT_ME_ROOT.joinpath("taxonomy").as_posix())
+CACHE_NAME = "taxonomy.plot-me.npz"
+CACHE_VERSION = 1
+
+
+class Taxonomy:
+    """ parents[taxid], ranks[taxid] (code in rank_names), depths[taxid] (root=1) and scientific names.
+        Taxid 0 is the sentinel for unknown taxids and above the root, its rank is "" and its name "".
+    """
+    def __init__(self, parents, ranks, rank_names, depths, names_blob, names_offsets):
+        self.parents       = parents
+        self.ranks         = ranks
+        self.rank_names    = tuple(rank_names)
+        self.rank_codes    = {rank: i for i, rank in enumerate(self.rank_names)}
+        self.depths        = depths
+        self.names_blob    = names_blob
+        self.names_offsets = names_offsets
+
+    @property
+    def size(self):
+        return self.parents.shape[0]
+
+    # ##########################################################################
+    # Loading
+    @classmethod
+    def from_dmp(cls, folder):
+        """ Parse nodes.dmp and names.dmp (scientific names only) """
+        import csv
+        import pandas as pd
+
+        logger.info(f"Parsing the taxonomy from {folder}, cached afterwards")
+        read_dmp = dict(sep="\t", header=None, quoting=csv.QUOTE_NONE, dtype=str, keep_default_na=False)
+        nodes = pd.read_csv(osp.join(folder, "nodes.dmp"), usecols=[0, 2, 4], **read_dmp)
+        taxids = nodes[0].to_numpy(dtype=np.int64)
+        size = int(taxids.max()) + 1
+
+        parents = np.zeros(size, dtype=np.int32)
+        parents[taxids] = nodes[2].to_numpy(dtype=np.int64)
+        parents[parents == np.arange(size)] = 0  # the root is its own parent in nodes.dmp
+        rank_names, codes = np.unique(np.concatenate([[""], nodes[4].to_numpy(dtype=str)]), return_inverse=True)
+        ranks = np.zeros(size, dtype=np.uint8)
+        ranks[taxids] = codes[1:]
+
+        names = pd.read_csv(osp.join(folder, "names.dmp"), usecols=[0, 2, 6], **read_dmp)
+        names = names[names[6] == "scientific name"]
+        encoded = [name.encode() for name in names[2]]
+        lengths = np.zeros(size, dtype=np.int64)
+        lengths[names[0].to_numpy(dtype=np.int64)] = [len(name) for name in encoded]
+        order = np.argsort(names[0].to_numpy(dtype=np.int64), kind="stable")
+        names_blob = b"".join(encoded[i] for i in order)
+        names_offsets = np.concatenate([[0], np.cumsum(lengths)])
+
+        known = np.zeros(size, dtype=bool)
+        known[taxids] = True
+        return cls(parents, ranks, rank_names.tolist(), cls.compute_depths(parents, known), names_blob, names_offsets)
+
+    @staticmethod
+    def compute_depths(parents, known):
+        """ Number of nodes from the root (depth 1) to each taxid (0 if not in the taxonomy), all climbing at once """
+        depths = np.zeros(parents.shape[0], dtype=np.int32)
+        current = np.where(known, np.arange(parents.shape[0], dtype=np.int32), 0)
+        while True:
+            alive = current != 0
+            if not alive.any():
+                return depths
+            depths += alive
+            current = parents[current]
+
+    @staticmethod
+    def signature(folder):
+        return np.array([os.stat(osp.join(folder, dmp)).st_mtime_ns for dmp in ("nodes.dmp", "names.dmp")]
+                        + [os.stat(osp.join(folder, dmp)).st_size for dmp in ("nodes.dmp", "names.dmp")])
+
+    def save(self, path, signature):
+        np.savez(path, version=CACHE_VERSION, signature=signature, parents=self.parents, ranks=self.ranks,
+                 rank_names=np.array(self.rank_names, dtype=str), depths=self.depths,
+                 names_blob=np.frombuffer(self.names_blob, dtype=np.uint8), names_offsets=self.names_offsets)
+
+    @classmethod
+    def load(cls, folder=None):
+        """ Taxonomy of a folder with nodes.dmp and names.dmp, from its cache if the .dmp files haven't changed """
+        folder = DEFAULT_PATH if folder is None else folder
+        assert osp.isfile(osp.join(folder, "nodes.dmp")), FileNotFoundError(f"No nodes.dmp in {folder}")
+        signature = cls.signature(folder)
+        path_cache = osp.join(folder, CACHE_NAME)
+        if osp.isfile(path_cache):
+            with np.load(path_cache, allow_pickle=False) as cache:
+                if int(cache["version"]) == CACHE_VERSION and np.array_equal(cache["signature"], signature):
+                    return cls(cache["parents"], cache["ranks"], cache["rank_names"].tolist(), cache["depths"],
+                               cache["names_blob"].tobytes(), cache["names_offsets"])
+        taxonomy = cls.from_dmp(folder)
+        try:
+            taxonomy.save(path_cache, signature)
+        except OSError as e:
+            logger.warning(f"Could not cache the taxonomy ({e}), it will be parsed again next time")
+        return taxonomy
+
+    # ##########################################################################
+    # Queries, on arrays of taxids
+    def index(self, taxids):
+        """ taxids as an int array, unknown ones replaced by 0 """
+        taxids = np.atleast_1d(np.asarray(taxids, dtype=np.int64))
+        known = (taxids > 0) & (taxids < self.size)
+        taxids = np.where(known, taxids, 0)
+        taxids[self.depths[taxids] == 0] = 0
+        return taxids
+
+    def lineage(self, taxid):
+        """ Taxids from the root to this taxid (like ete3's get_lineage), empty if unknown """
+        return [int(t) for t in self.lineages([taxid])[0] if t != 0]
+
+    def lineages(self, taxids):
+        """ Matrix of lineages, one row per taxid: column j holds its ancestor at depth j+1, 0 below the taxid """
+        current = self.index(taxids)
+        depths = self.depths[current]
+        matrix = np.zeros((current.shape[0], int(depths.max(initial=0))), dtype=np.int64)
+        rows = np.arange(current.shape[0])
+        while True:
+            alive = depths > 0
+            if not alive.any():
+                return matrix
+            matrix[rows[alive], depths[alive] - 1] = current[alive]
+            current = self.parents[current]
+            depths = depths - alive
+
+    def at_rank(self, taxids, rank="species"):
+        """ Ancestor (or itself) of each taxid at this rank, 0 if none (ex: taxid above the rank, or unknown) """
+        current = self.index(taxids)
+        result = np.zeros(current.shape[0], dtype=np.int64)
+        code = self.rank_codes.get(rank)
+        if code is None:
+            return result
+        while True:
+            found = (self.ranks[current] == code) & (result == 0)
+            result[found] = current[found]
+            current = self.parents[current]
+            if not (current != 0).any():
+                return result
+
+    def at_ranks(self, taxids, ranks):
+        """ Matrix of the ancestors of each taxid, one column per rank """
+        return np.stack([self.at_rank(taxids, rank) for rank in ranks], axis=1)
+
+    def rank(self, taxids):
+        """ Rank names of the taxids ("" if unknown) """
+        return [self.rank_names[code] for code in self.ranks[self.index(taxids)]]
+
+    def lca(self, taxids_a, taxids_b):
+        """ Lowest common ancestor of each pair of taxids, 0 if one of them is unknown """
+        a, b = self.index(taxids_a), self.index(taxids_b)
+        a, b = np.broadcast_arrays(a, b)
+        a, b = a.copy(), b.copy()
+        for deeper, other in ((a, b), (b, a)):
+            while True:
+                climb = self.depths[deeper] > self.depths[other]
+                if not climb.any():
+                    break
+                deeper[climb] = self.parents[deeper[climb]]
+        while True:
+            climb = a != b
+            if not climb.any():
+                return a
+            a[climb] = self.parents[a[climb]]
+            b[climb] = self.parents[b[climb]]
+
+    def lca_of(self, taxids):
+        """ Lowest common ancestor of all these taxids """
+        taxids = self.index(taxids)
+        while taxids.shape[0] > 1:
+            half = taxids.shape[0] // 2
+            paired = self.lca(taxids[:half], taxids[half:2 * half])
+            taxids = np.concatenate([paired, taxids[2 * half:]])
+        return int(taxids[0]) if taxids.shape[0] else 0
+
+    def names(self, taxids):
+        """ Scientific names of the taxids ("" if unknown) """
+        taxids = self.index(taxids)
+        starts, ends = self.names_offsets[taxids], self.names_offsets[taxids + 1]
+        return [self.names_blob[start:end].decode() for start, end in zip(starts.tolist(), ends.tolist())]
+
+    def translator(self, taxids):
+        """ {taxid: scientific name}, like ete3's get_taxid_translator """
+        taxids = np.atleast_1d(np.asarray(taxids, dtype=np.int64))
+        return dict(zip(taxids.tolist(), self.names(taxids)))
+
+    def __repr__(self):
+        return f"Taxonomy of {int((self.depths > 0).sum())} taxids, {len(self.rank_names) - 1} ranks"
+
+
+def get_taxonomy(folder=None):
+    """ Taxonomy loaded once per folder """
+    folder = DEFAULT_PATH if folder is None else folder
+    if folder not in get_taxonomy.loaded:
+        get_taxonomy.loaded[folder] = Taxonomy.load(folder)
+    return get_taxonomy.loaded[folder]
+
+
+get_taxonomy.loaded = {}
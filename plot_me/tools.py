@@ -11,18 +11,26 @@ https://github.com/sylvain-ri/PLoT-ME
 #############################################################################
 """
 import argparse
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+import gzip
+import io
+from itertools import islice
 import logging
 from multiprocessing import cpu_count
 # from multiprocessing.pool import Pool
 import numpy as np
 import os
 import os.path as osp
-import pandas as pd
 from pathlib import Path
+import resource
 import shutil
+import struct
 import subprocess
+import threading
 from tqdm import tqdm
+import zlib
 
 from plot_me import LOGS
 
@@ -30,24 +38,35 @@ from plot_me import LOGS
 # #############################################################################
 # https://docs.python.org/3/howto/logging-cookbook.html
 def init_logger(logger_name='reads_binning', verbose=True):
-    # create formatter for the handlers
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    # create file handler which logs even debug messages
-    fh = logging.FileHandler(LOGS)
-    fh.setLevel(logging.DEBUG)
-    fh.setFormatter(formatter)
+    # create logger with parse_DB.py and add the handlers to the logger, only once per logger
+    new_logger = logging.getLogger(logger_name)
+    new_logger.setLevel(logging.DEBUG)
+    if new_logger.handlers:
+        return new_logger
     # create console handler with a higher log level
     ch = logging.StreamHandler()
     ch.setLevel(logging.INFO if verbose else logging.DEBUG)
-    ch.setFormatter(formatter)
-    # create logger with parse_DB.py and add the handlers to the logger
-    new_logger = logging.getLogger(logger_name)
-    new_logger.setLevel(logging.DEBUG)
-    new_logger.addHandler(fh)
+    ch.setFormatter(init_logger.formatter)
+    new_logger.addHandler(log_file_handler())
     new_logger.addHandler(ch)
     return new_logger
 
 
+def log_file_handler():
+    """ File handler which logs even debug messages, shared by all loggers, the file being opened on first write """
+    if log_file_handler.handler is None:
+        fh = logging.FileHandler(LOGS, delay=True)
+        fh.setLevel(logging.DEBUG)
+        fh.setFormatter(init_logger.formatter)
+        log_file_handler.handler = fh
+    return log_file_handler.handler
+
+
+log_file_handler.handler = None
+# create formatter for the handlers
+init_logger.formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+
 logger = init_logger('tools')
 
 
@@ -131,9 +150,17 @@ f_size.splits = {
 
 def bash_process(cmd, msg=""):
     """ execute a bash command (list of string), redirect stream into logger
-        encoding=utf-8 to have text stream (somehow text=True not accepted by PyCharm),
         redirecting all stream to the Pipe, shell on for commands with bash syntax like wild cards
     """
+    proc = launch_process(cmd, msg)
+    wait_process(proc)
+
+
+def launch_process(cmd, msg="", stdin=None):
+    """ start a bash command (list of string, or string for bash syntax) without waiting for it to finish.
+        stdout and stderr are combined and redirected into the logger by a background thread.
+        stdin=subprocess.PIPE to feed data to the process (binary). End it with wait_process()
+    """
     # https://docs.python.org/3/library/subprocess.html#subprocess.Popen
     if isinstance(cmd, str):
         shell = True
@@ -145,24 +172,59 @@ def bash_process(cmd, msg=""):
                 + ": " + (cmd.split()[0] if shell else cmd[0]))
     logger.debug(cmd if shell else " ".join(cmd))
 
-    # Combine stdout and stderr into the same stream, both as text (non binary)
-    proc = subprocess.Popen(cmd, shell=shell, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, encoding="utf-8")
-    for line in iter(proc.stdout.readline, ''):
-        logger.debug(line.replace("\n", ""))
-    # Check that the process ended successfully
-    proc.wait(60*60*24)  # wait 24 hours max
+    # Combine stdout and stderr into the same stream
+    proc = subprocess.Popen(cmd, shell=shell, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    proc.cmd = cmd if shell else " ".join(cmd)
+    proc.log_thread = threading.Thread(target=log_stream, args=(proc.stdout,), daemon=True)
+    proc.log_thread.start()
+    return proc
+
+
+def log_stream(stream):
+    for line in iter(stream.readline, b''):
+        logger.debug(line.decode("utf-8", "replace").rstrip("\n"))
+
+
+def wait_process(proc, timeout=60*60*24):
+    """ Wait for a process from launch_process() (24 hours max) and check that it ended successfully """
+    proc.wait(timeout)
+    proc.log_thread.join()
     if proc.returncode == 123:
         logger.warning(f"Process {proc.pid} exited with exit status {proc.returncode}")
     elif proc.returncode != 0:
         logger.warning(f"Process {proc.pid} exited with exit status {proc.returncode}")
-        raise ChildProcessError(f"see log file, bash command raised errors: " +
-                                cmd if isinstance(cmd, str) else " ".join(cmd))
+        raise ChildProcessError(f"see log file, bash command raised errors: {proc.cmd}")
+
+
+def total_memory():
+    """ Physical memory of the machine, in bytes """
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+def peak_memory():
+    """ Peak resident memory of this process so far, in bytes """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
 
 
 def div_z(n, d):
     return n / d if d else 0
 
 
+def split_proportionally(total, weights):
+    """ Split an integer total (ex: threads) in proportion to the weights, at least 1 each, the remainder going
+        to the parts the furthest below their share """
+    if not weights:
+        return []
+    weight_sum = sum(weights)
+    shares = [total * w / weight_sum if weight_sum else total / len(weights) for w in weights]
+    parts = [max(1, int(share)) for share in shares]
+    for i in sorted(range(len(shares)), key=lambda j: shares[j] - parts[j], reverse=True):
+        if sum(parts) >= total:
+            break
+        parts[i] += 1
+    return parts
+
+
 def time_to_hms(start, end, fstring=True, short=False):
     assert start <= end, ArithmeticError(f"The start time is later than the end time: {start} > {end}")
     delay = int(end - start)
@@ -199,43 +261,302 @@ class ArgumentParserWithDefaults(argparse.ArgumentParser):
         super().add_argument(*args, **kwargs)
 
 
-def pll_scaling(serie):
-    serie = pd.to_numeric(serie, downcast='float')
-    serie *= pll_scaling.ratio
-    return serie
+def kmer_scaling_ratio(k, w):
+    """ Factor turning the kmer counts of a segment of length w into frequencies times the number of kmer choices """
+    divider = w - k + 1
+    return np.float32(4**k / divider if divider > 1 else 4**k)  # avoid divide by 0
 
 
-pll_scaling.ratio = 0
+def scale_counts(counts, k, w, out=None):
+    """ Scale a matrix of kmer counts of segments of length w in a single multiplication. Into out if given (a float32
+        matrix, can be counts itself to scale in place), otherwise into a new C-contiguous float32 matrix """
+    if out is None:
+        out = np.empty(counts.shape, dtype=np.float32)
+    return np.multiply(counts, kmer_scaling_ratio(k, w), out=out)
 
 
 def scale_df_by_length(data, kmer_cols, k, w, single_row=False, cores=cpu_count()):
     """ Divide the kmer counts by the length of the segments, and multiply by the number kmer choices"""
-    divider = w - k + 1
-    ratio = 4**k / divider if divider > 1 else 4**k  # avoid divide by 0
-    ratio = np.float32(ratio)
+    ratio = kmer_scaling_ratio(k, w)
     if single_row:
-        return data * ratio
+        return np.multiply(data, ratio, dtype=np.float32)
     else:
         logger.info(f"Scaling the dataframe {data.shape}, converting to float32")
-        logger.debug(f"{data}")
+        # One multiplication of the block of kmer columns, instead of one per column
+        data[kmer_cols] = np.multiply(data[kmer_cols].to_numpy(), ratio, dtype=np.float32)
+
+
+def scale_rows_by_length(counts, lengths, k):
+    """ Same scaling as scale_df_by_length(), for a matrix of kmer counts with one row per sequence, each of its own
+        length. Single broadcast multiplication, returns a float32 matrix """
+    dividers = np.asarray(lengths, dtype=np.int64) - k + 1
+    ratios = (4**k / np.where(dividers > 1, dividers, 1)).astype(np.float32)  # avoid divide by 0
+    return np.multiply(counts, ratios[:, None], dtype=np.float32)
+
+
+def batches(iterable, size):
+    """ Yield lists of <size> items from an iterable, the last one being shorter """
+    iterator = iter(iterable)
+    batch = list(islice(iterator, size))
+    while batch:
+        yield batch
+        batch = list(islice(iterator, size))
+
+
+class CentroidModel:
+    """ Nearest centroid model, exported from the sklearn (MiniBatch)KMeans by plot-me.preprocess in a small .npz:
+        float32 centroids, their squared norms, and the parameters of the k-mer counting (k, w, number of bins,
+        omitted folders, canonical k-mers). Predicting only needs numpy, no sklearn.
+    """
+    def __init__(self, centroids, k, w, omitted=(), canonical=False, clusterer="minikm", squared_norms=None):
+        self.centroids     = np.ascontiguousarray(centroids, dtype=np.float32)
+        self.squared_norms = (np.einsum("ij,ij->i", self.centroids, self.centroids) if squared_norms is None
+                              else np.asarray(squared_norms, dtype=np.float32))
+        self.k         = int(k)
+        self.w         = int(w)
+        self.omitted   = tuple(omitted)
+        self.canonical = bool(canonical)
+        self.clusterer = clusterer
+
+    @property
+    def n_clusters(self):
+        return self.centroids.shape[0]
+
+    @classmethod
+    def from_sklearn(cls, model, k, w, omitted=(), canonical=False, clusterer="minikm"):
+        return cls(model.cluster_centers_, k, w, omitted, canonical, clusterer)
+
+    def save(self, path):
+        np.savez(path, centroids=self.centroids, squared_norms=self.squared_norms, k=self.k, w=self.w,
+                 omitted=np.array(self.omitted, dtype=str), canonical=self.canonical, clusterer=self.clusterer)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            return cls(data["centroids"], int(data["k"]), int(data["w"]), data["omitted"].tolist(),
+                       bool(data["canonical"]), str(data["clusterer"]), data["squared_norms"])
+
+    def predict(self, X, batch_size=4096):
+        """ Closest centroid of each row. |x-c|^2 = |x|^2 - 2 x.c + |c|^2, |x|^2 doesn't change the argmin,
+            x.c for all rows and centroids is one matrix product (GEMM) per batch of rows """
+        X = np.asarray(X, dtype=np.float32)
+        labels = np.empty(X.shape[0], dtype=np.int32)
+        for start in range(0, X.shape[0], batch_size):
+            distances = X[start:start + batch_size] @ self.centroids.T
+            distances *= -2
+            distances += self.squared_norms
+            labels[start:start + batch_size] = distances.argmin(axis=1)
+        return labels
 
-        pll_scaling.ratio = ratio
+    def __repr__(self):
+        return f"CentroidModel({self.clusterer}, b={self.n_clusters}, k={self.k}, w={self.w}, " \
+               f"omitted={self.omitted}, canonical={self.canonical})"
 
-        # Mono thread version (extremely slow for some reasons)
-        for col in tqdm(kmer_cols):
-            data[col] *= ratio
 
-        # with Pool(cores) as pool:
-        #     results = list(tqdm(pool.imap(pll_scaling, (data.loc[:, col] for col in kmer_cols)),
-        #                         total=len(kmer_cols), desc="scaling each Series"))
-        # # much faster, but let's see if there an even faster assignment
-        # # todo: build a new DataFrame from scratch ?
-        # for i, col in tqdm(enumerate(kmer_cols), total=len(kmer_cols), desc="Assigning results back to DataFrame"):
-        #     data.assign[col] = results[i]
-        #     data[col] = results[i]
+class BufferedWriterPool:
+    """ Keep one buffered handle (append mode) per output file, instead of open/append/close for each record.
+        Each handle flushes to disk when its buffer of <buffer_size> bytes is full. When <max_open> handles are
+        open, the least recently used one is closed, to stay under the open files limit (ulimit -n).
+        Use it as a context manager to flush and close all the files, on exit or on error.
+    """
+    def __init__(self, buffer_size=4 * 2**20, max_open=None, compress_level=0):
+        """ compress_level: gzip compression level (1-9), 0 for no compression. Reopening an evicted file appends
+            a new gzip member, which stays a valid gzip file """
+        self.logger = logging.getLogger('tools.BufferedWriterPool')
+        self.buffer_size   = buffer_size
+        self.max_open      = max_open if max_open else self.default_max_open()
+        self.compress_level = compress_level
+        self.handles       = OrderedDict()  # {path: handle}, the least recently used first
+        self.bytes_written = {}
+        self.evictions     = 0
+
+    @staticmethod
+    def default_max_open():
+        """ Half of the soft limit of open files, to leave some for the rest of the program """
+        soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+        return max(1, soft // 2)
+
+    def handle(self, path):
+        """ Get the handle for this path, open it if needed (closing the least recently used one if too many) """
+        if path in self.handles:
+            self.handles.move_to_end(path)
+            return self.handles[path]
+        if len(self.handles) >= self.max_open:
+            _, oldest = self.handles.popitem(last=False)
+            oldest.close()
+            self.evictions += 1
+        if self.compress_level > 0:
+            self.handles[path] = io.BufferedWriter(gzip.open(path, "ab", compresslevel=self.compress_level),
+                                                   buffer_size=self.buffer_size)
+        else:
+            self.handles[path] = open(path, "ab", buffering=self.buffer_size)
+        self.bytes_written.setdefault(path, 0)
+        return self.handles[path]
+
+    def write(self, path, data):
+        if isinstance(data, str):
+            data = data.encode()
+        self.handle(path).write(data)
+        self.bytes_written[path] += len(data)
+
+    def flush(self):
+        for handle in self.handles.values():
+            handle.flush()
+
+    def close(self):
+        while self.handles:
+            _, handle = self.handles.popitem(last=False)
+            handle.close()
+        if self.evictions > 0:
+            self.logger.debug(f"{self.evictions} file handles have been closed to stay under {self.max_open} open files")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class Crc32Lines:
+    """ Iterate over the lines of a binary handle, keeping the crc32 and the size of all the bytes read,
+        to get the checksum of a file during the pass that processes it """
+    def __init__(self, handle):
+        self.handle = handle
+        self.crc32  = 0
+        self.size   = 0
+
+    def __iter__(self):
+        for line in self.handle:
+            self.crc32 = zlib.crc32(line, self.crc32)
+            self.size += len(line)
+            yield line
+
+    def skip(self, size):
+        """ Read and discard the next <size> bytes, included in the checksum """
+        while size > 0:
+            chunk = self.handle.read(min(size, 2**24))
+            if not chunk:
+                raise EOFError(f"Reached the end of the file, {size} bytes before the expected offset")
+            self.crc32 = zlib.crc32(chunk, self.crc32)
+            self.size += len(chunk)
+            size -= len(chunk)
+
+
+def file_signature(path):
+    """ Size and modification time of a file, to check in constant time that it hasn't changed """
+    stat = os.stat(path)
+    return {"path": osp.abspath(path), "size": stat.st_size, "mtime": stat.st_mtime}
+
+
+# #############################################################################
+# Compressed inputs
+def fastx_format(path):
+    """ 'fastq' or 'fasta' from the file extension, which can be followed by .gz """
+    name = path.lower()
+    if name.endswith(".gz"):
+        name = name[:-3]
+    for fmt in ("fastq", "fasta"):
+        if name.endswith(f".{fmt}"):
+            return fmt
+    raise NotImplementedError(f"The file is neither ending with .fasta(.gz) nor with .fastq(.gz): {path}")
+
+
+def fastx_base(path):
+    """ Path without the .fastq/.fasta and .gz extensions """
+    if path.lower().endswith(".gz"):
+        path = path[:-3]
+    return osp.splitext(path)[0]
+
+
+def is_gzip(path):
+    with open(path, "rb") as f:
+        return f.read(2) == b"\x1f\x8b"
+
+
+def is_bgzf(path):
+    """ BGZF (blocked gzip, from bgzip/samtools) has an extra field 'BC' with the block size in its gzip header """
+    with open(path, "rb") as f:
+        header = f.read(18)
+    return len(header) == 18 and header[:4] == b"\x1f\x8b\x08\x04" and header[12:14] == b"BC"
+
+
+def open_input(path, threads=1):
+    """ Open a file in binary mode, transparently decompressing gzip files.
+        BGZF files are decompressed block by block with <threads> threads """
+    if not is_gzip(path):
+        return open(path, "rb", buffering=2**20)
+    if threads > 1 and is_bgzf(path):
+        return io.BufferedReader(BgzfReader(path, threads), buffer_size=2**20)
+    return gzip.open(path, "rb")
+
+
+class BgzfReader(io.RawIOBase):
+    """ Read a BGZF file, decompressing the next blocks in a pool of threads (zlib releases the GIL) """
+    def __init__(self, path, threads=4):
+        self.path     = path
+        self._file    = open(path, "rb", buffering=2**20)
+        self._pool    = ThreadPoolExecutor(threads)
+        self._ahead   = 4 * threads  # blocks decompressed in advance
+        self._pending = deque()
+        self._buffer  = memoryview(b"")
+        self._all_read = False
+
+    def readable(self):
+        return True
 
-        logger.debug(f"{data}")
-        # data.loc[:, col] = pd.to_numeric(data.loc[:, col], downcast='float')
+    def _next_block(self):
+        """ Compressed data, crc and size of the next block, None at the end of the file """
+        header = self._file.read(12)
+        if len(header) < 12:
+            return None
+        xlen, = struct.unpack("<H", header[10:12])
+        extra = self._file.read(xlen)
+        block_size = None
+        i = 0
+        while i + 4 <= xlen:
+            sub_len, = struct.unpack("<H", extra[i + 2:i + 4])
+            if extra[i:i + 2] == b"BC":
+                block_size, = struct.unpack("<H", extra[i + 4:i + 6])
+            i += 4 + sub_len
+        if header[:4] != b"\x1f\x8b\x08\x04" or block_size is None:
+            raise ValueError(f"Not a BGZF block in {self.path}")
+        # total block size is block_size + 1 = header (12) + extra (xlen) + deflate data + crc (4) + size (4)
+        return self._file.read(block_size + 1 - 12 - xlen)
+
+    @staticmethod
+    def _inflate(block):
+        data = zlib.decompress(block[:-8], -15)
+        crc, size = struct.unpack("<II", block[-8:])
+        if zlib.crc32(data) != crc or len(data) != size:
+            raise ValueError("BGZF block corrupted (crc or size mismatch)")
+        return data
+
+    def _fill(self):
+        while not self._all_read and len(self._pending) < self._ahead:
+            block = self._next_block()
+            if block is None:
+                self._all_read = True
+            else:
+                self._pending.append(self._pool.submit(self._inflate, block))
+
+    def readinto(self, b):
+        while len(self._buffer) == 0:
+            self._fill()
+            if not self._pending:
+                return 0
+            self._buffer = memoryview(self._pending.popleft().result())
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            for future in self._pending:
+                future.cancel()
+            self._pool.shutdown()
+            self._file.close()
+        super().close()
 
 
 class ScanFolder:
@@ -61,6 +61,8 @@ setuptools.setup(
         'console_scripts': [
             'plot-me.preprocess = plot_me.parse_DB:arg_parser',
             'plot-me.classify = plot_me.classify:arg_parser',
+            'plot-me.cache = plot_me.counts_cache:arg_parser',
+            'plot-me.sweep = plot_me.parse_multi:arg_parser',
         ],
     },
 )